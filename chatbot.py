@@ -1,5 +1,7 @@
 import asyncio
 import logging
+import time
+
 import streamlit as st
 
 # https://github.com/run-llama/llama_index/issues/7244
@@ -10,9 +12,10 @@ loop = asyncio.new_event_loop()
 asyncio.set_event_loop(loop)
 
 # load components form utils
-from utils.chatbot import chatbot
-from utils.components import page_config, add_sidebar, chatbot_intro, styling, load_model
+from utils.components import page_config, add_sidebar, chatbot_intro, styling
 from utils.config import DEBUG
+# torch and llama_index are imported by the resources on first use, not on every rerun
+from stages.resources import get_resources, lazy_import
 
 # initialize logging for better debugging
 logging.basicConfig(level=logging.DEBUG, format='%(asctime)s - %(levelname)s - %(message)s')
@@ -26,8 +29,60 @@ logger = logging.getLogger(__name__)
 # https://blog.streamlit.io/build-a-chatbot-with-custom-data-sources-powered-by-llamaindex/
 # https://docs.streamlit.io/develop/tutorials/llms/build-conversational-apps
 # https://medium.com/@maximejabarian/building-a-local-llms-app-with-streamlit-and-ollama-llama3-phi3-511d519c95fe
+# https://docs.streamlit.io/develop/concepts/architecture/caching#stcache_resource
+
+
+def record_first_response(resources):
+    """
+    Record the time to the first assistant message of the session
+    :param resources:
+    :return:
+    """
+    if st.session_state.get("first_response_recorded"):
+        return
+    messages = st.session_state.get("messages") or []
+    if any(message.get("role") == "assistant" for message in messages if isinstance(message, dict)):
+        resources.record_response(st.session_state["session_started"])
+        st.session_state["first_response_recorded"] = True
+
+
+async def chat(sidebar_settings, resources):
+    """
+    Chat loop, the sources are shown once retrieved and the answer is streamed token by token
+    :param sidebar_settings:
+    :param resources:
+    :return:
+    """
+    st.session_state.setdefault("messages", [])
+    for message in st.session_state["messages"]:
+        with st.chat_message(message["role"]):
+            st.markdown(message["content"])
+
+    prompt = st.chat_input("Ask me about a movie")
+    if not prompt:
+        return
+    st.session_state["messages"].append({"role": "user", "content": prompt})
+    with st.chat_message("user"):
+        st.markdown(prompt)
+
+    # the chat history of the session is kept in its memory, the engine is bound to the event loop of this run
+    memory = st.session_state.setdefault("chat_memory", resources.chat_memory(sidebar_settings["llm"]))
+    chat_engine = resources.chat_engine(sidebar_settings["llm"], memory)
+    with st.chat_message("assistant"):
+        sources = st.expander("Sources")
+        answer, metrics = await lazy_import("stages.streaming").render_chat_turn(
+            chat_engine, prompt, st.empty(), sources
+        )
+    st.session_state["messages"].append({"role": "assistant", "content": answer})
+    st.session_state["turn_metrics"].append(metrics)
+
 
 async def main():
+    # RESOURCES (built once per process and shared by all sessions and reruns)
+    resources = get_resources()
+    st.session_state.setdefault("session_started", time.perf_counter())
+    st.session_state.setdefault("turn_metrics", [])
+
     # PAGE CONFIG
     page_config()
 
@@ -36,18 +91,35 @@ async def main():
 
     # SIDEBAR
     sidebar_settings = add_sidebar()
-    llm = load_model(sidebar_settings["llm"])
+    # the first run of the process warms the index, the answer cache and the LLM in the background
+    resources.warm_up(sidebar_settings["llm"])
+    st.session_state["llm"] = resources.llm(sidebar_settings["llm"])
+    st.session_state["resources"] = resources
 
     # LOAD INTRO
     chatbot_intro()
 
+    # CHATBOT
+    await chat(sidebar_settings, resources)
+    record_first_response(resources)
+
+    # ANSWER CACHE (shared by all sessions, built by the warm-up or the first question)
+    answer_cache = resources.peek('answer_cache')
+    if answer_cache is not None:
+        st.session_state["answer_cache"] = answer_cache
+
     # DEBUG
     if DEBUG:
         with st.expander("DEBUG Details"):
             st.session_state
+            st.write("Resources", resources.stats())
+            # time-to-first-token, tokens/sec and the stage latencies of every turn
+            st.write("Turn metrics", st.session_state.get("turn_metrics", []))
+            if answer_cache is not None:
+                st.write("Answer cache", answer_cache.stats())
 
-    # CHATBOT
-    chatbot(sidebar_settings)
+    # the async Qdrant clients are bound to the loop of this run
+    await resources.close_loop_clients()
 
 
 if __name__ == '__main__':
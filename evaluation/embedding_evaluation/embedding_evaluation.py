@@ -0,0 +1,43 @@
+import json
+import logging
+
+from stages.embedding import ONNX_INT8_BACKEND, compare_embed_models, load_embed_model
+from utils.config import ROOT_DIR
+
+# initialize logging for better debugging
+logging.basicConfig(level=logging.DEBUG, format='%(asctime)s - %(levelname)s - %(message)s')
+logger = logging.getLogger(__name__)
+
+
+def load_questions_and_contexts():
+    """
+    Load the questions and contexts of the evaluation dataset
+    :return:
+    """
+    evaluation_file = f'{ROOT_DIR}/evaluation/data/llm_qna_to_context_gpt-3.5-turbo_100_random.json'
+    with open(evaluation_file, 'r', encoding="utf-8") as f:
+        data = json.load(f)
+    questions = [question for row in data for question in row['questions']]
+    contexts = [row['context'] for row in data]
+    return questions, contexts
+
+
+def run_evaluation(top_k: int = 5):
+    """
+    Compare the int8 ONNX embedding backend with the fp32 model on the evaluation questions
+    :param top_k:
+    :return:
+    """
+    questions, contexts = load_questions_and_contexts()
+
+    # without cache, so both models really embed every text
+    reference = load_embed_model(cache=False, bucketing=False)
+    candidate = load_embed_model(cache=False, bucketing=False, backend=ONNX_INT8_BACKEND)
+
+    result = compare_embed_models(reference, candidate, questions, contexts, top_k=top_k)
+    logger.info(f"EMBEDDING EVALUATION |:> {ONNX_INT8_BACKEND} vs fp32 | {result}")
+    return result
+
+
+if __name__ == '__main__':
+    run_evaluation()
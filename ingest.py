@@ -1,7 +1,8 @@
 import logging
 
 from stages.loading import Loading
-from stages.storing import Storing
+from stages.embedding import load_embed_model
+from stages.storing import Storing, store_data_multi
 from utils.config import ROOT_DIR
 
 # initialize logging for better debugging
@@ -13,8 +14,8 @@ def ingestion():
     # load documents
     # for live purpose take: wiki_movie_plots.json
     # for testing purpose take: wiki_movie_plots_1000.json
-    d = Loading(input_file=f"{ROOT_DIR}/data/wiki_movie_plots_512_50_movie_2024.json")
-    documents = d.get_documents()
+    # streaming mode: the documents are parsed lazily and stored in windows
+    d = Loading(input_file=f"{ROOT_DIR}/data/wiki_movie_plots_512_50_movie_2024.json", streaming=True)
     # from llama_index.core import Document
     # documents = [Document(
     #     text="""
@@ -41,14 +42,35 @@ def ingestion():
         # 1024: 100,
         # 2048: 200,
     }
+    if len(chunk_sizes_overlap_size) > 1:
+        # load the documents and the embedding model once for all configurations,
+        # identical chunks of different configurations are embedded only once
+        embed_model = load_embed_model()
+        storings = [
+            Storing(
+                chunk_size=chunk_size,
+                overlap_size=overlap_size,
+                collection_name=f"wiki_movie_plots_{chunk_size}_{overlap_size}_mxbai_final",
+                embed_model=embed_model
+            )
+            for chunk_size, overlap_size in chunk_sizes_overlap_size.items()
+        ]
+        store_data_multi(storings, d.iter_documents(), db)
+        return
+
     for chunk_size, overlap_size in chunk_sizes_overlap_size.items():
         logger.info(f"Storing documents with chunk_size: {chunk_size} and overlap_size: {overlap_size}")
         s = Storing(
             chunk_size=chunk_size,
             overlap_size=overlap_size,
-            collection_name=f"wiki_movie_plots_{chunk_size}_{overlap_size}_mxbai_final"
+            collection_name=f"wiki_movie_plots_{chunk_size}_{overlap_size}_mxbai_final",
+            # only store new and changed movies, delete removed ones
+            incremental=True,
+            # log the progress and ETA after every committed window
+            checkpoint=True
         )
-        s.store_data(documents, db)
+        # the generator is consumed per configuration, so create a new one each time
+        s.store_data(d.iter_documents(), db, total=d.count_documents())
 
 
 if __name__ == '__main__':
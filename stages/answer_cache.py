@@ -0,0 +1,399 @@
+import hashlib
+import logging
+import re
+import threading
+import time
+import uuid
+from collections import OrderedDict
+from pathlib import Path
+
+import numpy as np
+
+from utils.config import ROOT_DIR
+
+# Sources:
+# https://en.wikipedia.org/wiki/Cache_replacement_policies#Least_recently_used_(LRU)
+# https://docs.python.org/3/library/collections.html#collections.OrderedDict.move_to_end
+# https://github.com/zilliztech/GPTCache (semantic cache)
+# https://docs.streamlit.io/develop/api-reference/caching-and-state/st.cache_resource
+
+"""
+The AnswerCache class caches the chatbot answers in front of the chat engine
+- Exact match on the normalized question, then query-embedding similarity above a threshold
+- Scoped by LLM, collection, system prompt and chat mode
+- TTL and LRU eviction by entries and answer size
+- Invalidated when the collection is ingested again (collection version marker written by Storing)
+- Hit rate and generation latency saved
+"""
+
+logger = logging.getLogger(__name__)
+
+COLLECTION_VERSION_DIRECTORY = ROOT_DIR + "/data/collection_versions"
+
+_whitespace_pattern = re.compile(r"\s+")
+_punctuation_pattern = re.compile(r"^[\W_]+|[\W_]+$")
+
+
+def normalize_question(question):
+    """
+    Normalize a question for the exact match: case, whitespace and leading or trailing punctuation
+    :param question:
+    :return:
+    """
+    return _punctuation_pattern.sub("", _whitespace_pattern.sub(" ", question.lower())).strip()
+
+
+def bump_collection_version(collection_name, directory=COLLECTION_VERSION_DIRECTORY):
+    """
+    Record that a collection was (re-)ingested, cached answers of older versions are dropped
+    :param collection_name:
+    :param directory:
+    :return: new version
+    """
+    path = Path(directory) / f"{collection_name}.version"
+    path.parent.mkdir(parents=True, exist_ok=True)
+    version = uuid.uuid4().hex
+    tmp_path = path.with_suffix(".tmp")
+    tmp_path.write_text(version, encoding="utf-8")
+    tmp_path.replace(path)
+    return version
+
+
+def collection_version(collection_name, directory=COLLECTION_VERSION_DIRECTORY):
+    """
+    Get the current version of a collection, None if it was never recorded
+    :param collection_name:
+    :param directory:
+    :return:
+    """
+    path = Path(directory) / f"{collection_name}.version"
+    try:
+        return path.read_text(encoding="utf-8")
+    except FileNotFoundError:
+        return None
+
+
+class AnswerCache:
+    """
+    Process-wide answer cache, shared by all chatbot sessions (see ChatResources.answer_cache).
+    The cache is small, so the similarity search is a matrix product over the entries of a scope.
+    """
+
+    def __init__(self, embed_model=None, threshold: float = 0.95, ttl: float = 3600, max_entries: int = 1000,
+                 max_bytes: int = 16 * 1024 ** 2, version_directory=COLLECTION_VERSION_DIRECTORY):
+        self.embed_model = embed_model
+        self.threshold = threshold
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.version_directory = version_directory
+        self.__lock = threading.Lock()
+        # (scope, normalized question) -> entry, least recently used first
+        self.__entries = OrderedDict()
+        self.__bytes = 0
+        self.__versions = {}
+        self.lookups = 0
+        self.exact_hits = 0
+        self.semantic_hits = 0
+        self.evictions = 0
+        self.expirations = 0
+        self.invalidations = 0
+        self.saved_seconds = 0.0
+
+    @staticmethod
+    def scope(llm, collection_name, system_prompt, chat_mode):
+        """
+        Get the scope of an answer, answers are only shared within a scope
+        :param llm:
+        :param collection_name:
+        :param system_prompt:
+        :param chat_mode:
+        :return:
+        """
+        prompt_hash = hashlib.sha256((system_prompt or "").encode("utf-8")).hexdigest()[:16]
+        return str(llm), str(collection_name), prompt_hash, str(chat_mode)
+
+    def get(self, question, scope):
+        """
+        Look up the answer of a question
+        :param question:
+        :param scope:
+        :return: answer or None
+        """
+        normalized = normalize_question(question)
+        now = time.time()
+        with self.__lock:
+            self.lookups += 1
+            self.__check_version(scope)
+            entry = self.__entries.get((scope, normalized))
+            if entry is not None and self.__expired(entry, now):
+                self.__remove((scope, normalized))
+                self.expirations += 1
+                entry = None
+            if entry is not None:
+                self.exact_hits += 1
+                return self.__hit((scope, normalized), entry)
+
+        if self.embed_model is None:
+            return None
+        vector = self.__embed(question)
+        with self.__lock:
+            key = self.__most_similar(scope, vector, now)
+            if key is None:
+                return None
+            self.semantic_hits += 1
+            return self.__hit(key, self.__entries[key])
+
+    def put(self, question, scope, answer, seconds: float = 0.0):
+        """
+        Cache the answer of a question
+        :param question:
+        :param scope:
+        :param answer:
+        :param seconds: time the answer took, counted as saved on every hit
+        :return:
+        """
+        key = (scope, normalize_question(question))
+        vector = self.__embed(question) if self.embed_model is not None else None
+        with self.__lock:
+            self.__check_version(scope)
+            if key in self.__entries:
+                self.__remove(key)
+            entry = {
+                'answer': answer,
+                'vector': vector,
+                'created': time.time(),
+                'seconds': seconds,
+                'bytes': len(answer.encode("utf-8")) + (vector.nbytes if vector is not None else 0)
+            }
+            self.__entries[key] = entry
+            self.__bytes += entry['bytes']
+            while self.__entries and (len(self.__entries) > self.max_entries or self.__bytes > self.max_bytes):
+                self.__remove(next(iter(self.__entries)))
+                self.evictions += 1
+
+    def invalidate(self, collection_name=None):
+        """
+        Drop the answers of a collection, or all answers
+        :param collection_name:
+        :return:
+        """
+        with self.__lock:
+            for key in [key for key in self.__entries if collection_name is None or key[0][1] == collection_name]:
+                self.__remove(key)
+                self.invalidations += 1
+
+    def stats(self):
+        """
+        Get the hit rate and the generation latency saved
+        :return:
+        """
+        hits = self.exact_hits + self.semantic_hits
+        return {
+            'entries': len(self.__entries),
+            'mb': round(self.__bytes / 1024 ** 2, 3),
+            'lookups': self.lookups,
+            'exact_hits': self.exact_hits,
+            'semantic_hits': self.semantic_hits,
+            'hit_rate': round(hits / self.lookups, 4) if self.lookups else 0,
+            'saved_seconds': round(self.saved_seconds, 2),
+            'evictions': self.evictions,
+            'expirations': self.expirations,
+            'invalidations': self.invalidations
+        }
+
+    def __embed(self, question):
+        vector = np.asarray(self.embed_model.get_query_embedding(question), dtype=np.float32)
+        norm = np.linalg.norm(vector)
+        return vector / norm if norm else vector
+
+    def __expired(self, entry, now):
+        return self.ttl is not None and now - entry['created'] > self.ttl
+
+    def __hit(self, key, entry):
+        self.__entries.move_to_end(key)
+        self.saved_seconds += entry['seconds']
+        return entry['answer']
+
+    def __remove(self, key):
+        self.__bytes -= self.__entries.pop(key)['bytes']
+
+    def __most_similar(self, scope, vector, now):
+        """
+        Get the key of the most similar cached question of the scope above the threshold
+        :param scope:
+        :param vector:
+        :param now:
+        :return:
+        """
+        keys = []
+        for key, entry in list(self.__entries.items()):
+            if key[0] != scope or entry['vector'] is None:
+                continue
+            if self.__expired(entry, now):
+                self.__remove(key)
+                self.expirations += 1
+                continue
+            keys.append(key)
+        if not keys:
+            return None
+        similarities = np.stack([self.__entries[key]['vector'] for key in keys]) @ vector
+        best = int(np.argmax(similarities))
+        return keys[best] if similarities[best] >= self.threshold else None
+
+    def __check_version(self, scope):
+        """
+        Drop the answers of the scope's collection if it was ingested again since they were cached
+        :param scope:
+        :return:
+        """
+        collection_name = scope[1]
+        version = collection_version(collection_name, self.version_directory)
+        if collection_name in self.__versions and self.__versions[collection_name] != version:
+            for key in [key for key in self.__entries if key[0][1] == collection_name]:
+                self.__remove(key)
+                self.invalidations += 1
+            logger.info(f"Collection {collection_name} changed, dropped its cached answers")
+        self.__versions[collection_name] = version
+
+
+class CachedChatEngine:
+    """
+    Chat engine wrapper that answers repeated questions from an AnswerCache.
+    A cached answer is added to the chat memory, so the conversation continues as if it was generated.
+    Only the first message of a conversation is cached, follow-up questions depend on the chat history.
+    """
+
+    def __init__(self, chat_engine, cache, scope):
+        self.chat_engine = chat_engine
+        self.cache = cache
+        self.scope = scope
+
+    def chat(self, message):
+        """
+        Answer a message from the cache or the chat engine
+        :param message:
+        :return:
+        """
+        if self.__has_history():
+            return self.chat_engine.chat(message)
+        answer = self.cache.get(message, self.scope)
+        if answer is not None:
+            return self.__cached_response(message, answer)
+        start = time.perf_counter()
+        response = self.chat_engine.chat(message)
+        self.cache.put(message, self.scope, str(response), seconds=time.perf_counter() - start)
+        return response
+
+    async def achat(self, message):
+        """
+        Answer a message from the cache or the chat engine, async
+        :param message:
+        :return:
+        """
+        if self.__has_history():
+            return await self.chat_engine.achat(message)
+        answer = self.cache.get(message, self.scope)
+        if answer is not None:
+            return self.__cached_response(message, answer)
+        start = time.perf_counter()
+        response = await self.chat_engine.achat(message)
+        self.cache.put(message, self.scope, str(response), seconds=time.perf_counter() - start)
+        return response
+
+    async def astream_chat(self, message):
+        """
+        Stream the answer of a message, a cached answer is streamed as one chunk
+        and a generated one is cached once the stream is consumed
+        :param message:
+        :return: streaming response with source_nodes and async_response_gen
+        """
+        if self.__has_history():
+            return await self.chat_engine.astream_chat(message)
+        answer = self.cache.get(message, self.scope)
+        if answer is not None:
+            self.__remember(message, answer)
+            return CachedStreamingResponse(answer)
+        start = time.perf_counter()
+        response = await self.chat_engine.astream_chat(message)
+        return CachingStreamingResponse(response, self.cache, message, self.scope, start)
+
+    def reset(self):
+        self.chat_engine.reset()
+
+    def __memory(self):
+        return getattr(self.chat_engine, 'memory', None) or getattr(self.chat_engine, '_memory', None)
+
+    def __has_history(self):
+        """
+        Check for earlier messages, the engine condenses a follow-up question with them
+        so the same text can ask for a different answer
+        :return:
+        """
+        memory = self.__memory()
+        return memory is not None and bool(memory.get_all())
+
+    def __remember(self, message, answer):
+        # imported on the first hit, the chatbot page renders before llama_index is loaded
+        from llama_index.core.base.llms.types import ChatMessage, MessageRole
+
+        memory = self.__memory()
+        if memory is not None:
+            memory.put(ChatMessage(role=MessageRole.USER, content=message))
+            memory.put(ChatMessage(role=MessageRole.ASSISTANT, content=answer))
+
+    def __cached_response(self, message, answer):
+        from llama_index.core.chat_engine.types import AgentChatResponse
+
+        self.__remember(message, answer)
+        return AgentChatResponse(response=answer, metadata={'cached': True})
+
+    def __getattr__(self, name):
+        return getattr(self.chat_engine, name)
+
+
+class CachedStreamingResponse:
+    """
+    Streaming response of a cached answer
+    """
+
+    cached = True
+
+    def __init__(self, answer):
+        self.response = answer
+        self.source_nodes = []
+
+    async def async_response_gen(self):
+        yield self.response
+
+    def __str__(self):
+        return self.response
+
+
+class CachingStreamingResponse:
+    """
+    Streaming response that caches the answer once it is streamed completely
+    """
+
+    cached = False
+
+    def __init__(self, response, cache, message, scope, start):
+        self.response = response
+        self.cache = cache
+        self.message = message
+        self.scope = scope
+        self.start = start
+
+    @property
+    def source_nodes(self):
+        return self.response.source_nodes
+
+    async def async_response_gen(self):
+        answer = ""
+        async for delta in self.response.async_response_gen():
+            answer += delta or ""
+            yield delta
+        self.cache.put(self.message, self.scope, answer.strip(), seconds=time.perf_counter() - self.start)
+
+    def __str__(self):
+        return str(self.response)
@@ -0,0 +1,186 @@
+import hashlib
+import json
+import logging
+import os
+import time
+from pathlib import Path
+
+# Sources:
+# https://docs.python.org/3/library/os.html#os.replace
+# https://docs.python.org/3/library/os.html#os.fsync
+
+"""
+The IngestionCheckpoint class records the progress of an ingestion run per collection
+- Durable checkpoint after every committed window: documents, nodes and a hash of the stored document ids
+- Resume a run with the same configuration after the last committed window
+- Progress, batch throughput and ETA logging
+- Atomic finished marker
+"""
+
+logger = logging.getLogger(__name__)
+
+RUNNING = "running"
+FINISHED = "finished"
+
+
+def config_key(config):
+    """
+    Hash the configuration of a run, a checkpoint is only resumed with the same configuration
+    :param config:
+    :return:
+    """
+    return hashlib.sha256(json.dumps(config, sort_keys=True, default=str).encode("utf-8")).hexdigest()
+
+
+def chain_hash(previous, doc_id):
+    """
+    Extend the hash over the stored document ids by one id,
+    the hash only depends on the order of the documents and not on the window size
+    :param previous:
+    :param doc_id:
+    :return:
+    """
+    return hashlib.blake2b(bytes.fromhex(previous) + doc_id.encode("utf-8"), digest_size=16).hexdigest()
+
+
+class IngestionCheckpoint:
+
+    def __init__(self, persist_path, config, total: int = None):
+        self.persist_path = Path(persist_path)
+        self.config = config
+        self.total = total
+        self.key = config_key(config)
+        previous = self.__load()
+        # a checkpoint of another configuration (or none) means the collection has to be rebuilt,
+        # a finished run is not resumed, the rerun starts counting from zero (incremental runs keep their vectors)
+        self.resumable = previous is not None and previous['key'] == self.key and previous['status'] != FINISHED
+        self.state = previous if self.resumable else self.__new_state()
+        self.__start = time.perf_counter()
+        self.__start_documents = self.state['documents']
+        self.__batch_start = self.__start
+
+    def __load(self):
+        """
+        Load the checkpoint from disk
+        :return:
+        """
+        if not self.persist_path.exists():
+            return None
+        with self.persist_path.open('r', encoding="utf-8") as file:
+            return json.load(file)
+
+    def __new_state(self):
+        return {
+            'key': self.key,
+            'config': self.config,
+            'status': RUNNING,
+            'documents': 0,
+            'nodes': 0,
+            'windows': 0,
+            'ids_hash': "00" * 16,
+            'started': time.time(),
+            'updated': time.time()
+        }
+
+    @property
+    def documents(self):
+        return self.state['documents']
+
+    @property
+    def finished(self):
+        return self.state['status'] == FINISHED
+
+    def skip(self, documents):
+        """
+        Skip the documents of the committed windows and yield the rest.
+        The ids of the skipped documents have to match the checkpoint, otherwise the input changed.
+        :param documents:
+        :return:
+        """
+        iterator = iter(documents)
+        committed = self.state['documents']
+        if committed:
+            ids_hash = "00" * 16
+            skipped = 0
+            for document in iterator:
+                ids_hash = chain_hash(ids_hash, document.doc_id)
+                skipped += 1
+                if skipped == committed:
+                    break
+            if skipped != committed or ids_hash != self.state['ids_hash']:
+                raise ValueError(
+                    f"The input differs from the checkpoint {self.persist_path} "
+                    f"in the first {committed} documents, delete the checkpoint to start over"
+                )
+            logger.info(f"Resuming {self.config.get('collection_name')} after {committed} documents")
+        self.__batch_start = time.perf_counter()
+        yield from iterator
+
+    def commit(self, documents, nodes: int):
+        """
+        Record a window of documents whose nodes are committed to the vector store
+        :param documents:
+        :param nodes: number of written nodes
+        :return:
+        """
+        now = time.perf_counter()
+        batch_seconds = now - self.__batch_start
+        self.__batch_start = now
+        self.state['documents'] += len(documents)
+        self.state['nodes'] += nodes
+        self.state['windows'] += 1
+        for document in documents:
+            self.state['ids_hash'] = chain_hash(self.state['ids_hash'], document.doc_id)
+        self.state['status'] = RUNNING
+        self.state['updated'] = time.time()
+        self.__persist()
+        self.__log_progress(len(documents), nodes, batch_seconds, now)
+
+    def finish(self):
+        """
+        Mark the run as finished
+        :return:
+        """
+        self.state['status'] = FINISHED
+        self.state['updated'] = time.time()
+        self.__persist()
+        logger.info(
+            f"Finished {self.config.get('collection_name')}: {self.state['documents']} documents, "
+            f"{self.state['nodes']} nodes in {time.perf_counter() - self.__start:.1f}s"
+        )
+
+    def __persist(self):
+        """
+        Write the checkpoint to disk, atomically replacing the previous one
+        :return:
+        """
+        self.persist_path.parent.mkdir(parents=True, exist_ok=True)
+        tmp_path = self.persist_path.with_suffix(self.persist_path.suffix + ".tmp")
+        with tmp_path.open('w', encoding="utf-8") as file:
+            json.dump(self.state, file)
+            file.flush()
+            os.fsync(file.fileno())
+        os.replace(tmp_path, self.persist_path)
+
+    def __log_progress(self, documents, nodes, batch_seconds, now):
+        """
+        Log the progress, the throughput of the last window and the ETA
+        :param documents:
+        :param nodes:
+        :param batch_seconds:
+        :param now:
+        :return:
+        """
+        done = self.state['documents']
+        run_documents = done - self.__start_documents
+        rate = run_documents / (now - self.__start) if now > self.__start else 0
+        message = (
+            f"{self.config.get('collection_name')}: {done} documents committed, "
+            f"window {documents / batch_seconds if batch_seconds else 0:.1f} documents/s "
+            f"{nodes / batch_seconds if batch_seconds else 0:.1f} nodes/s"
+        )
+        if self.total:
+            remaining = max(self.total - done, 0)
+            eta = remaining / rate if rate else float("inf")
+            message += f", {100 * done / self.total:.1f}% done, ETA {eta / 60:.1f} min"
+        logger.info(message)
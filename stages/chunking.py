@@ -0,0 +1,303 @@
+import logging
+import uuid
+from typing import Any, List, Optional, Sequence
+
+from llama_index.core.bridge.pydantic import Field, PrivateAttr
+from llama_index.core.node_parser import NodeParser, SentenceSplitter
+from llama_index.core.postprocessor.types import BaseNodePostprocessor
+from llama_index.core.retrievers import BaseRetriever
+from llama_index.core.schema import (
+    MetadataMode,
+    NodeRelationship,
+    NodeWithScore,
+    QueryBundle,
+    RelatedNodeInfo,
+    TextNode
+)
+from llama_index.core.utils import get_tokenizer
+from llama_index.core.vector_stores.utils import metadata_dict_to_node
+from qdrant_client.http import models
+
+# Sources:
+# https://docs.llamaindex.ai/en/stable/module_guides/loading/node_parsers/
+# https://docs.llamaindex.ai/en/stable/module_guides/querying/node_postprocessors/#custom-node-postprocessor
+# https://docs.llamaindex.ai/en/stable/examples/retrievers/recursive_retriever_nodes/
+# https://qdrant.tech/documentation/concepts/points/#retrieve-points
+
+"""
+The MovieNodeParser class chunks the movie documents by their structure
+- One compact header node per movie (title, year, director, cast, genre, ...)
+- Plot-only chunks, the metadata is neither embedded nor sent to the LLM with every chunk
+- MovieHeaderPostprocessor reattaches the header to the retrieved plot chunks, registered by the chatbot resources
+- Report the embedded and prompted tokens saved compared to the SentenceSplitter
+"""
+
+logger = logging.getLogger(__name__)
+
+HEADER_NODE = "header"
+PLOT_NODE = "plot"
+
+# field of the formatted document text that is chunked, every other field goes into the header
+PLOT_KEY = "plot"
+# fields left out of the header
+EXCLUDED_HEADER_KEYS = ("plot_length",)
+
+
+def split_movie_text(text, plot_key=PLOT_KEY, excluded_keys=EXCLUDED_HEADER_KEYS):
+    """
+    Split the formatted text of a movie ("key: value" lines, see Loading) into the header and the plot.
+    The plot can contain line breaks, it ends at the last following "plot_length:" line.
+    :param text:
+    :param plot_key:
+    :param excluded_keys:
+    :return: header and plot, None as plot if the text has no plot field
+    """
+    marker = f"{plot_key}: "
+    if text.startswith(marker):
+        start = 0
+    else:
+        start = text.find(f"\n{marker}") + 1
+        if not start:
+            return text, None
+    header = text[:start]
+    plot = text[start + len(marker):]
+    # fields after the plot, e.g. plot_length
+    for key in excluded_keys:
+        end = plot.rfind(f"\n{key}: ")
+        if end >= 0:
+            plot = plot[:end]
+    header_lines = [
+        line for line in header.splitlines()
+        if line and not any(line.startswith(f"{key}: ") for key in excluded_keys)
+    ]
+    return "\n".join(header_lines), plot.strip()
+
+
+def header_node_id(doc_id):
+    """
+    Get the id of the header node of a document, deterministic so it can be looked up from the chunks
+    :param doc_id:
+    :return:
+    """
+    return str(uuid.uuid5(uuid.NAMESPACE_OID, f"{doc_id}:{HEADER_NODE}"))
+
+
+class MovieNodeParser(NodeParser):
+    """
+    Node parser for the movie schema: a header node per movie and plot-only chunks.
+    The document metadata stays on every node for payload filters (e.g. release_year),
+    but it is excluded from the embedded and the LLM text.
+    """
+
+    chunk_size: int = Field(default=512, description="Token chunk size of the plot chunks.")
+    chunk_overlap: int = Field(default=50, description="Token overlap of the plot chunks.")
+    header_node: bool = Field(default=True, description="Embed the header as a separate node.")
+
+    _splitter: SentenceSplitter = PrivateAttr()
+
+    def __init__(self, chunk_size: int = 512, chunk_overlap: int = 50, header_node: bool = True, **kwargs):
+        super().__init__(chunk_size=chunk_size, chunk_overlap=chunk_overlap, header_node=header_node, **kwargs)
+        self._splitter = SentenceSplitter(chunk_size=chunk_size, chunk_overlap=chunk_overlap)
+
+    @classmethod
+    def class_name(cls) -> str:
+        return "MovieNodeParser"
+
+    def _parse_nodes(self, nodes: Sequence, show_progress: bool = False, **kwargs: Any) -> List:
+        """
+        Split every document into its header node and plot chunks
+        :param nodes:
+        :param show_progress:
+        :param kwargs:
+        :return:
+        """
+        parsed = []
+        for document in nodes:
+            header, plot = split_movie_text(document.get_content(metadata_mode=MetadataMode.NONE))
+            if plot is None:
+                # not a movie document, chunk it like the SentenceSplitter
+                parsed.extend(self._splitter.get_nodes_from_documents([document]))
+                continue
+
+            metadata_keys = list(document.metadata)
+            header_id = header_node_id(document.doc_id)
+            if self.header_node:
+                parsed.append(self.__create_node(document, header_id, header, HEADER_NODE, metadata_keys))
+            for i, chunk in enumerate(self._splitter.split_text(plot)):
+                node = self.__create_node(
+                    document,
+                    str(uuid.uuid5(uuid.NAMESPACE_OID, f"{document.doc_id}:{PLOT_NODE}:{i}")),
+                    chunk,
+                    PLOT_NODE,
+                    metadata_keys
+                )
+                node.relationships[NodeRelationship.PARENT] = RelatedNodeInfo(node_id=header_id)
+                parsed.append(node)
+        return parsed
+
+    @staticmethod
+    def __create_node(document, node_id, text, node_type, metadata_keys):
+        """
+        Create a node that keeps the document metadata out of the embedded and LLM text
+        :param document:
+        :param node_id:
+        :param text:
+        :param node_type:
+        :param metadata_keys:
+        :return:
+        """
+        excluded = metadata_keys + ['node_type']
+        return TextNode(
+            id_=node_id,
+            text=text,
+            metadata={**document.metadata, 'node_type': node_type},
+            excluded_embed_metadata_keys=excluded,
+            excluded_llm_metadata_keys=excluded,
+            relationships={NodeRelationship.SOURCE: document.as_related_node_info()}
+        )
+
+
+def fetch_nodes(vector_store, node_ids):
+    """
+    Get stored nodes by id, with get_nodes or directly from the qdrant collection
+    :param vector_store:
+    :param node_ids:
+    :return:
+    """
+    try:
+        return vector_store.get_nodes(node_ids=node_ids)
+    except (NotImplementedError, AttributeError):
+        pass
+    client = getattr(vector_store, 'client', None)
+    if client is None or not hasattr(client, 'retrieve'):
+        raise ValueError(f"Cannot get nodes by id from {type(vector_store).__name__}")
+    points = client.retrieve(collection_name=vector_store.collection_name, ids=list(node_ids), with_payload=True)
+    return [metadata_dict_to_node(point.payload) for point in points]
+
+
+class MovieHeaderPostprocessor(BaseNodePostprocessor):
+    """
+    Reattach the movie header to retrieved plot chunks.
+    The header is added once per movie, to the best ranked chunk, and only in memory.
+    """
+
+    vector_store: Any = Field(description="Vector store with the header nodes.")
+
+    @classmethod
+    def class_name(cls) -> str:
+        return "MovieHeaderPostprocessor"
+
+    def _postprocess_nodes(
+            self,
+            nodes: List[NodeWithScore],
+            query_bundle: Optional[Any] = None) -> List[NodeWithScore]:
+        """
+        Prefix the first plot chunk of every movie with its header
+        :param nodes:
+        :param query_bundle:
+        :return:
+        """
+        retrieved = {result.node.node_id for result in nodes}
+        header_ids = {
+            result.node.parent_node.node_id
+            for result in nodes
+            if result.node.metadata.get('node_type') == PLOT_NODE and result.node.parent_node is not None
+        }
+        # movies whose header node was retrieved itself need no header
+        header_ids -= retrieved
+        headers = {node.node_id: node for node in fetch_nodes(self.vector_store, list(header_ids))} \
+            if header_ids else {}
+
+        attached = set()
+        processed = []
+        for result in nodes:
+            parent = result.node.parent_node
+            if parent is None or parent.node_id not in headers or parent.node_id in attached:
+                processed.append(result)
+                continue
+            attached.add(parent.node_id)
+            node = result.node.copy()
+            node.text = f"{headers[parent.node_id].text}\n{PLOT_KEY}: {node.text}"
+            processed.append(NodeWithScore(node=node, score=result.score))
+        return processed
+
+
+def has_header_nodes(vector_store, batch_size: int = 1000):
+    """
+    Check if a collection was chunked by the MovieNodeParser, every movie has a header node
+    :param vector_store: QdrantVectorStore or a local vector store
+    :param batch_size: rows of a local store that are checked
+    :return:
+    """
+    if hasattr(vector_store, 'iter_records'):
+        for _, _, payloads in vector_store.iter_records(batch_size=batch_size):
+            return any(payload.get('node_type') == HEADER_NODE for payload in payloads)
+        return False
+    client = getattr(vector_store, 'client', None)
+    if client is None or not hasattr(client, 'scroll'):
+        raise ValueError(f"Cannot read the node types of {type(vector_store).__name__}")
+    points, _ = client.scroll(
+        collection_name=vector_store.collection_name,
+        scroll_filter=models.Filter(
+            must=[models.FieldCondition(key='node_type', match=models.MatchValue(value=HEADER_NODE))]
+        ),
+        limit=1,
+        with_payload=False,
+        with_vectors=False
+    )
+    return bool(points)
+
+
+class PostprocessedRetriever(BaseRetriever):
+    """
+    Retriever that runs node postprocessors over the results of another retriever,
+    for callers that use the retriever without a query or chat engine
+    """
+
+    def __init__(self, retriever, node_postprocessors, **kwargs):
+        self.retriever = retriever
+        self.node_postprocessors = node_postprocessors
+        super().__init__(**kwargs)
+
+    def _retrieve(self, query_bundle: QueryBundle) -> List[NodeWithScore]:
+        nodes = self.retriever.retrieve(query_bundle)
+        for postprocessor in self.node_postprocessors:
+            nodes = postprocessor.postprocess_nodes(nodes, query_bundle=query_bundle)
+        return nodes
+
+    async def _aretrieve(self, query_bundle: QueryBundle) -> List[NodeWithScore]:
+        nodes = await self.retriever.aretrieve(query_bundle)
+        for postprocessor in self.node_postprocessors:
+            nodes = postprocessor.postprocess_nodes(nodes, query_bundle=query_bundle)
+        return nodes
+
+
+def token_savings(documents, chunk_size: int = 512, chunk_overlap: int = 50, tokenizer=None):
+    """
+    Compare the tokens of the SentenceSplitter and the MovieNodeParser chunks.
+    The LLM tokens of the structured chunks count the header once per movie, as the postprocessor attaches it.
+    :param documents:
+    :param chunk_size:
+    :param chunk_overlap:
+    :param tokenizer: default the llama_index tokenizer used for the chunk sizes
+    :return:
+    """
+    tokenizer = tokenizer or get_tokenizer()
+
+    def count(nodes, mode):
+        return sum(len(tokenizer(node.get_content(metadata_mode=mode))) for node in nodes)
+
+    baseline = SentenceSplitter(chunk_size=chunk_size, chunk_overlap=chunk_overlap).get_nodes_from_documents(documents)
+    structured = MovieNodeParser(chunk_size=chunk_size, chunk_overlap=chunk_overlap).get_nodes_from_documents(documents)
+    report = {'documents': len(documents)}
+    for name, nodes in (('sentence', baseline), ('structured', structured)):
+        report[name] = {
+            'nodes': len(nodes),
+            'embed_tokens': count(nodes, MetadataMode.EMBED),
+            'llm_tokens': count(nodes, MetadataMode.LLM)
+        }
+    for kind in ('embed_tokens', 'llm_tokens'):
+        saved = report['sentence'][kind] - report['structured'][kind]
+        report[f"saved_{kind}"] = saved
+        report[f"saved_{kind}_ratio"] = round(saved / report['sentence'][kind], 4) if report['sentence'][kind] else 0
+    return report
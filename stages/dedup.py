@@ -0,0 +1,293 @@
+import hashlib
+import json
+import logging
+import re
+import shutil
+import sqlite3
+import tempfile
+from collections import defaultdict
+from pathlib import Path
+
+import numpy as np
+from llama_index.core.vector_stores.utils import node_to_metadata_dict
+
+from stages.chunking import HEADER_NODE, fetch_nodes
+
+# Sources:
+# http://infolab.stanford.edu/~ullman/mmds/ch3n.pdf (MinHash and locality-sensitive hashing, 3.3-3.4)
+# https://ekzhu.com/datasketch/lsh.html
+# https://qdrant.tech/documentation/concepts/payload/#set-payload
+# https://docs.python.org/3/library/sqlite3.html
+
+"""
+The NearDuplicateFilter class collapses near-duplicate chunks before they are embedded
+- MinHash signatures over word shingles of the chunk text
+- LSH banding to find candidate duplicates, verified by the estimated Jaccard similarity
+- Only chunks with the same filterable metadata are compared, so a payload filter finds the kept chunk
+  whenever it would have found the dropped one
+- The signatures and LSH buckets are kept in a SQLite file, not in memory
+- A duplicate is dropped and its source is added to the duplicate_sources of the stored chunk
+- Report the embedding time and index space saved
+"""
+
+logger = logging.getLogger(__name__)
+
+MERSENNE_PRIME = (1 << 61) - 1
+MAX_HASH = (1 << 32) - 1
+
+# metadata key with the sources of the collapsed duplicates of a chunk
+DUPLICATE_SOURCES_KEY = "duplicate_sources"
+
+# payload fields the self-querying retrieval filters on, see stages.self_query
+IDENTITY_KEYS = ('title', 'release_year', 'genre', 'origin_ethnicity')
+
+_token_pattern = re.compile(r"\w+")
+
+
+def shingle_hashes(text, shingle_size: int = 5):
+    """
+    Hash the word shingles of a text to 32 bit values
+    :param text:
+    :param shingle_size:
+    :return:
+    """
+    tokens = _token_pattern.findall(text.lower())
+    if len(tokens) <= shingle_size:
+        shingles = {" ".join(tokens)}
+    else:
+        shingles = {" ".join(tokens[i:i + shingle_size]) for i in range(len(tokens) - shingle_size + 1)}
+    return np.fromiter(
+        (int.from_bytes(hashlib.blake2b(shingle.encode("utf-8"), digest_size=4).digest(), "little")
+         for shingle in shingles),
+        dtype=np.uint64,
+        count=len(shingles)
+    )
+
+
+def source_reference(node):
+    """
+    Get the reference to the source of a chunk that is kept with the stored duplicate
+    :param node:
+    :return:
+    """
+    reference = {'doc_id': node.ref_doc_id, 'node_id': node.node_id}
+    for key in ('title', 'release_year'):
+        if key in node.metadata:
+            reference[key] = node.metadata[key]
+    return reference
+
+
+def duplicate_identity(node):
+    """
+    Get the filterable metadata of a chunk, chunks are only collapsed into a chunk with the same identity
+    :param node:
+    :return:
+    """
+    identity = [(key, node.metadata[key]) for key in IDENTITY_KEYS if key in node.metadata]
+    return json.dumps(identity, default=str)
+
+
+def add_duplicate_sources(node, sources):
+    """
+    Add source references to the metadata of a node, they are neither embedded nor sent to the LLM
+    :param node:
+    :param sources:
+    :return:
+    """
+    node.metadata[DUPLICATE_SOURCES_KEY] = node.metadata.get(DUPLICATE_SOURCES_KEY, []) + list(sources)
+    for excluded in (node.excluded_embed_metadata_keys, node.excluded_llm_metadata_keys):
+        if DUPLICATE_SOURCES_KEY not in excluded:
+            excluded.append(DUPLICATE_SOURCES_KEY)
+
+
+class NearDuplicateFilter:
+    """
+    Near-duplicate detection over all chunks of an ingestion run.
+    The signatures of the kept chunks and their LSH buckets are stored in a SQLite file,
+    in a temporary directory removed by close unless a path is given.
+    """
+
+    def __init__(self, threshold: float = 0.8, num_perm: int = 128, bands: int = 16, shingle_size: int = 5,
+                 seed: int = 1, path=None):
+        if num_perm % bands:
+            raise ValueError(f"num_perm {num_perm} must be a multiple of bands {bands}")
+        self.threshold = threshold
+        self.num_perm = num_perm
+        self.bands = bands
+        self.rows = num_perm // bands
+        self.shingle_size = shingle_size
+        rng = np.random.default_rng(seed)
+        self.__a = rng.integers(1, MAX_HASH, size=num_perm, dtype=np.uint64)
+        self.__b = rng.integers(0, MAX_HASH, size=num_perm, dtype=np.uint64)
+        self.__temporary_directory = None
+        if path is None:
+            self.__temporary_directory = tempfile.mkdtemp(prefix="dedup-")
+            path = Path(self.__temporary_directory) / "signatures.sqlite"
+        else:
+            Path(path).parent.mkdir(parents=True, exist_ok=True)
+        self.path = Path(path)
+        self.__db = sqlite3.connect(self.path, check_same_thread=False)
+        # the signatures of an earlier run are not in the collection that is being stored
+        self.__db.execute("DROP TABLE IF EXISTS signatures")
+        self.__db.execute("DROP TABLE IF EXISTS buckets")
+        self.__db.execute("CREATE TABLE signatures (node_id TEXT PRIMARY KEY, signature BLOB NOT NULL)")
+        self.__db.execute("CREATE TABLE buckets (key BLOB NOT NULL, node_id TEXT NOT NULL)")
+        self.__db.execute("CREATE INDEX buckets_key ON buckets (key)")
+        self.__db.commit()
+        # sources of duplicates of chunks written in an earlier window, node id -> references
+        self.pending = defaultdict(list)
+        self.chunks = 0
+        self.duplicates = 0
+        self.written = 0
+        self.write_seconds = 0.0
+        self.point_bytes = 0
+
+    def signature(self, text):
+        """
+        Compute the MinHash signature of a text
+        :param text:
+        :return:
+        """
+        hashes = shingle_hashes(text, self.shingle_size)
+        permuted = np.bitwise_and((np.outer(hashes, self.__a) + self.__b) % MERSENNE_PRIME, MAX_HASH)
+        return permuted.min(axis=0).astype(np.uint32)
+
+    def __band_keys(self, signature, identity):
+        """
+        Get the LSH bucket keys of a signature, the buckets of every identity are separate
+        :param signature:
+        :param identity:
+        :return:
+        """
+        keys = []
+        for band in range(self.bands):
+            key = hashlib.blake2b(identity.encode("utf-8"), digest_size=16)
+            key.update(band.to_bytes(2, "little"))
+            key.update(signature[band * self.rows:(band + 1) * self.rows].tobytes())
+            keys.append(key.digest())
+        return keys
+
+    def __find_duplicate(self, signature, keys):
+        """
+        Get the id of a kept chunk with an estimated Jaccard similarity of at least the threshold
+        :param signature:
+        :param keys:
+        :return:
+        """
+        placeholders = ",".join("?" * len(keys))
+        candidates = self.__db.execute(
+            f"SELECT s.node_id, s.signature FROM signatures s WHERE s.node_id IN "
+            f"(SELECT DISTINCT node_id FROM buckets WHERE key IN ({placeholders}))",
+            keys
+        )
+        for node_id, candidate in candidates:
+            if np.mean(np.frombuffer(candidate, dtype=np.uint32) == signature) >= self.threshold:
+                return node_id
+        return None
+
+    def filter(self, nodes):
+        """
+        Drop the near-duplicates of a window of chunks, before they are embedded
+        :param nodes:
+        :return: kept nodes
+        """
+        kept = []
+        window = {}
+        for node in nodes:
+            self.chunks += 1
+            text = node.get_content()
+            # header nodes are looked up by id from their chunks, so they are always kept
+            if node.metadata.get('node_type') == HEADER_NODE or not text.strip():
+                kept.append(node)
+                continue
+            signature = self.signature(text)
+            keys = self.__band_keys(signature, duplicate_identity(node))
+            duplicate_of = self.__find_duplicate(signature, keys)
+            if duplicate_of is None:
+                self.__db.execute(
+                    "INSERT OR REPLACE INTO signatures (node_id, signature) VALUES (?, ?)",
+                    (node.node_id, signature.tobytes())
+                )
+                self.__db.executemany(
+                    "INSERT INTO buckets (key, node_id) VALUES (?, ?)", [(key, node.node_id) for key in keys]
+                )
+                window[node.node_id] = node
+                kept.append(node)
+                continue
+
+            self.duplicates += 1
+            reference = source_reference(node)
+            if duplicate_of in window:
+                add_duplicate_sources(window[duplicate_of], [reference])
+            else:
+                self.pending[duplicate_of].append(reference)
+        self.__db.commit()
+        return kept
+
+    def close(self):
+        """
+        Close the signature store, a temporary one is removed
+        :return:
+        """
+        self.__db.close()
+        if self.__temporary_directory is not None:
+            shutil.rmtree(self.__temporary_directory, ignore_errors=True)
+            self.__temporary_directory = None
+
+    def record_write(self, nodes, seconds, vector_size):
+        """
+        Record the time spent on embedding and writing kept chunks and their size in the index
+        :param nodes:
+        :param seconds:
+        :param vector_size:
+        :return:
+        """
+        self.written += len(nodes)
+        self.write_seconds += seconds
+        for node in nodes:
+            payload = node_to_metadata_dict(node, remove_text=False, flat_metadata=False)
+            self.point_bytes += vector_size * 4 + len(json.dumps(payload, default=str))
+
+    def report(self):
+        """
+        Report the collapsed duplicates and the estimated savings
+        :return:
+        """
+        seconds_per_chunk = self.write_seconds / self.written if self.written else 0
+        bytes_per_point = self.point_bytes / self.written if self.written else 0
+        return {
+            'chunks': self.chunks,
+            'duplicates': self.duplicates,
+            'duplicate_ratio': round(self.duplicates / self.chunks, 4) if self.chunks else 0,
+            'saved_embedding_seconds': round(self.duplicates * seconds_per_chunk, 2),
+            'saved_index_mb': round(self.duplicates * bytes_per_point / 1024 ** 2, 2)
+        }
+
+
+def merge_duplicate_sources(vector_store, pending):
+    """
+    Add the sources of duplicates found in later windows to the stored chunks
+    :param vector_store:
+    :param pending: node id -> source references
+    :return:
+    """
+    if not pending:
+        return
+    nodes = fetch_nodes(vector_store, list(pending))
+    for node in nodes:
+        add_duplicate_sources(node, pending[node.node_id])
+
+    client = getattr(vector_store, 'client', None)
+    if hasattr(vector_store, 'update_nodes'):
+        vector_store.update_nodes(nodes)
+    elif client is not None and hasattr(client, 'set_payload'):
+        for node in nodes:
+            client.set_payload(
+                collection_name=vector_store.collection_name,
+                payload=node_to_metadata_dict(node, remove_text=False, flat_metadata=False),
+                points=[node.node_id]
+            )
+    else:
+        logger.warning(f"Cannot update the duplicate sources of {len(nodes)} chunks in {type(vector_store).__name__}")
+        return
+    logger.info(f"Merged duplicate sources into {len(nodes)} stored chunks")
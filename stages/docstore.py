@@ -0,0 +1,87 @@
+import hashlib
+import json
+import os
+from pathlib import Path
+
+# Sources:
+# https://docs.llamaindex.ai/en/stable/module_guides/loading/ingestion_pipeline/#document-management
+# https://docs.python.org/3/library/os.html#os.replace
+
+"""
+The DocumentHashStore class keeps the content hash of every stored document per collection
+- Detect new, changed and removed documents between ingestion runs
+- Persist the hashes as a small JSON file next to the vector store data
+"""
+
+
+def content_hash(document):
+    """
+    Hash the text and metadata of a document
+    :param document:
+    :return:
+    """
+    content = document.text + "\x1e" + json.dumps(document.metadata, sort_keys=True, default=str)
+    return hashlib.sha256(content.encode("utf-8")).hexdigest()
+
+
+class DocumentHashStore:
+
+    def __init__(self, persist_path):
+        self.persist_path = Path(persist_path)
+        self.hashes = self.__load()
+
+    def __load(self):
+        """
+        Load the hashes from disk
+        :return:
+        """
+        if not self.persist_path.exists():
+            return {}
+        with self.persist_path.open('r', encoding="utf-8") as file:
+            return json.load(file)
+
+    def __len__(self):
+        return len(self.hashes)
+
+    def get(self, doc_id):
+        """
+        Get the stored hash of a document
+        :param doc_id:
+        :return:
+        """
+        return self.hashes.get(doc_id)
+
+    def set(self, doc_id, document_hash):
+        """
+        Set the hash of a stored document
+        :param doc_id:
+        :param document_hash:
+        :return:
+        """
+        self.hashes[doc_id] = document_hash
+
+    def remove(self, doc_id):
+        """
+        Remove a document
+        :param doc_id:
+        :return:
+        """
+        self.hashes.pop(doc_id, None)
+
+    def doc_ids(self):
+        """
+        Get the ids of all stored documents
+        :return:
+        """
+        return set(self.hashes)
+
+    def persist(self):
+        """
+        Write the hashes to disk, atomically replacing the previous file
+        :return:
+        """
+        self.persist_path.parent.mkdir(parents=True, exist_ok=True)
+        tmp_path = self.persist_path.with_suffix(self.persist_path.suffix + ".tmp")
+        with tmp_path.open('w', encoding="utf-8") as file:
+            json.dump(self.hashes, file)
+        os.replace(tmp_path, self.persist_path)
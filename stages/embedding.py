@@ -0,0 +1,734 @@
+import hashlib
+import json
+import logging
+import platform
+import sqlite3
+import threading
+import time
+from pathlib import Path
+from typing import List
+
+import numpy as np
+from llama_index.core.base.embeddings.base import BaseEmbedding
+from llama_index.core.bridge.pydantic import PrivateAttr
+from llama_index.embeddings.huggingface import HuggingFaceEmbedding
+
+from utils.config import CACHE_DIR, DEVICE
+
+# Sources:
+# https://docs.llamaindex.ai/en/stable/module_guides/models/embeddings/#custom-embedding-model
+# https://numpy.org/doc/stable/reference/generated/numpy.memmap.html
+# https://docs.python.org/3/library/sqlite3.html
+# https://en.wikipedia.org/wiki/Cache_replacement_policies#Least_recently_used_(LRU)
+# https://huggingface.co/docs/transformers/pad_truncation
+# https://huggingface.co/docs/optimum/onnxruntime/usage_guides/quantization
+# https://onnxruntime.ai/docs/performance/model-optimizations/quantization.html#dynamic-quantization
+# https://huggingface.co/mixedbread-ai/mxbai-embed-large-v1 (CLS pooling)
+
+"""
+The embedding module is responsible for creating the embedding model
+- Load the mxbai embedding model used for ingestion and retrieval
+- Cache the embeddings on disk, so a text is only embedded once per model and settings
+- Batch the texts by token length under a token budget to reduce padding on CPU
+- Export the model once to ONNX with int8 dynamic quantization for faster CPU inference
+"""
+
+logger = logging.getLogger(__name__)
+
+EMBED_MODEL_NAME = "mixedbread-ai/mxbai-embed-large-v1"
+
+# embedding backends of load_embed_model
+TORCH_BACKEND = "torch"
+ONNX_INT8_BACKEND = "onnx-int8"
+
+
+class EmbeddingCache:
+    """
+    Disk-backed embedding cache.
+    The vectors are stored in a memory-mapped float32 matrix, one row (slot) per text,
+    a small SQLite table maps the text hash to its slot and last use for the LRU eviction.
+    """
+
+    def __init__(self, cache_dir, namespace, max_entries: int = 1_000_000, max_bytes: int = None):
+        self.path = Path(cache_dir) / namespace
+        self.path.mkdir(parents=True, exist_ok=True)
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.__lock = threading.Lock()
+        self.__touched = {}
+        self.__vectors = None
+        self.__capacity = 0
+        self.__free = []
+        self.__next_slot = 0
+        self.__db = sqlite3.connect(self.path / "index.sqlite", check_same_thread=False)
+        self.__db.execute(
+            "CREATE TABLE IF NOT EXISTS entries (key BLOB PRIMARY KEY, slot INTEGER NOT NULL, used REAL NOT NULL)"
+        )
+        self.__db.execute("CREATE TABLE IF NOT EXISTS meta (name TEXT PRIMARY KEY, value TEXT NOT NULL)")
+        self.__db.commit()
+        row = self.__db.execute("SELECT value FROM meta WHERE name = 'dim'").fetchone()
+        self.dim = int(row[0]) if row else None
+        if self.dim:
+            self.__open_vectors()
+            # slots of evicted entries are reused before the file grows
+            used = {row[0] for row in self.__db.execute("SELECT slot FROM entries")}
+            self.__next_slot = max(used) + 1 if used else 0
+            self.__free = sorted(set(range(self.__next_slot)) - used, reverse=True)
+
+    @staticmethod
+    def key(text, kind="text"):
+        """
+        Hash a text, query and text embeddings of the same string are different entries
+        :param text:
+        :param kind:
+        :return:
+        """
+        return hashlib.blake2b(f"{kind}\x1f{text}".encode("utf-8"), digest_size=16).digest()
+
+    def __len__(self):
+        return self.__db.execute("SELECT COUNT(*) FROM entries").fetchone()[0]
+
+    def __limit(self):
+        """
+        Get the maximum number of entries from max_entries and max_bytes
+        :return:
+        """
+        if self.max_bytes and self.dim:
+            return max(1, min(self.max_entries, self.max_bytes // (self.dim * 4)))
+        return self.max_entries
+
+    def __open_vectors(self, capacity=None):
+        """
+        Map the vector file, grow it to the capacity if needed
+        :param capacity:
+        :return:
+        """
+        vector_file = self.path / "vectors.f32"
+        row_bytes = self.dim * 4
+        size = vector_file.stat().st_size if vector_file.exists() else 0
+        capacity = max(capacity or 0, size // row_bytes, 1024)
+        if self.__vectors is not None:
+            self.__vectors.flush()
+            self.__vectors = None
+        if size < capacity * row_bytes:
+            with vector_file.open('ab') as file:
+                file.truncate(capacity * row_bytes)
+        self.__vectors = np.memmap(vector_file, dtype=np.float32, mode='r+', shape=(capacity, self.dim))
+        self.__capacity = capacity
+
+    def get_many(self, keys):
+        """
+        Get the cached vectors, None for every missing key
+        :param keys:
+        :return:
+        """
+        with self.__lock:
+            if self.dim is None:
+                self.misses += len(keys)
+                return [None] * len(keys)
+            slots = {}
+            unique_keys = list(set(keys))
+            for i in range(0, len(unique_keys), 500):
+                batch = unique_keys[i:i + 500]
+                placeholders = ",".join("?" * len(batch))
+                slots.update(self.__db.execute(
+                    f"SELECT key, slot FROM entries WHERE key IN ({placeholders})", batch
+                ).fetchall())
+            now = time.time()
+            result = []
+            for key in keys:
+                slot = slots.get(key)
+                if slot is None:
+                    self.misses += 1
+                    result.append(None)
+                else:
+                    self.hits += 1
+                    self.__touched[key] = now
+                    result.append(self.__vectors[slot].tolist())
+            return result
+
+    def put_many(self, keys, vectors):
+        """
+        Store new vectors, evict the least recently used entries if the cache is full
+        :param keys:
+        :param vectors:
+        :return:
+        """
+        if not keys:
+            return
+        with self.__lock:
+            if self.dim is None:
+                self.dim = len(vectors[0])
+                self.__db.execute("INSERT OR REPLACE INTO meta VALUES ('dim', ?)", (str(self.dim),))
+                self.__open_vectors()
+
+            # entries that are already cached keep their slot
+            entries = dict(zip(keys, vectors))
+            unique_keys = list(entries)
+            for i in range(0, len(unique_keys), 500):
+                batch = unique_keys[i:i + 500]
+                placeholders = ",".join("?" * len(batch))
+                cached = self.__db.execute(f"SELECT key, slot FROM entries WHERE key IN ({placeholders})", batch)
+                for key, slot in cached.fetchall():
+                    self.__vectors[slot] = entries.pop(key)
+            entries = dict(list(entries.items())[-self.__limit():])
+
+            overflow = len(self) + len(entries) - self.__limit()
+            if overflow > 0:
+                self.__evict(overflow)
+            slots = self.__free_slots(len(entries))
+
+            now = time.time()
+            rows = []
+            for slot, (key, vector) in zip(slots, entries.items()):
+                self.__vectors[slot] = vector
+                rows.append((key, slot, now))
+            self.__vectors.flush()
+            self.__db.executemany("INSERT OR REPLACE INTO entries VALUES (?, ?, ?)", rows)
+            self.__db.commit()
+
+    def __free_slots(self, count):
+        """
+        Get unused slots, grow the vector file if needed
+        :param count:
+        :return:
+        """
+        slots = [self.__free.pop() for _ in range(min(count, len(self.__free)))]
+        while len(slots) < count:
+            slots.append(self.__next_slot)
+            self.__next_slot += 1
+        if self.__next_slot > self.__capacity:
+            self.__open_vectors(max(self.__next_slot, self.__capacity * 2))
+        return slots
+
+    def __evict(self, count):
+        """
+        Remove the least recently used entries
+        :param count:
+        :return:
+        """
+        self.__flush_touched()
+        evicted = self.__db.execute("SELECT key, slot FROM entries ORDER BY used LIMIT ?", (count,)).fetchall()
+        self.__db.executemany("DELETE FROM entries WHERE key = ?", [(key,) for key, _ in evicted])
+        self.__free.extend(slot for _, slot in evicted)
+        self.evictions += len(evicted)
+
+    def __flush_touched(self):
+        """
+        Write the last use of the hits to the index
+        :return:
+        """
+        if self.__touched:
+            self.__db.executemany(
+                "UPDATE entries SET used = ? WHERE key = ?",
+                [(used, key) for key, used in self.__touched.items()]
+            )
+            self.__touched = {}
+            self.__db.commit()
+
+    def flush(self):
+        """
+        Persist the LRU information and the vectors
+        :return:
+        """
+        with self.__lock:
+            self.__flush_touched()
+            if self.__vectors is not None:
+                self.__vectors.flush()
+
+    def stats(self):
+        """
+        Get the hit and miss counters
+        :return:
+        """
+        total = self.hits + self.misses
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_rate': round(self.hits / total, 4) if total else 0.0,
+            'evictions': self.evictions,
+            'entries': len(self)
+        }
+
+
+class EmbeddingWrapper(BaseEmbedding):
+    """
+    Base class of the embedding models that wrap another embedding model
+    """
+
+    _embed_model: BaseEmbedding = PrivateAttr()
+
+    def __init__(self, embed_model: BaseEmbedding, **kwargs):
+        kwargs.setdefault('embed_batch_size', embed_model.embed_batch_size)
+        super().__init__(model_name=embed_model.model_name, **kwargs)
+        self._embed_model = embed_model
+
+    @property
+    def embed_model(self):
+        return self._embed_model
+
+    @property
+    def base_model(self):
+        """
+        Get the innermost, not wrapped embedding model
+        :return:
+        """
+        model = self._embed_model
+        while isinstance(model, EmbeddingWrapper):
+            model = model.embed_model
+        return model
+
+
+class CachedEmbedding(EmbeddingWrapper):
+    """
+    Embedding model that answers from the EmbeddingCache and
+    only sends the missing texts to the wrapped model
+    """
+
+    _cache: EmbeddingCache = PrivateAttr()
+
+    def __init__(self, embed_model: BaseEmbedding, cache_dir=CACHE_DIR, **kwargs):
+        super().__init__(embed_model, **kwargs)
+        self._cache = EmbeddingCache(f"{cache_dir}/embeddings", self.cache_namespace(self.base_model))
+
+    @classmethod
+    def class_name(cls) -> str:
+        return "CachedEmbedding"
+
+    @staticmethod
+    def cache_namespace(embed_model):
+        """
+        Key of the model and the settings that change the vectors
+        :param embed_model:
+        :return:
+        """
+        settings = {
+            'model_name': embed_model.model_name,
+            'normalize': getattr(embed_model, 'normalize', None),
+            'max_length': getattr(embed_model, 'max_length', None),
+            'query_instruction': getattr(embed_model, 'query_instruction', None),
+            'text_instruction': getattr(embed_model, 'text_instruction', None)
+        }
+        if getattr(embed_model, 'backend', None):
+            # quantized vectors differ from the fp32 vectors
+            settings['backend'] = embed_model.backend
+        digest = hashlib.sha1(json.dumps(settings, sort_keys=True).encode("utf-8")).hexdigest()[:16]
+        return f"{embed_model.model_name.replace('/', '__')}_{digest}"
+
+    @property
+    def cache(self):
+        return self._cache
+
+    def __embed(self, texts, kind):
+        """
+        Get the embeddings from the cache and embed the missing texts
+        :param texts:
+        :param kind:
+        :return:
+        """
+        keys = [EmbeddingCache.key(text, kind) for text in texts]
+        embeddings = self._cache.get_many(keys)
+        missing = {}
+        for i, embedding in enumerate(embeddings):
+            if embedding is None:
+                missing.setdefault(keys[i], []).append(i)
+        if missing:
+            missing_keys = list(missing)
+            missing_texts = [texts[missing[key][0]] for key in missing_keys]
+            if kind == "query":
+                new_embeddings = [self._embed_model.get_query_embedding(text) for text in missing_texts]
+            else:
+                new_embeddings = self._embed_model.get_text_embedding_batch(missing_texts)
+            # round to float32 like the cached vectors, so hits and misses return the same values
+            new_embeddings = np.asarray(new_embeddings, dtype=np.float32).tolist()
+            self._cache.put_many(missing_keys, new_embeddings)
+            for key, embedding in zip(missing_keys, new_embeddings):
+                for i in missing[key]:
+                    embeddings[i] = embedding
+        return embeddings
+
+    def _get_query_embedding(self, query: str) -> List[float]:
+        return self.__embed([query], "query")[0]
+
+    async def _aget_query_embedding(self, query: str) -> List[float]:
+        return self._get_query_embedding(query)
+
+    def _get_text_embedding(self, text: str) -> List[float]:
+        return self.__embed([text], "text")[0]
+
+    def _get_text_embeddings(self, texts: List[str]) -> List[List[float]]:
+        return self.__embed(texts, "text")
+
+    async def _aget_text_embeddings(self, texts: List[str]) -> List[List[float]]:
+        return self._get_text_embeddings(texts)
+
+
+def export_quantized_model(model_name=EMBED_MODEL_NAME, cache_folder=CACHE_DIR):
+    """
+    Export the model to ONNX and quantize the weights to int8 (dynamic quantization).
+    The export runs once, the result is cached under CACHE_DIR/onnx.
+    :param model_name:
+    :param cache_folder:
+    :return: directory with model_quantized.onnx and the tokenizer
+    """
+    export_dir = Path(cache_folder) / "onnx" / model_name.replace('/', '__')
+    quantized_dir = export_dir / "int8"
+    if (quantized_dir / "model_quantized.onnx").exists():
+        return quantized_dir
+
+    try:
+        from optimum.onnxruntime import ORTModelForFeatureExtraction, ORTQuantizer
+        from optimum.onnxruntime.configuration import AutoQuantizationConfig
+        from transformers import AutoTokenizer
+    except ImportError as e:
+        raise ImportError(
+            f"The {ONNX_INT8_BACKEND} embedding backend needs optimum, install it with: "
+            "pip install optimum[onnxruntime]"
+        ) from e
+
+    logger.info(f"Exporting {model_name} to ONNX int8 in {quantized_dir}")
+    model = ORTModelForFeatureExtraction.from_pretrained(model_name, export=True, cache_dir=cache_folder)
+    model.save_pretrained(export_dir)
+    AutoTokenizer.from_pretrained(model_name, cache_dir=cache_folder).save_pretrained(quantized_dir)
+
+    if platform.machine().lower() in ('arm64', 'aarch64'):
+        config = AutoQuantizationConfig.arm64(is_static=False, per_channel=False)
+    else:
+        config = AutoQuantizationConfig.avx2(is_static=False, per_channel=False)
+    ORTQuantizer.from_pretrained(model).quantize(save_dir=quantized_dir, quantization_config=config)
+    return quantized_dir
+
+
+class OnnxEmbedding(BaseEmbedding):
+    """
+    Embedding model running the int8 quantized ONNX export with ONNX Runtime on CPU.
+    Uses CLS pooling and normalization like the SentenceTransformer config of mxbai.
+    """
+
+    max_length: int = 512
+    normalize: bool = True
+    query_instruction: str = ""
+    text_instruction: str = ""
+    backend: str = ONNX_INT8_BACKEND
+
+    _session = PrivateAttr()
+    _tokenizer = PrivateAttr()
+    _input_names = PrivateAttr()
+
+    def __init__(
+            self,
+            model_name: str = EMBED_MODEL_NAME,
+            cache_folder=CACHE_DIR,
+            embed_batch_size: int = 128,
+            threads: int = None,
+            **kwargs):
+        super().__init__(model_name=model_name, embed_batch_size=embed_batch_size, **kwargs)
+        try:
+            import onnxruntime
+            from transformers import AutoTokenizer
+        except ImportError as e:
+            raise ImportError(
+                f"The {ONNX_INT8_BACKEND} embedding backend needs onnxruntime, install it with: "
+                "pip install optimum[onnxruntime]"
+            ) from e
+
+        model_dir = export_quantized_model(model_name, cache_folder)
+        options = onnxruntime.SessionOptions()
+        options.graph_optimization_level = onnxruntime.GraphOptimizationLevel.ORT_ENABLE_ALL
+        if threads:
+            options.intra_op_num_threads = threads
+        self._session = onnxruntime.InferenceSession(
+            str(model_dir / "model_quantized.onnx"),
+            sess_options=options,
+            providers=["CPUExecutionProvider"]
+        )
+        self._input_names = {model_input.name for model_input in self._session.get_inputs()}
+        self._tokenizer = AutoTokenizer.from_pretrained(model_dir)
+
+    @classmethod
+    def class_name(cls) -> str:
+        return "OnnxEmbedding"
+
+    def __embed(self, texts):
+        """
+        Embed the texts in batches of embed_batch_size
+        :param texts:
+        :return:
+        """
+        embeddings = []
+        for i in range(0, len(texts), self.embed_batch_size):
+            inputs = self._tokenizer(
+                texts[i:i + self.embed_batch_size],
+                padding=True,
+                truncation=True,
+                max_length=self.max_length,
+                return_tensors="np"
+            )
+            inputs = {name: value for name, value in inputs.items() if name in self._input_names}
+            last_hidden_state = self._session.run(None, inputs)[0]
+            cls_embeddings = last_hidden_state[:, 0]
+            if self.normalize:
+                cls_embeddings = cls_embeddings / np.linalg.norm(cls_embeddings, axis=1, keepdims=True)
+            embeddings.extend(cls_embeddings.tolist())
+        return embeddings
+
+    def _get_query_embedding(self, query: str) -> List[float]:
+        return self.__embed([self.query_instruction + query])[0]
+
+    async def _aget_query_embedding(self, query: str) -> List[float]:
+        return self._get_query_embedding(query)
+
+    def _get_text_embedding(self, text: str) -> List[float]:
+        return self.__embed([self.text_instruction + text])[0]
+
+    def _get_text_embeddings(self, texts: List[str]) -> List[List[float]]:
+        return self.__embed([self.text_instruction + text for text in texts])
+
+
+def compare_embed_models(reference, candidate, questions, passages, top_k: int = 5):
+    """
+    Compare a candidate embedding model (e.g. int8) with the reference model (fp32)
+    - cosine agreement of the query and passage vectors of both models
+    - overlap of the top_k passages retrieved for every question
+    :param reference:
+    :param candidate:
+    :param questions:
+    :param passages:
+    :param top_k:
+    :return:
+    """
+    result = {}
+    passage_vectors = {}
+    query_vectors = {}
+    for name, model in (('reference', reference), ('candidate', candidate)):
+        start = time.perf_counter()
+        passage_vectors[name] = np.asarray(model.get_text_embedding_batch(passages), dtype=np.float32)
+        query_vectors[name] = np.asarray([model.get_query_embedding(question) for question in questions],
+                                         dtype=np.float32)
+        result[f'{name}_seconds'] = round(time.perf_counter() - start, 2)
+
+    def cosine(a, b):
+        a = a / np.linalg.norm(a, axis=1, keepdims=True)
+        b = b / np.linalg.norm(b, axis=1, keepdims=True)
+        return np.sum(a * b, axis=1)
+
+    passage_cosine = cosine(passage_vectors['reference'], passage_vectors['candidate'])
+    query_cosine = cosine(query_vectors['reference'], query_vectors['candidate'])
+    result['passage_cosine_mean'] = round(float(passage_cosine.mean()), 4)
+    result['passage_cosine_min'] = round(float(passage_cosine.min()), 4)
+    result['query_cosine_mean'] = round(float(query_cosine.mean()), 4)
+    result['query_cosine_min'] = round(float(query_cosine.min()), 4)
+
+    # retrieval overlap of the top_k passages
+    top_k = min(top_k, len(passages))
+    rankings = {
+        name: np.argsort(-(query_vectors[name] @ passage_vectors[name].T), axis=1)[:, :top_k]
+        for name in ('reference', 'candidate')
+    }
+    overlaps = [
+        len(set(reference_top) & set(candidate_top)) / top_k
+        for reference_top, candidate_top in zip(rankings['reference'], rankings['candidate'])
+    ]
+    result[f'overlap_at_{top_k}'] = round(float(np.mean(overlaps)), 4)
+    result['top_1_agreement'] = round(float(np.mean(rankings['reference'][:, 0] == rankings['candidate'][:, 0])), 4)
+    return result
+
+
+def get_tokenizer(embed_model):
+    """
+    Get the Hugging Face tokenizer of an embedding model, if it has one
+    :param embed_model:
+    :return:
+    """
+    model = getattr(embed_model, '_model', None)
+    return getattr(model, 'tokenizer', None) or getattr(embed_model, '_tokenizer', None)
+
+
+class BucketedEmbedding(EmbeddingWrapper):
+    """
+    Embedding model that sorts the texts by token length and forms batches
+    under a token budget (longest text * batch size) instead of a fixed count.
+    Short chunks are no longer padded to the length of the longest chunk of a mixed batch.
+    """
+
+    token_budget: int = 16384
+    max_batch_size: int = 128
+
+    _tokenizer = PrivateAttr()
+    _stats: dict = PrivateAttr()
+
+    def __init__(self, embed_model: BaseEmbedding, token_budget: int = 16384, window_size: int = 2048, **kwargs):
+        # the window is sorted as a whole, so get_text_embedding_batch must not cut it into small batches
+        # (2048 is the largest embed_batch_size llama_index accepts)
+        super().__init__(
+            embed_model,
+            embed_batch_size=window_size,
+            token_budget=token_budget,
+            max_batch_size=embed_model.embed_batch_size,
+            **kwargs
+        )
+        self._tokenizer = get_tokenizer(self.base_model)
+        self._stats = {
+            'texts': 0, 'batches': 0, 'tokens': 0, 'padded_tokens': 0, 'fixed_padded_tokens': 0, 'seconds': 0.0
+        }
+
+    @classmethod
+    def class_name(cls) -> str:
+        return "BucketedEmbedding"
+
+    def token_lengths(self, texts):
+        """
+        Count the tokens of the texts, truncated like the model does
+        :param texts:
+        :return:
+        """
+        if self._tokenizer is None:
+            # rough estimate if the model has no tokenizer
+            return [len(text.split()) * 4 // 3 + 2 for text in texts]
+        max_length = getattr(self.base_model, 'max_length', None) or 512
+        encoded = self._tokenizer(texts, add_special_tokens=True, truncation=True, max_length=max_length)
+        return [len(input_ids) for input_ids in encoded['input_ids']]
+
+    def create_batches(self, lengths):
+        """
+        Group the text indices, longest first, into batches under the token budget
+        :param lengths:
+        :return:
+        """
+        batches = []
+        batch = []
+        batch_max_length = 0
+        for index in sorted(range(len(lengths)), key=lengths.__getitem__, reverse=True):
+            max_length = max(batch_max_length, lengths[index])
+            if batch and (max_length * (len(batch) + 1) > self.token_budget or len(batch) >= self.max_batch_size):
+                batches.append(batch)
+                batch = []
+                max_length = lengths[index]
+            batch.append(index)
+            batch_max_length = max_length
+        if batch:
+            batches.append(batch)
+        return batches
+
+    def _get_text_embeddings(self, texts: List[str]) -> List[List[float]]:
+        start = time.perf_counter()
+        lengths = self.token_lengths(texts)
+        embeddings = [None] * len(texts)
+        for batch in self.create_batches(lengths):
+            batch_embeddings = self._embed_model._get_text_embeddings([texts[i] for i in batch])
+            for i, embedding in zip(batch, batch_embeddings):
+                embeddings[i] = embedding
+            self._stats['batches'] += 1
+            self._stats['padded_tokens'] += max(lengths[i] for i in batch) * len(batch)
+
+        # padding of fixed size batches in insertion order, for comparison
+        for i in range(0, len(lengths), self.max_batch_size):
+            fixed_batch = lengths[i:i + self.max_batch_size]
+            self._stats['fixed_padded_tokens'] += max(fixed_batch) * len(fixed_batch)
+        self._stats['texts'] += len(texts)
+        self._stats['tokens'] += sum(lengths)
+        self._stats['seconds'] += time.perf_counter() - start
+        return embeddings
+
+    async def _aget_text_embeddings(self, texts: List[str]) -> List[List[float]]:
+        return self._get_text_embeddings(texts)
+
+    def _get_text_embedding(self, text: str) -> List[float]:
+        return self._get_text_embeddings([text])[0]
+
+    def _get_query_embedding(self, query: str) -> List[float]:
+        return self._embed_model.get_query_embedding(query)
+
+    async def _aget_query_embedding(self, query: str) -> List[float]:
+        return await self._embed_model.aget_query_embedding(query)
+
+    def stats(self):
+        """
+        Get the padding efficiency (real tokens / padded tokens) and tokens/sec
+        :return:
+        """
+        stats = dict(self._stats)
+        tokens = stats['tokens']
+        stats['padding_efficiency'] = round(tokens / stats['padded_tokens'], 4) if stats['padded_tokens'] else None
+        stats['fixed_padding_efficiency'] = round(tokens / stats['fixed_padded_tokens'], 4) \
+            if stats['fixed_padded_tokens'] else None
+        stats['tokens_per_second'] = round(tokens / stats['seconds'], 1) if stats['seconds'] else None
+        stats['seconds'] = round(stats['seconds'], 2)
+        return stats
+
+
+def embedding_namespace(embed_model):
+    """
+    Get the key of the model and the settings that change its vectors (backend, normalization, ...),
+    the wrappers report the model_name of the wrapped model for every backend
+    :param embed_model:
+    :return:
+    """
+    if isinstance(embed_model, EmbeddingWrapper):
+        embed_model = embed_model.base_model
+    return CachedEmbedding.cache_namespace(embed_model)
+
+
+def embedding_stats(embed_model):
+    """
+    Collect the stats of all wrappers of an embedding model
+    :param embed_model:
+    :return:
+    """
+    stats = {}
+    model = embed_model
+    while isinstance(model, EmbeddingWrapper):
+        if isinstance(model, CachedEmbedding):
+            model.cache.flush()
+            stats['cache'] = model.cache.stats()
+        elif isinstance(model, BucketedEmbedding):
+            stats['batching'] = model.stats()
+        model = model.embed_model
+    return stats
+
+
+def load_embed_model(
+        cache_folder=CACHE_DIR,
+        device=DEVICE,
+        embed_batch_size: int = 128,
+        cache: bool = True,
+        bucketing: bool = True,
+        token_budget: int = 16384,
+        backend: str = TORCH_BACKEND):
+    """
+    Load the mxbai embedding model, by default behind the on-disk embedding cache
+    and with length-bucketed batches.
+    Use it for ingestion and query time, so both share the cached vectors.
+    The backend is either the fp32 PyTorch model (torch) or the quantized ONNX export (onnx-int8).
+    :param cache_folder:
+    :param device:
+    :param embed_batch_size:
+    :param cache:
+    :param bucketing:
+    :param token_budget:
+    :param backend:
+    :return:
+    """
+    if backend == TORCH_BACKEND:
+        embed_model = HuggingFaceEmbedding(
+            model_name=EMBED_MODEL_NAME,
+            cache_folder=cache_folder,
+            device=device,
+            embed_batch_size=embed_batch_size
+        )
+    elif backend == ONNX_INT8_BACKEND:
+        embed_model = OnnxEmbedding(
+            model_name=EMBED_MODEL_NAME,
+            cache_folder=cache_folder,
+            embed_batch_size=embed_batch_size
+        )
+    else:
+        raise ValueError(f"Embedding backend {backend} not supported")
+    if bucketing:
+        embed_model = BucketedEmbedding(embed_model, token_budget=token_budget)
+    if cache:
+        embed_model = CachedEmbedding(embed_model, cache_dir=cache_folder)
+    return embed_model
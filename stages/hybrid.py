@@ -0,0 +1,269 @@
+import hashlib
+import logging
+import re
+from collections import Counter
+from typing import List, Optional
+
+from llama_index.core.retrievers import BaseRetriever
+from llama_index.core.schema import MetadataMode, NodeWithScore, QueryBundle
+from llama_index.core.vector_stores.utils import metadata_dict_to_node
+from qdrant_client.http import models
+
+from stages.qdrant import SPARSE_VECTOR_NAME
+from stages.self_query import compare_retrievers, parse_query, to_qdrant_filter
+
+# Sources:
+# https://qdrant.tech/documentation/concepts/hybrid-queries/#hybrid-search
+# https://qdrant.tech/documentation/concepts/vectors/#sparse-vectors
+# https://qdrant.tech/articles/bm42/#bm25 (IDF modifier, term frequencies on the client)
+# https://en.wikipedia.org/wiki/Okapi_BM25
+# https://plg.uwaterloo.ca/~gvcormac/cormacksigir09-rrf.pdf (reciprocal rank fusion)
+
+"""
+The hybrid module adds lexical BM25 retrieval next to the dense vectors of a Qdrant collection
+- BM25 sparse vectors computed at ingestion, the IDF is applied by Qdrant (sparse vector modifier)
+- Dense, sparse and hybrid search, the hybrid rankings are fused with reciprocal rank fusion
+- Optional self-query filters of the question
+- Per-mode latency, precision and recall on the evaluation questions
+"""
+
+logger = logging.getLogger(__name__)
+
+DENSE = "dense"
+SPARSE = "sparse"
+HYBRID = "hybrid"
+MODES = (DENSE, SPARSE, HYBRID)
+
+_token_pattern = re.compile(r"\w+")
+STOPWORDS = frozenset((
+    "a", "an", "and", "are", "as", "at", "be", "by", "did", "do", "does", "for", "from", "has", "have", "he", "her",
+    "his", "how", "in", "is", "it", "its", "of", "on", "or", "she", "that", "the", "their", "they", "this", "to",
+    "was", "were", "what", "when", "where", "which", "who", "whom", "why", "with"
+))
+
+
+class BM25Encoder:
+    """
+    Client side part of BM25: the saturated term frequency per document, the IDF is added by Qdrant.
+    Terms are hashed to 32 bit ids, so no vocabulary has to be built or stored.
+    The average document length is fixed, ingestion streams the documents and cannot know it beforehand.
+    """
+
+    def __init__(self, k1: float = 1.2, b: float = 0.75, avg_len: float = 256, stopwords=STOPWORDS):
+        self.k1 = k1
+        self.b = b
+        self.avg_len = avg_len
+        self.stopwords = stopwords
+
+    def tokenize(self, text):
+        return [token for token in _token_pattern.findall(text.lower()) if token not in self.stopwords]
+
+    @staticmethod
+    def term_id(token):
+        return int.from_bytes(hashlib.blake2b(token.encode("utf-8"), digest_size=4).digest(), "little")
+
+    def encode_document(self, text):
+        """
+        Encode a document (chunk) text to a sparse vector of BM25 term weights
+        :param text:
+        :return:
+        """
+        tokens = self.tokenize(text)
+        norm = self.k1 * (1 - self.b + self.b * len(tokens) / self.avg_len)
+        weights = {}
+        for token, frequency in Counter(tokens).items():
+            # hash collisions add up, like the frequencies of the same term
+            term = self.term_id(token)
+            weights[term] = weights.get(term, 0) + frequency
+        return models.SparseVector(
+            indices=list(weights),
+            values=[frequency * (self.k1 + 1) / (frequency + norm) for frequency in weights.values()]
+        )
+
+    def encode_query(self, text):
+        """
+        Encode a query to a sparse vector, every query term counts once
+        :param text:
+        :return:
+        """
+        terms = sorted({self.term_id(token) for token in self.tokenize(text)})
+        return models.SparseVector(indices=terms, values=[1.0] * len(terms))
+
+    def encode_node(self, node):
+        return self.encode_document(node.get_content(metadata_mode=MetadataMode.EMBED))
+
+
+def add_sparse_vectors(client, collection_name, nodes, encoder, vector_name=SPARSE_VECTOR_NAME):
+    """
+    Add the sparse vectors to stored points, for nodes written by QdrantVectorStore
+    :param client:
+    :param collection_name:
+    :param nodes:
+    :param encoder:
+    :param vector_name:
+    :return:
+    """
+    if not nodes:
+        return
+    client.update_vectors(
+        collection_name=collection_name,
+        points=[
+            models.PointVectors(id=node.node_id, vector={vector_name: encoder.encode_node(node)})
+            for node in nodes
+        ]
+    )
+
+
+def rrf_fuse(rankings, k: int = 60, top_k: Optional[int] = None):
+    """
+    Fuse rankings with reciprocal rank fusion
+    :param rankings: lists of (id, item), best first
+    :param k: rank constant, damps the influence of the top ranks
+    :param top_k:
+    :return: list of (id, item, score), best first
+    """
+    scores = {}
+    items = {}
+    for ranking in rankings:
+        for rank, (item_id, item) in enumerate(ranking):
+            scores[item_id] = scores.get(item_id, 0.0) + 1.0 / (k + rank + 1)
+            items.setdefault(item_id, item)
+    fused = sorted(scores, key=scores.get, reverse=True)[:top_k]
+    return [(item_id, items[item_id], scores[item_id]) for item_id in fused]
+
+
+def hybrid_search(client, collection_name, dense_vector, sparse_vector, top_k: int = 2, prefetch_k: int = 20,
+                  mode: str = HYBRID, query_filter=None, vector_name: str = SPARSE_VECTOR_NAME):
+    """
+    Search a collection with the dense vector, the sparse vector or both fused
+    :param client:
+    :param collection_name:
+    :param dense_vector:
+    :param sparse_vector:
+    :param top_k:
+    :param prefetch_k: candidates of each search that are fused
+    :param mode: dense, sparse or hybrid
+    :param query_filter:
+    :param vector_name: name of the sparse vector
+    :return: scored points, best first
+    """
+    if mode not in MODES:
+        raise ValueError(f"Search mode {mode} not supported")
+    if hasattr(client, 'query_points'):
+        if mode == DENSE:
+            return client.query_points(
+                collection_name, query=dense_vector, limit=top_k, query_filter=query_filter, with_payload=True
+            ).points
+        if mode == SPARSE:
+            return client.query_points(
+                collection_name, query=sparse_vector, using=vector_name, limit=top_k, query_filter=query_filter,
+                with_payload=True
+            ).points
+        # both searches and the fusion run in one request
+        return client.query_points(
+            collection_name,
+            prefetch=[
+                models.Prefetch(query=dense_vector, limit=prefetch_k, filter=query_filter),
+                models.Prefetch(query=sparse_vector, using=vector_name, limit=prefetch_k, filter=query_filter)
+            ],
+            query=models.FusionQuery(fusion=models.Fusion.RRF),
+            limit=top_k,
+            with_payload=True
+        ).points
+
+    # qdrant-client < 1.10, the rankings are fused on the client
+    def search(vector, limit):
+        return client.search(collection_name, query_vector=vector, limit=limit, query_filter=query_filter,
+                             with_payload=True)
+
+    named_sparse_vector = models.NamedSparseVector(name=vector_name, vector=sparse_vector)
+    if mode == DENSE:
+        return search(dense_vector, top_k)
+    if mode == SPARSE:
+        return search(named_sparse_vector, top_k)
+    rankings = [
+        [(point.id, point) for point in search(vector, prefetch_k)]
+        for vector in (dense_vector, named_sparse_vector)
+    ]
+    fused = []
+    for _, point, score in rrf_fuse(rankings, top_k=top_k):
+        point.score = score
+        fused.append(point)
+    return fused
+
+
+class HybridRetriever(BaseRetriever):
+    """
+    Retriever over the dense and BM25 vectors of a Qdrant collection.
+    With self_query the constraints of the question filter both searches, with an unfiltered fallback.
+    """
+
+    def __init__(self, client, collection_name, embed_model, similarity_top_k: int = 2, mode: str = HYBRID,
+                 prefetch_k: int = 20, encoder: Optional[BM25Encoder] = None, self_query: bool = False, titles=None,
+                 **kwargs):
+        if mode not in MODES:
+            raise ValueError(f"Search mode {mode} not supported")
+        self.client = client
+        self.collection_name = collection_name
+        self.embed_model = embed_model
+        self.similarity_top_k = similarity_top_k
+        self.mode = mode
+        self.prefetch_k = max(prefetch_k, similarity_top_k)
+        self.encoder = encoder or BM25Encoder()
+        self.self_query = self_query
+        self.titles = titles
+        super().__init__(**kwargs)
+
+    def _retrieve(self, query_bundle: QueryBundle) -> List[NodeWithScore]:
+        """
+        Search the collection in the mode of the retriever
+        :param query_bundle:
+        :return:
+        """
+        dense_vector = None
+        if self.mode != SPARSE:
+            dense_vector = query_bundle.embedding or self.embed_model.get_query_embedding(query_bundle.query_str)
+        sparse_vector = self.encoder.encode_query(query_bundle.query_str) if self.mode != DENSE else None
+        query_filter = to_qdrant_filter(parse_query(query_bundle.query_str, self.titles)) if self.self_query else None
+
+        points = self.__search(dense_vector, sparse_vector, query_filter)
+        if not points and query_filter is not None:
+            points = self.__search(dense_vector, sparse_vector, None)
+        return [NodeWithScore(node=metadata_dict_to_node(point.payload), score=point.score) for point in points]
+
+    def __search(self, dense_vector, sparse_vector, query_filter):
+        return hybrid_search(
+            self.client,
+            self.collection_name,
+            dense_vector,
+            sparse_vector,
+            top_k=self.similarity_top_k,
+            prefetch_k=self.prefetch_k,
+            mode=self.mode,
+            query_filter=query_filter
+        )
+
+
+def hybrid_report(client, collection_name, embed_model, queries, top_k: int = 2, prefetch_k: int = 20, titles=None):
+    """
+    Compare the latency, precision and recall (hit rate) of the search modes
+    :param client:
+    :param collection_name:
+    :param embed_model:
+    :param queries: list of question and expected title, see self_query.evaluation_queries
+    :param top_k:
+    :param prefetch_k:
+    :param titles: known titles, adds the self-queried hybrid mode
+    :return:
+    """
+    retrievers = {
+        mode: HybridRetriever(client, collection_name, embed_model, similarity_top_k=top_k, mode=mode,
+                              prefetch_k=prefetch_k)
+        for mode in MODES
+    }
+    if titles is not None:
+        retrievers['hybrid_self_query'] = HybridRetriever(
+            client, collection_name, embed_model, similarity_top_k=top_k, prefetch_k=prefetch_k, self_query=True,
+            titles=titles
+        )
+    return compare_retrievers(retrievers, queries, top_k=top_k)
@@ -1,6 +1,17 @@
+import hashlib
 import json
+import logging
+import os
+import time
+import uuid
+from concurrent.futures import ProcessPoolExecutor
+from functools import partial
+from itertools import chain
 from pathlib import Path
+from array import array
+from typing import Iterator
 
+import numpy as np
 from llama_index.core import Document
 
 from utils.config import OUTPUT_FILE
@@ -13,23 +24,483 @@ from utils.config import OUTPUT_FILE
 # https://docs.python.org/3/tutorial/errors.html#raising-exceptions
 # https://stackoverflow.com/questions/136097/what-is-the-difference-between-staticmethod-and-classmethod-in-python
 # https://www.geeksforgeeks.org/private-methods-in-python/
+# https://docs.python.org/3/library/json.html#json.JSONDecoder.raw_decode
+# https://docs.python.org/3/library/concurrent.futures.html#processpoolexecutor
+# https://numpy.org/doc/stable/reference/generated/numpy.memmap.html
+# https://docs.python.org/3/library/hashlib.html#blake2
 
 """
 The Documents class is responsible for loading the data from the JSON file
 - Load the data from the JSON file
 - Create document objects
+- Stream the records and documents one by one for large files
+- Build the documents in a process pool for large inputs
+- Convert the JSON file once into a memory-mapped columnar corpus for fast reloads
+- Split the records reproducibly into training/test data or k folds by hash
 """
 
+logger = logging.getLogger(__name__)
+
+# number of characters read from the JSON file per step in streaming mode
+JSON_STREAM_BUFFER_SIZE = 64 * 1024
+
+# documents are built in a process pool from this number of records on
+PARALLEL_THRESHOLD = 20000
+# number of records sent to a worker process at once
+DOCUMENT_CHUNK_SIZE = 2000
+
+# metadata only attached for payload filters (self-querying retrieval),
+# the value is already part of the document text, so it is neither embedded nor sent to the LLM again
+FILTER_ONLY_METADATA_KEYS = ("genre",)
+
+# text formatters per schema (tuple of keys), compiled once per process
+_text_formatters = {}
+
+
+def format_document_text(row):
+    """
+    Create the text for the document with a precompiled formatter
+    for the schema of the row, e.g. "title: {}\nplot: {}\n"
+    :param row:
+    :return:
+    """
+    keys = tuple(row)
+    formatter = _text_formatters.get(keys)
+    if formatter is None:
+        template = "".join(
+            str(key).replace("{", "{{").replace("}", "}}") + ": {}\n" for key in keys
+        )
+        formatter = _text_formatters[keys] = template.format
+    return formatter(*row.values())
+
+
+def create_document(row, formatted, text_template, include_from_metadata, doc_id=None):
+    """
+    Create a document object
+    :param row:
+    :param formatted:
+    :param text_template:
+    :param include_from_metadata:
+    :param doc_id: id from DocumentIds, default the id of the record identity
+    :return:
+    """
+    text = format_document_text(row) if formatted else json.dumps(row)
+    return Document(
+        id_=doc_id or document_id(row),
+        text=text,
+        metadata={key: value for key, value in row.items() if key in include_from_metadata},
+        excluded_embed_metadata_keys=[key for key in FILTER_ONLY_METADATA_KEYS if key in row],
+        excluded_llm_metadata_keys=["file_name", *(key for key in FILTER_ONLY_METADATA_KEYS if key in row)],
+        text_template=text_template
+    )
+
+
+def build_documents(rows, doc_ids, formatted, text_template, include_from_metadata):
+    """
+    Create the document objects for a chunk of rows,
+    module level so it can be sent to a worker process
+    :param rows:
+    :param doc_ids: ids of the rows from DocumentIds, None for the ids of the record identities
+    :param formatted:
+    :param text_template:
+    :param include_from_metadata:
+    :return:
+    """
+    include_from_metadata = frozenset(include_from_metadata)
+    if doc_ids is None:
+        return [create_document(row, formatted, text_template, include_from_metadata) for row in rows]
+    return [
+        create_document(row, formatted, text_template, include_from_metadata, doc_id)
+        for row, doc_id in zip(rows, doc_ids)
+    ]
+
+
+def iter_json_records(input_file, buffer_size=JSON_STREAM_BUFFER_SIZE) -> Iterator[dict]:
+    """
+    Parse the top-level JSON array of the input file record by record.
+    Only the current record and the read buffer are held in memory.
+    :param input_file:
+    :param buffer_size:
+    :return:
+    """
+    file_path = Path(input_file)
+    if not file_path.exists():
+        raise FileNotFoundError(f"No file found at {file_path}")
+
+    decoder = json.JSONDecoder()
+    with file_path.open('r', encoding="utf-8") as file:
+        buffer = ""
+        position = 0
+        started = False
+        records = 0
+        while True:
+            # skip whitespace and read more data if the buffer is consumed
+            while True:
+                while position < len(buffer) and buffer[position] in " \t\r\n":
+                    position += 1
+                if position < len(buffer):
+                    break
+                chunk = file.read(buffer_size)
+                if not chunk:
+                    if not started:
+                        raise ValueError(f"No data found in {file_path}")
+                    raise ValueError(f"Unexpected end of JSON array in {file_path}")
+                buffer = buffer[position:] + chunk
+                position = 0
+
+            char = buffer[position]
+            if not started:
+                if char != "[":
+                    raise ValueError(f"Data in {file_path} must be a list")
+                started = True
+                position += 1
+                continue
+            if char == "]":
+                if not records:
+                    raise ValueError(f"No data found in {file_path}")
+                return
+            if char == ",":
+                position += 1
+                continue
+            if char != "{":
+                raise ValueError(f"Records in {file_path} must be objects")
+
+            # decode the next record, extend the buffer until it is complete
+            while True:
+                try:
+                    record, position = decoder.raw_decode(buffer, position)
+                    break
+                except json.JSONDecodeError:
+                    # grow geometrically so a large record is not re-parsed too often
+                    chunk = file.read(max(buffer_size, len(buffer) - position))
+                    if not chunk:
+                        raise
+                    buffer = buffer[position:] + chunk
+                    position = 0
+            records += 1
+            yield record
+
+
+# keys that identify a movie for the document id and the hash based split
+IDENTITY_KEYS = ('title', 'release_year', 'wiki_page')
+
+
+def record_identity(row, identity_keys=IDENTITY_KEYS):
+    """
+    Get the identity string of a record
+    :param row:
+    :param identity_keys:
+    :return:
+    """
+    return "\x1f".join(str(row.get(key, "")) for key in identity_keys)
+
+
+def document_id(row, occurrence: int = 0):
+    """
+    Get a stable document id for a record, so the same movie keeps its id
+    between runs and its vectors can be found again (e.g. for incremental ingestion)
+    :param row:
+    :param occurrence: number of earlier records with the same identity, see DocumentIds
+    :return:
+    """
+    identity = record_identity(row)
+    if occurrence:
+        identity += f"\x1f#{occurrence}"
+    digest = hashlib.blake2b(identity.encode("utf-8"), digest_size=16).digest()
+    return str(uuid.UUID(bytes=digest))
+
+
+class DocumentIds:
+    """
+    Document ids of the records of one pass over the input.
+    Records with the same identity (e.g. a movie listed under two origins) would share an id and overwrite each
+    other's content hash in incremental mode. The first keeps the plain id, the others get their occurrence added,
+    so the ids stay stable as long as the order of the duplicates does not change.
+    """
+
+    def __init__(self, identity_keys=IDENTITY_KEYS):
+        self.identity_keys = identity_keys
+        # identity digest -> records seen
+        self.__seen = {}
+        self.duplicates = 0
+
+    def next(self, row):
+        """
+        Get the id of the next record
+        :param row:
+        :return:
+        """
+        key = hashlib.blake2b(record_identity(row, self.identity_keys).encode("utf-8"), digest_size=16).digest()
+        occurrence = self.__seen.get(key, 0)
+        self.__seen[key] = occurrence + 1
+        if occurrence:
+            self.duplicates += 1
+            logger.warning(
+                f"Duplicate record {({key: row.get(key) for key in self.identity_keys})}, "
+                f"occurrence {occurrence + 1} gets its own document id"
+            )
+        return document_id(row, occurrence)
+
+
+def split_fraction(row, seed=0, identity_keys=IDENTITY_KEYS):
+    """
+    Map a record to a stable number in [0, 1) based on its identity and the seed.
+    The value only depends on the record itself, not on the order or size of the corpus,
+    so the same record always lands in the same split on every run and machine.
+    :param row:
+    :param seed:
+    :param identity_keys:
+    :return:
+    """
+    identity = record_identity(row, identity_keys)
+    digest = hashlib.blake2b(f"{seed}\x1e{identity}".encode("utf-8"), digest_size=8).digest()
+    return int.from_bytes(digest, "big") / 2 ** 64
+
+
+def split_fold(row, folds, seed=0, identity_keys=IDENTITY_KEYS):
+    """
+    Get the fold (0 to folds - 1) of a record for k-fold evaluation
+    :param row:
+    :param folds:
+    :param seed:
+    :param identity_keys:
+    :return:
+    """
+    if folds < 2:
+        raise ValueError("folds must be at least 2")
+    return min(int(split_fraction(row, seed, identity_keys) * folds), folds - 1)
+
+
+# files and version of the columnar corpus format
+COLUMNAR_MANIFEST = "manifest.json"
+COLUMNAR_VERSION = 1
+
+
+def is_columnar_corpus(path):
+    """
+    Check if the path is a directory written by write_columnar_corpus
+    :param path:
+    :return:
+    """
+    return (Path(path) / COLUMNAR_MANIFEST).is_file()
+
+
+def write_columnar_corpus(input_file, output_dir):
+    """
+    Convert the JSON file into a columnar corpus.
+    Integer columns (release_year, plot_length) are stored as int64 arrays,
+    all other columns as concatenated UTF-8 data with an int64 offset index.
+    Text values can be null, they are marked in a byte array per column that has nulls.
+    The records are streamed, so the JSON file is never fully loaded.
+    :param input_file:
+    :param output_dir:
+    :return:
+    """
+    output_path = Path(output_dir)
+    output_path.mkdir(parents=True, exist_ok=True)
+
+    columns = None
+    data_files = []
+    offsets = []
+    values = []
+    nulls = []
+    rows = 0
+    try:
+        for record in iter_json_records(input_file):
+            if columns is None:
+                # the schema is taken from the first record
+                columns = [
+                    (key, "int" if isinstance(value, int) and not isinstance(value, bool) else "str")
+                    for key, value in record.items()
+                ]
+                for i, (_, kind) in enumerate(columns):
+                    if kind == "str":
+                        data_files.append((output_path / f"col_{i}.data").open('wb'))
+                        offsets.append(array('q', [0]))
+                        values.append(None)
+                        nulls.append(array('B'))
+                    else:
+                        data_files.append(None)
+                        offsets.append(None)
+                        values.append(array('q'))
+                        nulls.append(None)
+                schema = {key for key, _ in columns}
+
+            if record.keys() != schema:
+                raise ValueError(
+                    f"Record {rows} in {input_file} does not match the schema, "
+                    f"missing {sorted(schema - record.keys())}, unknown {sorted(record.keys() - schema)}"
+                )
+            for i, (key, kind) in enumerate(columns):
+                value = record[key]
+                if kind == "int":
+                    if not isinstance(value, int):
+                        raise ValueError(f"Column {key} of record {rows} in {input_file} must be an integer")
+                    values[i].append(value)
+                else:
+                    if value is not None and not isinstance(value, str):
+                        raise ValueError(f"Column {key} of record {rows} in {input_file} must be a string or null")
+                    encoded = value.encode("utf-8") if value is not None else b""
+                    data_files[i].write(encoded)
+                    offsets[i].append(offsets[i][-1] + len(encoded))
+                    nulls[i].append(value is None)
+            rows += 1
+    finally:
+        for file in data_files:
+            if file is not None:
+                file.close()
+
+    nullable = []
+    for i, (key, kind) in enumerate(columns):
+        if kind == "str":
+            np.asarray(offsets[i], dtype='<i8').tofile(output_path / f"col_{i}.offsets")
+            if any(nulls[i]):
+                np.asarray(nulls[i], dtype=np.uint8).tofile(output_path / f"col_{i}.nulls")
+                nullable.append(key)
+        else:
+            np.asarray(values[i], dtype='<i8').tofile(output_path / f"col_{i}.values")
+
+    # write the manifest last, so an incomplete conversion is never opened
+    manifest = {
+        'version': COLUMNAR_VERSION,
+        'source': Path(input_file).name,
+        'rows': rows,
+        'columns': columns,
+        'nullable': nullable
+    }
+    manifest_tmp = output_path / (COLUMNAR_MANIFEST + ".tmp")
+    manifest_tmp.write_text(json.dumps(manifest), encoding="utf-8")
+    os.replace(manifest_tmp, output_path / COLUMNAR_MANIFEST)
+    return output_path
+
+
+class ColumnarCorpus:
+    """
+    Read-only, memory-mapped access to a corpus written by write_columnar_corpus
+    """
+
+    def __init__(self, path):
+        self.path = Path(path)
+        if not is_columnar_corpus(self.path):
+            raise FileNotFoundError(f"No columnar corpus found at {self.path}")
+
+        manifest = json.loads((self.path / COLUMNAR_MANIFEST).read_text(encoding="utf-8"))
+        if manifest.get('version') != COLUMNAR_VERSION:
+            raise ValueError(f"Unsupported columnar corpus version in {self.path}")
+        self.source = manifest['source']
+        self.rows = manifest['rows']
+        self.columns = [(key, kind) for key, kind in manifest['columns']]
+        self.__data = {}
+        self.__offsets = {}
+        self.__values = {}
+        self.__nulls = {}
+        nullable = set(manifest.get('nullable', ()))
+        for i, (key, kind) in enumerate(self.columns):
+            if kind == "str":
+                self.__offsets[key] = self.__memmap(f"col_{i}.offsets", '<i8')
+                self.__data[key] = self.__memmap(f"col_{i}.data", np.uint8)
+                if key in nullable:
+                    self.__nulls[key] = self.__memmap(f"col_{i}.nulls", np.uint8)
+            else:
+                self.__values[key] = self.__memmap(f"col_{i}.values", '<i8')
+
+    def __memmap(self, file_name, dtype):
+        """
+        Map a column file, an empty file cannot be mapped
+        :param file_name:
+        :param dtype:
+        :return:
+        """
+        file_path = self.path / file_name
+        if file_path.stat().st_size == 0:
+            return np.zeros(0, dtype=dtype)
+        return np.memmap(file_path, dtype=dtype, mode='r')
+
+    def __len__(self):
+        return self.rows
+
+    def column(self, key):
+        """
+        Get an integer column as a memory-mapped array, e.g. release_year
+        :param key:
+        :return:
+        """
+        if key not in self.__values:
+            raise KeyError(f"{key} is not an integer column")
+        return self.__values[key]
+
+    def get_value(self, key, index):
+        """
+        Get a single value without reading the rest of the column
+        :param key:
+        :param index:
+        :return:
+        """
+        if key in self.__values:
+            return int(self.__values[key][index])
+        if key in self.__nulls and self.__nulls[key][index]:
+            return None
+        offsets = self.__offsets[key]
+        return self.__data[key][offsets[index]:offsets[index + 1]].tobytes().decode("utf-8")
+
+    def get_row(self, index):
+        """
+        Get a row as a dict with the keys in the original order
+        :param index:
+        :return:
+        """
+        if not 0 <= index < self.rows:
+            raise IndexError(f"Row {index} out of range")
+        return {key: self.get_value(key, index) for key, _ in self.columns}
+
+    def iter_rows(self, indices=None):
+        """
+        Iterate over the rows, optionally only over the given indices
+        :param indices:
+        :return:
+        """
+        for index in range(self.rows) if indices is None else indices:
+            yield self.get_row(int(index))
+
+    def select_range(self, start=0, stop=None):
+        """
+        Get the row indices of a row range
+        :param start:
+        :param stop:
+        :return:
+        """
+        return np.arange(*slice(start, stop).indices(self.rows))
+
+    def select_years(self, start_year, end_year=None, key='release_year'):
+        """
+        Get the row indices of all movies released between start_year and end_year
+        :param start_year:
+        :param end_year:
+        :param key:
+        :return:
+        """
+        years = self.column(key)
+        end_year = start_year if end_year is None else end_year
+        return np.flatnonzero((years >= start_year) & (years <= end_year))
+
 
 class Loading:
 
-    def __init__(self, input_file=OUTPUT_FILE, formatted=True):
+    def __init__(self, input_file=OUTPUT_FILE, formatted=True, streaming=False, workers=None):
         self.input_file = input_file
-        self.json_data = self.read_input_json_file()
+        self.streaming = streaming
+        self.workers = workers or os.cpu_count() or 1
+        self.parallel_threshold = PARALLEL_THRESHOLD
+        self.throughput = None
+        # a columnar corpus is memory-mapped instead of parsed
+        self.corpus = ColumnarCorpus(input_file) if is_columnar_corpus(input_file) else None
+        # in streaming mode the file is parsed lazily by iter_json_data
+        self.json_data = None if streaming or self.corpus else self.read_input_json_file()
         self.documents = []
+        self.__corpus_document_ids = None
         self.text_formatted = formatted
         self.text_template = "Metadata:\n{metadata_str}\n-----------\nContent:\n{content}"
-        self.include_from_metadata = ['release_year', 'origin_ethnicity', 'plot_length', 'title']
+        self.include_from_metadata = ['release_year', 'origin_ethnicity', 'plot_length', 'title', 'genre']
         self.metadata_template = "{key}: {value}"
         self.metadata = {
             'extension': '.json',
@@ -63,86 +534,213 @@ class Loading:
         Get the JSON data
         :return:
         """
+        if self.json_data is None:
+            if self.corpus is not None:
+                self.json_data = list(self.corpus.iter_rows())
+            else:
+                self.json_data = self.read_input_json_file()
         return self.json_data
 
+    def iter_json_data(self):
+        """
+        Iterate over the records of the JSON file without loading the whole file
+        :return:
+        """
+        if self.json_data is not None:
+            return iter(self.json_data)
+        if self.corpus is not None:
+            return self.corpus.iter_rows()
+        return iter_json_records(self.input_file)
+
+    def count_documents(self):
+        """
+        Count the records without creating documents, e.g. for the ETA of the ingestion
+        :return:
+        """
+        if self.json_data is not None:
+            return len(self.json_data)
+        if self.corpus is not None:
+            return len(self.corpus)
+        return sum(1 for _ in iter_json_records(self.input_file))
+
+    def iter_documents(self):
+        """
+        Lazily create the documents record by record
+        :return:
+        """
+        doc_ids = DocumentIds()
+        for row in self.iter_json_data():
+            yield self.__create_document(row, doc_ids.next(row))
+
     def load_data(self):
         """
         Load the data from the JSON file
         and create a list of documents
         :return:
         """
-        for row in self.get_json_data():
-            self.documents.append(self.__create_document(row))
+        start = time.perf_counter()
+        rows = self.get_json_data()
+        doc_ids = DocumentIds()
+        ids = [doc_ids.next(row) for row in rows]
+        settings = {
+            'formatted': self.text_formatted,
+            'text_template': self.text_template,
+            'include_from_metadata': self.include_from_metadata
+        }
+
+        if self.workers > 1 and len(rows) >= self.parallel_threshold:
+            starts = range(0, len(rows), DOCUMENT_CHUNK_SIZE)
+            with ProcessPoolExecutor(max_workers=self.workers) as executor:
+                documents = list(chain.from_iterable(executor.map(
+                    partial(build_documents, **settings),
+                    [rows[i:i + DOCUMENT_CHUNK_SIZE] for i in starts],
+                    [ids[i:i + DOCUMENT_CHUNK_SIZE] for i in starts]
+                )))
+        else:
+            documents = build_documents(rows, ids, **settings)
+        self.documents = documents
+
+        # report the throughput
+        elapsed = time.perf_counter() - start
+        self.throughput = len(documents) / elapsed if elapsed > 0 else float("inf")
+        logger.info(
+            f"Created {len(documents)} documents in {elapsed:.2f}s ({self.throughput:.0f} documents/sec)"
+        )
 
     def get_documents(self):
         """
-        Get the list of documents
+        Get the list of documents,
+        the documents are only created on the first call
         :return:
         """
-        self.load_data()
+        if not self.documents:
+            self.load_data()
         return self.documents
 
-    def get_training_test_data(self):
+    def write_columnar(self, output_dir):
+        """
+        Convert the input file into a columnar corpus that can be opened with Loading(output_dir)
+        :param output_dir:
+        :return:
+        """
+        return write_columnar_corpus(self.input_file, output_dir)
+
+    def get_documents_by_range(self, start=0, stop=None):
+        """
+        Create the documents of a row range of the columnar corpus
+        :param start:
+        :param stop:
+        :return:
+        """
+        return self.__create_documents_from_corpus(self.__get_corpus().select_range(start, stop))
+
+    def get_documents_by_year(self, start_year, end_year=None):
+        """
+        Create the documents of all movies released between start_year and end_year
+        :param start_year:
+        :param end_year:
+        :return:
+        """
+        return self.__create_documents_from_corpus(self.__get_corpus().select_years(start_year, end_year))
+
+    def __get_corpus(self):
         """
-        Get the training and test data
+        Get the columnar corpus
         :return:
         """
-        # randomly shuffle the data
-        import random
-        random.shuffle(self.get_json_data())
+        if self.corpus is None:
+            raise ValueError(f"{self.input_file} is not a columnar corpus, convert it with write_columnar")
+        return self.corpus
 
-        # split the data into training and test data
+    def __create_documents_from_corpus(self, indices):
+        """
+        Create the documents for the given rows of the columnar corpus
+        :param indices:
+        :return:
+        """
+        # the ids are numbered over the whole corpus, so a range gets the same ids as a full pass
+        if self.__corpus_document_ids is None:
+            doc_ids = DocumentIds()
+            keys = [key for key, _ in self.corpus.columns if key in IDENTITY_KEYS]
+            self.__corpus_document_ids = [
+                doc_ids.next({key: self.corpus.get_value(key, index) for key in keys})
+                for index in range(len(self.corpus))
+            ]
+        return build_documents(
+            self.corpus.iter_rows(indices),
+            [self.__corpus_document_ids[int(index)] for index in indices],
+            self.text_formatted,
+            self.text_template,
+            self.include_from_metadata
+        )
+
+    def get_training_test_data(self, test_ratio=0.2, seed=0):
+        """
+        Get the training and test data,
+        default split 80% training and 20% test
+        :param test_ratio:
+        :param seed:
+        :return:
+        """
+        if not 0 <= test_ratio <= 1:
+            raise ValueError("test_ratio must be between 0 and 1")
         training_data = []
         test_data = []
-        # split 80% training and 20% test
-
-        split = int(0.8 * len(self.get_json_data()))
-        print(split)
-        for i, row in enumerate(self.get_json_data()):
-            create_document = self.__create_document(row)
-            if i < split:
-                training_data.append(create_document)
+        doc_ids = DocumentIds()
+        for row in self.iter_json_data():
+            document = self.__create_document(row, doc_ids.next(row))
+            if split_fraction(row, seed) < test_ratio:
+                test_data.append(document)
             else:
-                test_data.append(create_document)
+                training_data.append(document)
         return training_data, test_data
 
-    def __create_document(self, document):
+    def iter_split(self, test=False, test_ratio=0.2, seed=0):
         """
-        Create a document object
-        :param document:
+        Lazily create the documents of the training or the test split
+        :param test:
+        :param test_ratio:
+        :param seed:
         :return:
         """
-        if self.text_formatted:
-            text = self.__create_document_text(document)
-        else:
-            text = json.dumps(document)
-        return Document(
-            text=text,
-            metadata=self.__create_metadata(document),
-            excluded_llm_metadata_keys=["file_name"],
-            text_template=self.text_template
-        )
+        if not 0 <= test_ratio <= 1:
+            raise ValueError("test_ratio must be between 0 and 1")
+        # every record is numbered, so the documents of a split have the same ids as in a full pass
+        doc_ids = DocumentIds()
+        for row in self.iter_json_data():
+            doc_id = doc_ids.next(row)
+            if (split_fraction(row, seed) < test_ratio) == test:
+                yield self.__create_document(row, doc_id)
 
-    def __create_metadata(self, row):
+    def iter_fold(self, fold, folds=5, test=True, seed=0):
         """
-        Create the metadata for the document
-        :param row:
+        Lazily create the documents of a fold (test=True)
+        or of all other folds (test=False) for k-fold evaluation
+        :param fold:
+        :param folds:
+        :param test:
+        :param seed:
         :return:
         """
-        metadata = {}
-        for key, value in row.items():
-            if key in self.include_from_metadata:
-                metadata[key] = value
-        return metadata
+        if not 0 <= fold < folds:
+            raise ValueError(f"fold must be between 0 and {folds - 1}")
+        doc_ids = DocumentIds()
+        for row in self.iter_json_data():
+            doc_id = doc_ids.next(row)
+            if (split_fold(row, folds, seed) == fold) == test:
+                yield self.__create_document(row, doc_id)
 
-    @staticmethod
-    def __create_document_text(row):
+    def __create_document(self, document, doc_id=None):
         """
-        Create the text for the document
-        :param row:
+        Create a document object
+        :param document:
+        :param doc_id: id from DocumentIds
         :return:
         """
-        content = ""
-        for key, value in row.items():
-            content += f"{key}: {value}\n"
-        return content
+        return create_document(
+            document,
+            self.text_formatted,
+            self.text_template,
+            self.include_from_metadata,
+            doc_id
+        )
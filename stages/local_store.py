@@ -0,0 +1,579 @@
+import json
+import logging
+import os
+import sqlite3
+import threading
+from pathlib import Path
+from typing import Any, List
+
+import numpy as np
+from llama_index.core import VectorStoreIndex
+from llama_index.core.bridge.pydantic import PrivateAttr
+from llama_index.core.vector_stores.types import (
+    BasePydanticVectorStore,
+    FilterCondition,
+    FilterOperator,
+    MetadataFilters,
+    VectorStoreQuery,
+    VectorStoreQueryResult
+)
+from llama_index.core.vector_stores.utils import metadata_dict_to_node, node_to_metadata_dict
+
+# Sources:
+# https://numpy.org/doc/stable/reference/generated/numpy.memmap.html
+# https://docs.llamaindex.ai/en/stable/module_guides/storing/vector_stores/
+# https://www.sqlite.org/json1.html
+# https://github.com/facebookresearch/faiss/wiki/Faiss-indexes#cell-probe-methods-indexivf-indexes
+
+"""
+The MemmapVectorStore class is a serverless vector store for the local mode
+- Keep the normalized vectors in a memory-mapped float32 or float16 matrix, one row per node
+- Keep the node ids, document ids, metadata and node payloads in a SQLite side table
+- Exact cosine search as one matrix product, optional IVF index for sub-linear search
+- Append new nodes without rewriting the stored ones
+"""
+
+logger = logging.getLogger(__name__)
+
+VECTOR_DTYPES = ("float32", "float16")
+
+# rows per block of the exact search, bounds the float32 copy of a float16 matrix
+SEARCH_BLOCK_SIZE = 65536
+
+_sql_operators = {
+    FilterOperator.EQ: "=",
+    FilterOperator.NE: "!=",
+    FilterOperator.GT: ">",
+    FilterOperator.GTE: ">=",
+    FilterOperator.LT: "<",
+    FilterOperator.LTE: "<="
+}
+
+
+def _filter_sql(filters: MetadataFilters):
+    """
+    Translate metadata filters to a SQL condition on the metadata column
+    :param filters:
+    :return: condition and parameters
+    """
+    clauses = []
+    params = []
+    for metadata_filter in filters.filters:
+        if isinstance(metadata_filter, MetadataFilters):
+            clause, clause_params = _filter_sql(metadata_filter)
+            clauses.append(f"({clause})")
+            params.extend(clause_params)
+            continue
+        field = "json_extract(metadata, ?)"
+        params.append(f'$."{metadata_filter.key}"')
+        operator = metadata_filter.operator
+        value = metadata_filter.value
+        if operator in _sql_operators:
+            clauses.append(f"{field} {_sql_operators[operator]} ?")
+            params.append(value)
+        elif operator in (FilterOperator.IN, FilterOperator.NIN):
+            values = list(value)
+            negation = "NOT " if operator == FilterOperator.NIN else ""
+            clauses.append(f"{field} {negation}IN ({', '.join('?' * len(values))})")
+            params.extend(values)
+        elif operator == FilterOperator.TEXT_MATCH:
+            clauses.append(f"{field} LIKE ?")
+            params.append(f"%{value}%")
+        else:
+            raise ValueError(f"Filter operator {operator} not supported by the local vector store")
+    condition = " OR " if filters.condition == FilterCondition.OR else " AND "
+    return condition.join(clauses) or "1", params
+
+
+class MemmapVectorStore(BasePydanticVectorStore):
+    """
+    Local vector store on a memory-mapped matrix.
+    Rows are only appended, deleted and replaced nodes are marked in the side table
+    and skipped by the search until the store is compacted.
+    """
+
+    stores_text: bool = True
+    flat_metadata: bool = False
+    persist_path: str
+    dtype: str = "float32"
+    n_probe: int = 8
+
+    _lock = PrivateAttr()
+    _db = PrivateAttr()
+    _dim = PrivateAttr()
+    _rows = PrivateAttr()
+    _vectors = PrivateAttr()
+    _deleted = PrivateAttr()
+    _ivf = PrivateAttr()
+
+    def __init__(self, persist_path, dtype: str = "float32", n_probe: int = 8, **kwargs):
+        if dtype not in VECTOR_DTYPES:
+            raise ValueError(f"Vector dtype {dtype} not supported, use one of {VECTOR_DTYPES}")
+        super().__init__(persist_path=str(persist_path), dtype=dtype, n_probe=n_probe, **kwargs)
+        path = Path(self.persist_path)
+        path.mkdir(parents=True, exist_ok=True)
+        self._lock = threading.RLock()
+        self._vectors = None
+        self._ivf = None
+        self._db = sqlite3.connect(path / "table.sqlite", check_same_thread=False)
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS points ("
+            "row INTEGER PRIMARY KEY, node_id TEXT NOT NULL, doc_id TEXT, "
+            "metadata TEXT NOT NULL, node TEXT NOT NULL, deleted INTEGER NOT NULL DEFAULT 0)"
+        )
+        self._db.execute("CREATE INDEX IF NOT EXISTS points_node_id ON points (node_id)")
+        self._db.execute("CREATE INDEX IF NOT EXISTS points_doc_id ON points (doc_id)")
+        self._db.execute("CREATE TABLE IF NOT EXISTS meta (name TEXT PRIMARY KEY, value TEXT NOT NULL)")
+        self._db.commit()
+
+        meta = dict(self._db.execute("SELECT name, value FROM meta"))
+        if meta.get('dtype', self.dtype) != self.dtype:
+            raise ValueError(f"The store at {path} has dtype {meta['dtype']}, not {self.dtype}")
+        self._dim = int(meta['dim']) if 'dim' in meta else None
+        self._rows = self._db.execute("SELECT COALESCE(MAX(row) + 1, 0) FROM points").fetchone()[0]
+        self._deleted = np.zeros(self._rows, dtype=bool)
+        self._deleted[[row for row, in self._db.execute("SELECT row FROM points WHERE deleted = 1")]] = True
+        if self._dim:
+            # rows written after the last committed add (e.g. an interrupted run) are dropped
+            with self.__vector_file.open('ab') as file:
+                file.truncate(self._rows * self.__row_bytes)
+        self.__load_ivf()
+
+    @classmethod
+    def class_name(cls) -> str:
+        return "MemmapVectorStore"
+
+    @property
+    def client(self) -> Any:
+        return None
+
+    @property
+    def __vector_file(self):
+        return Path(self.persist_path) / f"vectors.{self.dtype}"
+
+    @property
+    def __row_bytes(self):
+        return self._dim * np.dtype(self.dtype).itemsize
+
+    def count(self):
+        """
+        Get the number of stored nodes, not __len__ because an empty store would be falsy
+        and StorageContext.from_defaults would replace it with a SimpleVectorStore
+        :return:
+        """
+        return int(self._rows - self._deleted.sum())
+
+    def __matrix(self):
+        """
+        Map the vector file, the map is renewed after appends
+        :return:
+        """
+        if self._vectors is None or len(self._vectors) != self._rows:
+            self._vectors = np.memmap(self.__vector_file, dtype=self.dtype, mode='r', shape=(self._rows, self._dim))
+        return self._vectors
+
+    def add(self, nodes, **kwargs: Any) -> List[str]:
+        """
+        Append embedded nodes, nodes with a stored id replace the stored version
+        :param nodes:
+        :param kwargs:
+        :return:
+        """
+        if not nodes:
+            return []
+        vectors = np.asarray([node.get_embedding() for node in nodes], dtype=np.float32)
+        norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+        vectors = vectors / np.where(norms == 0, 1, norms)
+
+        with self._lock:
+            if self._dim is None:
+                self._dim = vectors.shape[1]
+                self._db.execute("INSERT INTO meta VALUES ('dim', ?)", (str(self._dim),))
+                self._db.execute("INSERT INTO meta VALUES ('dtype', ?)", (self.dtype,))
+            elif vectors.shape[1] != self._dim:
+                raise ValueError(f"Vector size {vectors.shape[1]} does not match the store ({self._dim})")
+
+            node_ids = [node.node_id for node in nodes]
+            self.__mark_deleted("node_id", node_ids)
+            rows = []
+            for i, node in enumerate(nodes):
+                payload = node_to_metadata_dict(node, remove_text=False, flat_metadata=self.flat_metadata)
+                rows.append((
+                    self._rows + i,
+                    node.node_id,
+                    node.ref_doc_id,
+                    json.dumps(node.metadata, default=str),
+                    json.dumps(payload, default=str)
+                ))
+
+            # the vectors are written before the rows are committed,
+            # so every committed row has its vector on disk
+            with self.__vector_file.open('ab') as file:
+                file.write(vectors.astype(self.dtype).tobytes())
+            self._db.executemany(
+                "INSERT INTO points (row, node_id, doc_id, metadata, node) VALUES (?, ?, ?, ?, ?)",
+                rows
+            )
+            self._db.commit()
+            self._rows += len(nodes)
+            self._deleted = np.concatenate([self._deleted, np.zeros(len(nodes), dtype=bool)])
+        return node_ids
+
+    def __mark_deleted(self, column, values):
+        """
+        Mark the rows with the given node or document ids as deleted
+        :param column:
+        :param values:
+        :return:
+        """
+        values = list(values)
+        for i in range(0, len(values), 500):
+            batch = values[i:i + 500]
+            placeholders = ", ".join("?" * len(batch))
+            rows = [row for row, in self._db.execute(
+                f"SELECT row FROM points WHERE deleted = 0 AND {column} IN ({placeholders})", batch
+            )]
+            if rows:
+                self._db.execute(
+                    f"UPDATE points SET deleted = 1 WHERE row IN ({', '.join('?' * len(rows))})", rows
+                )
+                self._deleted[rows] = True
+
+    def update_nodes(self, nodes):
+        """
+        Replace the metadata and payload of stored nodes, the vectors stay unchanged
+        :param nodes:
+        :return:
+        """
+        with self._lock:
+            self._db.executemany(
+                "UPDATE points SET metadata = ?, node = ? WHERE node_id = ? AND deleted = 0",
+                [(
+                    json.dumps(node.metadata, default=str),
+                    json.dumps(
+                        node_to_metadata_dict(node, remove_text=False, flat_metadata=self.flat_metadata), default=str
+                    ),
+                    node.node_id
+                ) for node in nodes]
+            )
+            self._db.commit()
+
+    def delete(self, ref_doc_id: str, **delete_kwargs: Any) -> None:
+        """
+        Delete the nodes of a document
+        :param ref_doc_id:
+        :param delete_kwargs:
+        :return:
+        """
+        with self._lock:
+            self.__mark_deleted("doc_id", [ref_doc_id])
+            self._db.commit()
+
+    def delete_nodes(self, node_ids=None, filters=None, **delete_kwargs: Any) -> None:
+        """
+        Delete nodes by id and/or metadata filters
+        :param node_ids:
+        :param filters:
+        :param delete_kwargs:
+        :return:
+        """
+        with self._lock:
+            rows = self.__select_rows(node_ids=node_ids, filters=filters)
+            if rows is not None:
+                self.__mark_deleted("row", rows.tolist())
+                self._db.commit()
+
+    def get_nodes(self, node_ids=None, filters=None) -> list:
+        """
+        Get the stored nodes by id and/or metadata filters
+        :param node_ids:
+        :param filters:
+        :return:
+        """
+        rows = self.__select_rows(node_ids=node_ids, filters=filters)
+        if rows is None:
+            rows = np.flatnonzero(~self._deleted)
+        return self.__load_nodes(rows.tolist())
+
+    def iter_records(self, batch_size: int = 1000):
+        """
+        Iterate over the live rows in batches of node ids, float32 vectors and payloads
+        :param batch_size:
+        :return:
+        """
+        with self._lock:
+            live = np.flatnonzero(~self._deleted)
+            matrix = self.__matrix() if len(live) else None
+        for start in range(0, len(live), batch_size):
+            rows = live[start:start + batch_size]
+            with self._lock:
+                records = dict(
+                    (row, (node_id, payload)) for row, node_id, payload in self._db.execute(
+                        f"SELECT row, node_id, node FROM points WHERE row IN ({', '.join('?' * len(rows))})",
+                        rows.tolist()
+                    )
+                )
+            vectors = np.asarray(matrix[rows], dtype=np.float32)
+            yield (
+                [records[row][0] for row in rows.tolist()],
+                vectors,
+                [json.loads(records[row][1]) for row in rows.tolist()]
+            )
+
+    def clear(self) -> None:
+        """
+        Remove all nodes and the index files
+        :return:
+        """
+        with self._lock:
+            self._db.execute("DELETE FROM points")
+            self._db.execute("DELETE FROM meta")
+            self._db.commit()
+            self._vectors = None
+            self.__vector_file.unlink(missing_ok=True)
+            self.__remove_ivf()
+            self._dim = None
+            self._rows = 0
+            self._deleted = np.zeros(0, dtype=bool)
+
+    def persist(self, persist_path=None, fs=None) -> None:
+        """
+        Every add is written to disk immediately, persisting only commits pending deletes
+        :param persist_path:
+        :param fs:
+        :return:
+        """
+        with self._lock:
+            self._db.commit()
+
+    def __select_rows(self, node_ids=None, doc_ids=None, filters=None):
+        """
+        Get the live rows matching the ids and filters, None if there is no condition
+        :param node_ids:
+        :param doc_ids:
+        :param filters:
+        :return:
+        """
+        # empty id lists are no condition, VectorIndexRetriever passes node_ids=[] for an index without nodes_dict
+        node_ids = node_ids or None
+        doc_ids = doc_ids or None
+        if node_ids is None and doc_ids is None and (filters is None or not filters.filters):
+            return None
+        clauses = ["deleted = 0"]
+        params = []
+        for column, values in (("node_id", node_ids), ("doc_id", doc_ids)):
+            if values is not None:
+                values = list(values)
+                clauses.append(f"{column} IN ({', '.join('?' * len(values))})")
+                params.extend(values)
+        if filters is not None:
+            clause, filter_params = _filter_sql(filters)
+            clauses.append(f"({clause})")
+            params.extend(filter_params)
+        query = f"SELECT row FROM points WHERE {' AND '.join(clauses)} ORDER BY row"
+        return np.fromiter((row for row, in self._db.execute(query, params)), dtype=np.int64)
+
+    def __load_nodes(self, rows):
+        """
+        Load the nodes of the given rows, in the given order
+        :param rows:
+        :return:
+        """
+        payloads = {}
+        for i in range(0, len(rows), 500):
+            batch = rows[i:i + 500]
+            payloads.update(self._db.execute(
+                f"SELECT row, node FROM points WHERE row IN ({', '.join('?' * len(batch))})", batch
+            ))
+        return [metadata_dict_to_node(json.loads(payloads[row])) for row in rows]
+
+    def query(self, query: VectorStoreQuery, **kwargs: Any) -> VectorStoreQueryResult:
+        """
+        Search the most similar nodes by cosine similarity.
+        With an IVF index only the n_probe nearest lists and the rows appended after the index was built are scored.
+        :param query:
+        :param kwargs: n_probe, exact
+        :return:
+        """
+        if query.query_embedding is None:
+            raise ValueError("The local vector store requires a query embedding")
+        with self._lock:
+            rows_count = self._rows
+            if not rows_count or not self.count():
+                return VectorStoreQueryResult(nodes=[], similarities=[], ids=[])
+            matrix = self.__matrix()
+            deleted = self._deleted
+            candidates = self.__select_rows(node_ids=query.node_ids, doc_ids=query.doc_ids, filters=query.filters)
+            ivf = None if kwargs.get('exact') else self._ivf
+
+        vector = np.asarray(query.query_embedding, dtype=np.float32)
+        vector = vector / (np.linalg.norm(vector) or 1)
+        top_k = query.similarity_top_k
+
+        if ivf is not None:
+            probes = self.__probe_rows(ivf, vector, kwargs.get('n_probe', self.n_probe), rows_count)
+            candidates = probes if candidates is None else np.intersect1d(candidates, probes, assume_unique=True)
+
+        if candidates is None:
+            # exact search, one matrix product per block
+            scores = np.empty(rows_count, dtype=np.float32)
+            for start in range(0, rows_count, SEARCH_BLOCK_SIZE):
+                block = np.asarray(matrix[start:start + SEARCH_BLOCK_SIZE], dtype=np.float32)
+                scores[start:start + len(block)] = block @ vector
+            scores[deleted] = -np.inf
+            rows = np.arange(rows_count)
+        else:
+            rows = candidates[~deleted[candidates]]
+            scores = np.asarray(matrix[rows], dtype=np.float32) @ vector if len(rows) else np.empty(0, np.float32)
+
+        top_k = min(top_k, int(np.isfinite(scores).sum()))
+        if top_k <= 0:
+            return VectorStoreQueryResult(nodes=[], similarities=[], ids=[])
+        top = np.argpartition(-scores, top_k - 1)[:top_k]
+        top = top[np.argsort(-scores[top])]
+
+        with self._lock:
+            nodes = self.__load_nodes(rows[top].tolist())
+        return VectorStoreQueryResult(
+            nodes=nodes,
+            similarities=scores[top].tolist(),
+            ids=[node.node_id for node in nodes]
+        )
+
+    def build_ivf(self, n_lists: int = None, iterations: int = 10, sample_size: int = 100_000, seed: int = 0):
+        """
+        Build an IVF index: spherical k-means centroids and one inverted list of rows per centroid.
+        Rows appended later are searched exactly until the index is rebuilt.
+        :param n_lists: number of centroids, default sqrt of the number of rows
+        :param iterations:
+        :param sample_size: rows used to train the centroids
+        :param seed:
+        :return:
+        """
+        with self._lock:
+            rows_count = self._rows
+            live = np.flatnonzero(~self._deleted)
+            if not len(live):
+                raise ValueError("Cannot build an IVF index on an empty store")
+            matrix = self.__matrix()
+        n_lists = min(n_lists or max(1, int(np.sqrt(len(live)))), len(live))
+        rng = np.random.default_rng(seed)
+
+        sample = np.sort(rng.choice(live, size=min(sample_size, len(live)), replace=False))
+        sample_vectors = np.asarray(matrix[sample], dtype=np.float32)
+        centroids = sample_vectors[rng.choice(len(sample), size=n_lists, replace=False)]
+        for _ in range(iterations):
+            assignment = np.argmax(sample_vectors @ centroids.T, axis=1)
+            sums = np.zeros_like(centroids)
+            np.add.at(sums, assignment, sample_vectors)
+            norms = np.linalg.norm(sums, axis=1, keepdims=True)
+            # empty lists keep their centroid
+            centroids = np.where(norms > 0, sums / np.where(norms == 0, 1, norms), centroids)
+
+        assignment = np.empty(rows_count, dtype=np.int32)
+        for start in range(0, rows_count, SEARCH_BLOCK_SIZE):
+            block = np.asarray(matrix[start:start + SEARCH_BLOCK_SIZE], dtype=np.float32)
+            assignment[start:start + len(block)] = np.argmax(block @ centroids.T, axis=1)
+        order = np.argsort(assignment, kind='stable').astype(np.int64)
+        offsets = np.searchsorted(assignment[order], np.arange(n_lists + 1)).astype(np.int64)
+
+        path = Path(self.persist_path)
+        with self._lock:
+            for name, array in (('centroids', centroids), ('rows', order), ('offsets', offsets)):
+                tmp_file = path / f"ivf_{name}.tmp.npy"
+                np.save(tmp_file, array)
+                os.replace(tmp_file, path / f"ivf_{name}.npy")
+            self._db.execute("INSERT OR REPLACE INTO meta VALUES ('ivf_rows', ?)", (str(rows_count),))
+            self._db.commit()
+            self.__load_ivf()
+        logger.info(f"Built IVF index with {n_lists} lists over {rows_count} rows in {path}")
+
+    def __load_ivf(self):
+        """
+        Load the IVF index if it was built
+        :return:
+        """
+        path = Path(self.persist_path)
+        row = self._db.execute("SELECT value FROM meta WHERE name = 'ivf_rows'").fetchone()
+        if row is None or not (path / "ivf_centroids.npy").exists():
+            self._ivf = None
+            return
+        self._ivf = {
+            'centroids': np.load(path / "ivf_centroids.npy"),
+            'rows': np.load(path / "ivf_rows.npy", mmap_mode='r'),
+            'offsets': np.load(path / "ivf_offsets.npy"),
+            'indexed_rows': int(row[0])
+        }
+
+    def __remove_ivf(self):
+        """
+        Remove the IVF index files
+        :return:
+        """
+        for name in ('centroids', 'rows', 'offsets'):
+            (Path(self.persist_path) / f"ivf_{name}.npy").unlink(missing_ok=True)
+        self._ivf = None
+
+    @staticmethod
+    def __probe_rows(ivf, vector, n_probe, rows_count):
+        """
+        Get the rows of the n_probe nearest lists and all rows appended after the index was built
+        :param ivf:
+        :param vector:
+        :param n_probe:
+        :param rows_count:
+        :return:
+        """
+        centroid_scores = ivf['centroids'] @ vector
+        n_probe = min(n_probe, len(centroid_scores))
+        lists = np.argpartition(-centroid_scores, n_probe - 1)[:n_probe]
+        offsets = ivf['offsets']
+        probes = [ivf['rows'][offsets[i]:offsets[i + 1]] for i in lists]
+        probes.append(np.arange(ivf['indexed_rows'], rows_count))
+        return np.sort(np.concatenate(probes))
+
+    def compact(self):
+        """
+        Rewrite the store without the deleted rows, the IVF index has to be rebuilt afterwards
+        :return:
+        """
+        with self._lock:
+            live = np.flatnonzero(~self._deleted)
+            if len(live) == self._rows:
+                return
+            path = Path(self.persist_path)
+            tmp_file = path / f"vectors.{self.dtype}.tmp"
+            matrix = self.__matrix()
+            with tmp_file.open('wb') as file:
+                for start in range(0, len(live), SEARCH_BLOCK_SIZE):
+                    file.write(np.asarray(matrix[live[start:start + SEARCH_BLOCK_SIZE]]).tobytes())
+            self._db.execute("DELETE FROM points WHERE deleted = 1")
+            self._db.execute("CREATE TEMP TABLE moves (old INTEGER PRIMARY KEY, new INTEGER)")
+            self._db.executemany("INSERT INTO moves VALUES (?, ?)", ((old, new) for new, old in enumerate(live.tolist())))
+            # move through negative rows, so no new row collides with an old one
+            self._db.execute("UPDATE points SET row = -1 - (SELECT new FROM moves WHERE old = points.row)")
+            self._db.execute("UPDATE points SET row = -1 - row")
+            self._db.execute("DROP TABLE moves")
+            self._db.execute("DELETE FROM meta WHERE name = 'ivf_rows'")
+            self._vectors = None
+            os.replace(tmp_file, self.__vector_file)
+            self._db.commit()
+            self.__remove_ivf()
+            self._rows = len(live)
+            self._deleted = np.zeros(self._rows, dtype=bool)
+        logger.info(f"Compacted {path} to {self._rows} rows")
+
+
+def load_local_index(persist_path, embed_model, dtype: str = "float32"):
+    """
+    Open a local vector store as index
+    :param persist_path:
+    :param embed_model:
+    :param dtype:
+    :return:
+    """
+    return VectorStoreIndex.from_vector_store(
+        MemmapVectorStore(persist_path, dtype=dtype),
+        embed_model=embed_model
+    )
+
@@ -0,0 +1,250 @@
+import logging
+import threading
+import time
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from itertools import islice
+
+from llama_index.core.node_parser import SentenceSplitter
+from llama_index.core.schema import MetadataMode
+
+from stages.hybrid import add_sparse_vectors
+
+# Sources:
+# https://docs.python.org/3/library/concurrent.futures.html
+# https://docs.llamaindex.ai/en/stable/module_guides/loading/ingestion_pipeline/#parallel-processing
+# https://qdrant.tech/documentation/tutorials/bulk-upload/
+
+"""
+The StagedIngestion class runs the ingestion as overlapping stages with bounded queues
+- Split the documents into nodes in a process pool
+- Embed the nodes in large batches in the main process
+- Write the embedded nodes to the vector store in background threads
+"""
+
+logger = logging.getLogger(__name__)
+
+# sentence splitters per process, built once per chunk configuration
+_splitters = {}
+
+
+def split_documents(documents, chunk_size, chunk_overlap):
+    """
+    Split documents into nodes, module level so it runs in a worker process
+    :param documents:
+    :param chunk_size:
+    :param chunk_overlap:
+    :return:
+    """
+    key = (chunk_size, chunk_overlap)
+    if key not in _splitters:
+        _splitters[key] = SentenceSplitter(chunk_size=chunk_size, chunk_overlap=chunk_overlap)
+    return _splitters[key].get_nodes_from_documents(documents)
+
+
+def timed_call(function, *args):
+    """
+    Call a function and return its result and the elapsed seconds
+    :param function:
+    :param args:
+    :return:
+    """
+    start = time.perf_counter()
+    result = function(*args)
+    return result, time.perf_counter() - start
+
+
+class StageStats:
+
+    def __init__(self, name):
+        self.name = name
+        self.items = 0
+        self.seconds = 0.0
+        self.max_queue_depth = 0
+        self.__queue_depth_sum = 0
+        self.__queue_depth_samples = 0
+        self.__lock = threading.Lock()
+
+    def add(self, items, seconds):
+        """
+        Add processed items and the time spent on them
+        :param items:
+        :param seconds:
+        :return:
+        """
+        with self.__lock:
+            self.items += items
+            self.seconds += seconds
+
+    def sample_queue(self, depth):
+        """
+        Record the current depth of the queue in front of the stage
+        :param depth:
+        :return:
+        """
+        self.max_queue_depth = max(self.max_queue_depth, depth)
+        self.__queue_depth_sum += depth
+        self.__queue_depth_samples += 1
+
+    def to_dict(self):
+        """
+        Get the throughput and queue depth of the stage
+        :return:
+        """
+        return {
+            'items': self.items,
+            'seconds': round(self.seconds, 2),
+            'items_per_second': round(self.items / self.seconds, 1) if self.seconds else None,
+            'max_queue_depth': self.max_queue_depth,
+            'avg_queue_depth': round(self.__queue_depth_sum / self.__queue_depth_samples, 2)
+            if self.__queue_depth_samples else 0
+        }
+
+
+class StagedIngestion:
+
+    def __init__(
+            self,
+            storing,
+            split_workers: int = None,
+            window_size: int = 200,
+            max_pending_windows: int = 4,
+            embed_batch_size: int = 512,
+            upsert_batch_size: int = 256,
+            max_in_flight: int = 4):
+        self.storing = storing
+        self.split_workers = split_workers
+        self.window_size = window_size
+        self.max_pending_windows = max_pending_windows
+        self.embed_batch_size = embed_batch_size
+        self.upsert_batch_size = upsert_batch_size
+        self.max_in_flight = max_in_flight
+        self.stats = {name: StageStats(name) for name in ('split', 'embed', 'upsert')}
+        self.__collection_created = False
+
+    def run(self, documents):
+        """
+        Run the stages over an iterable of documents
+        :param documents:
+        :return: stats per stage
+        """
+        start = time.perf_counter()
+        vector_store = self.storing.vector_store
+        if vector_store is None:
+            raise ValueError("Vector store not set, call open_vector_store first")
+
+        # a custom node parser cannot be rebuilt in a worker process, it runs in a thread
+        default_parser = type(self.storing.node_parser) is SentenceSplitter
+        split_executor = ProcessPoolExecutor(max_workers=self.split_workers) if default_parser \
+            else ThreadPoolExecutor(max_workers=1)
+        upsert_executor = ThreadPoolExecutor(max_workers=self.max_in_flight)
+
+        pending_splits = deque()
+        pending_upserts = deque()
+        buffer = []
+        self.__collection_created = False
+        try:
+            iterator = iter(documents)
+            exhausted = False
+            while not exhausted or pending_splits:
+                # stage 1: keep up to max_pending_windows windows in the split pool
+                while not exhausted and len(pending_splits) < self.max_pending_windows:
+                    window = list(islice(iterator, self.window_size))
+                    if not window:
+                        exhausted = True
+                        break
+                    if default_parser:
+                        future = split_executor.submit(
+                            timed_call, split_documents, window, self.storing.chunk_size, self.storing.overlap_size
+                        )
+                    else:
+                        future = split_executor.submit(
+                            timed_call, self.storing.node_parser.get_nodes_from_documents, window
+                        )
+                    pending_splits.append((len(window), future))
+                self.stats['split'].sample_queue(len(pending_splits))
+                if not pending_splits:
+                    break
+
+                # the windows are taken in order, so the stored order matches the input
+                count, future = pending_splits.popleft()
+                nodes, seconds = future.result()
+                buffer.extend(nodes)
+                self.stats['split'].add(count, seconds)
+                self.stats['embed'].sample_queue(len(buffer))
+
+                buffer = self.__embed_and_write(
+                    buffer, exhausted and not pending_splits, vector_store, upsert_executor, pending_upserts
+                )
+
+            # the last window can be taken before the end of the input is read, its rest is written here
+            self.__embed_and_write(buffer, True, vector_store, upsert_executor, pending_upserts)
+            while pending_upserts:
+                pending_upserts.popleft().result()
+        finally:
+            # shutdown(cancel_futures=True) needs Python 3.9, the environment pins 3.8
+            for _, future in pending_splits:
+                future.cancel()
+            split_executor.shutdown()
+            upsert_executor.shutdown()
+
+        result = {name: stage.to_dict() for name, stage in self.stats.items()}
+        result['total_seconds'] = round(time.perf_counter() - start, 2)
+        logger.info(f"Staged ingestion of {self.storing.collection_name}: {result}")
+        return result
+
+    def __embed_and_write(self, buffer, flush, vector_store, upsert_executor, pending_upserts):
+        """
+        Embed the buffered nodes in full batches and write them in the background
+        :param buffer:
+        :param flush: also embed the last, partial batch
+        :param vector_store:
+        :param upsert_executor:
+        :param pending_upserts:
+        :return: nodes left in the buffer
+        """
+        # stage 2: embed in large batches
+        while len(buffer) >= self.embed_batch_size or (buffer and flush):
+            batch, buffer = buffer[:self.embed_batch_size], buffer[self.embed_batch_size:]
+            self.__embed(batch)
+
+            # stage 3: write in the background, at most max_in_flight batches at once
+            for i in range(0, len(batch), self.upsert_batch_size):
+                nodes = batch[i:i + self.upsert_batch_size]
+                if not self.__collection_created:
+                    # the first write creates the collection, so it is not run in parallel
+                    self.__upsert(vector_store, nodes)
+                    self.__collection_created = True
+                    continue
+                while len(pending_upserts) >= self.max_in_flight:
+                    pending_upserts.popleft().result()
+                pending_upserts.append(upsert_executor.submit(self.__upsert, vector_store, nodes))
+                self.stats['upsert'].sample_queue(len(pending_upserts))
+        return buffer
+
+    def __embed(self, nodes):
+        """
+        Embed a batch of nodes with the embed model of the storing
+        :param nodes:
+        :return:
+        """
+        start = time.perf_counter()
+        texts = [node.get_content(metadata_mode=MetadataMode.EMBED) for node in nodes]
+        embeddings = self.storing.embed_model.get_text_embedding_batch(texts)
+        for node, embedding in zip(nodes, embeddings):
+            node.embedding = embedding
+        self.stats['embed'].add(len(nodes), time.perf_counter() - start)
+
+    def __upsert(self, vector_store, nodes):
+        """
+        Write a batch of embedded nodes
+        :param vector_store:
+        :param nodes:
+        :return:
+        """
+        start = time.perf_counter()
+        vector_store.add(nodes)
+        if self.storing.hybrid:
+            # QdrantVectorStore only writes the dense vectors
+            add_sparse_vectors(self.storing.client, self.storing.collection_name, nodes, self.storing.sparse_encoder)
+        self.stats['upsert'].add(len(nodes), time.perf_counter() - start)
@@ -0,0 +1,192 @@
+import argparse
+import logging
+import os
+import re
+import time
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+
+from utils.config import OUTPUT_FILE
+
+# Sources:
+# analysis/02_Data_Preparation.ipynb
+# https://pandas.pydata.org/docs/user_guide/io.html#iterating-through-files-chunk-by-chunk
+# https://pandas.pydata.org/docs/user_guide/text.html
+# https://en.wikipedia.org/wiki/Reservoir_sampling
+# https://docs.python.org/3/library/argparse.html
+
+"""
+The Preparation class is responsible for turning the CSV file into the JSON file used by Loading
+- Stream the CSV file in chunks
+- Filter and clean every chunk with vectorized operations
+- Write the JSON file and all random samples in a single pass
+
+Usage:
+PYTHONPATH=$(pwd) python stages/preparation.py --input data/wiki_movie_plots.csv
+"""
+
+logger = logging.getLogger(__name__)
+
+# nested sample sizes, every sample is a subset of the next larger one
+SAMPLE_SIZES = (1000, 200, 100, 10, 2, 1)
+
+
+class Preparation:
+
+    def __init__(
+            self,
+            input_file=None,
+            output_file=OUTPUT_FILE,
+            chunk_size: int = 5000,
+            min_release_year: int = 1980,
+            origin_ethnicity: str = "American",
+            sample_sizes=SAMPLE_SIZES,
+            seed: int = 42):
+        self.input_file = input_file or os.getenv('INPUT_FILE')
+        self.output_file = output_file
+        self.chunk_size = chunk_size
+        self.min_release_year = min_release_year
+        self.origin_ethnicity = origin_ethnicity
+        self.sample_sizes = sorted(sample_sizes, reverse=True)
+        self.seed = seed
+        self.missing_value = "Unknown"
+        self.separator_columns = ["director", "cast", "genre"]
+        self.separators = [" and ", "&", "/", "\r\n", ";"]
+        self.separator_replacement = ", "
+        # one regex instead of one replace pass per separator,
+        # the separators do not overlap, so the result is the same
+        self.separator_pattern = "|".join(re.escape(separator) for separator in self.separators)
+
+    def run(self):
+        """
+        Clean the CSV file and write the JSON file and the samples
+        :return: number of written movies
+        """
+        if not self.input_file:
+            raise ValueError("No input file set, pass it or set INPUT_FILE")
+        input_path = Path(self.input_file)
+        if not input_path.exists():
+            raise FileNotFoundError(f"No file found at {input_path}")
+
+        start = time.perf_counter()
+        rng = np.random.default_rng(self.seed)
+        sample = None
+        rows = 0
+
+        with open(self.output_file, 'w', encoding="utf-8") as output:
+            output.write("[")
+            for chunk in pd.read_csv(input_path, sep=',', chunksize=self.chunk_size):
+                chunk = self.clean(chunk)
+                if chunk.empty:
+                    continue
+
+                # append the records of the chunk to the JSON array
+                records = chunk.to_json(orient='records', lines=False)
+                if rows:
+                    output.write(",")
+                output.write(records[1:-1])
+                rows += len(chunk)
+
+                # keep the rows with the smallest random keys as sample
+                if self.sample_sizes:
+                    sample = self.__update_sample(sample, chunk, rng)
+            output.write("]")
+
+        if not rows:
+            raise ValueError(f"No movies left in {input_path} after filtering")
+
+        if sample is not None:
+            self.__write_samples(sample)
+        logger.info(f"Prepared {rows} movies in {time.perf_counter() - start:.2f}s")
+        return rows
+
+    def clean(self, df):
+        """
+        Filter and clean a chunk of the CSV file
+        :param df:
+        :return:
+        """
+        # fix column names
+        df.columns = df.columns.str.replace(' ', '_').str.replace('/', '_').str.lower()
+
+        # 1980s and onward US movies
+        df = df[(df['release_year'] >= self.min_release_year) & (df['origin_ethnicity'] == self.origin_ethnicity)]
+        df = df.copy()
+        text_columns = df.columns[df.columns != 'release_year']
+
+        # fix missing values and empty strings
+        df[text_columns] = df[text_columns].fillna(self.missing_value)
+        for column in text_columns:
+            if not pd.api.types.is_numeric_dtype(df[column]):
+                empty = df[column].str.strip() == ''
+                df.loc[empty, column] = self.missing_value
+
+        # fix multiple values
+        for column in self.separator_columns:
+            df[column] = df[column].str.replace(self.separator_pattern, self.separator_replacement, regex=True)
+
+        # the notebook's newline replacement in plot is a no-op (the regex replacement "\\n" is a newline again),
+        # so the plots keep their line breaks
+
+        # add plot length
+        df['plot_length'] = df['plot'].str.len()
+        return df
+
+    def __update_sample(self, sample, chunk, rng):
+        """
+        Keep a uniform random sample of the largest sample size over all chunks.
+        Every row gets a random key, the rows with the smallest keys are the sample.
+        :param sample:
+        :param chunk:
+        :param rng:
+        :return:
+        """
+        chunk = chunk.assign(_sample_key=rng.random(len(chunk)))
+        if sample is not None:
+            chunk = pd.concat([sample, chunk])
+        return chunk.nsmallest(self.sample_sizes[0], '_sample_key')
+
+    def __write_samples(self, sample):
+        """
+        Write the nested samples, the smallest keys of a sample are a random subset of it
+        :param sample:
+        :return:
+        """
+        sample = sample.sort_values('_sample_key')
+        for size in self.sample_sizes:
+            sample_file = self.output_file.replace('.json', f'_{size}_random.json')
+            sample.head(size).drop(columns='_sample_key').to_json(
+                sample_file,
+                orient='records',
+                lines=False
+            )
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Prepare the wiki movie plots CSV file")
+    parser.add_argument("--input", default=os.getenv('INPUT_FILE'), help="CSV input file")
+    parser.add_argument("--output", default=OUTPUT_FILE, help="JSON output file")
+    parser.add_argument("--chunk-size", type=int, default=5000)
+    parser.add_argument("--min-release-year", type=int, default=1980)
+    parser.add_argument("--origin-ethnicity", default="American")
+    parser.add_argument("--sample-sizes", type=int, nargs="*", default=list(SAMPLE_SIZES))
+    parser.add_argument("--seed", type=int, default=42)
+    args = parser.parse_args()
+
+    Preparation(
+        input_file=args.input,
+        output_file=args.output,
+        chunk_size=args.chunk_size,
+        min_release_year=args.min_release_year,
+        origin_ethnicity=args.origin_ethnicity,
+        sample_sizes=args.sample_sizes,
+        seed=args.seed
+    ).run()
+
+
+if __name__ == '__main__':
+    # initialize logging for better debugging
+    logging.basicConfig(level=logging.DEBUG, format='%(asctime)s - %(levelname)s - %(message)s')
+    main()
@@ -0,0 +1,583 @@
+import asyncio
+import atexit
+import json
+import logging
+import os
+import threading
+import time
+from itertools import chain
+
+import numpy as np
+import qdrant_client
+from llama_index.core import VectorStoreIndex
+from llama_index.core.vector_stores.utils import node_to_metadata_dict
+from llama_index.vector_stores.qdrant import QdrantVectorStore
+from qdrant_client.http import models
+
+from utils.config import VECTOR_STORE_HOST, VECTOR_STORE_PORT
+
+# Sources:
+# https://qdrant.tech/documentation/concepts/indexing/#payload-index
+# https://qdrant.tech/documentation/concepts/indexing/#vector-index
+# https://qdrant.tech/documentation/guides/quantization/
+# https://qdrant.tech/documentation/concepts/storage/#configuring-memmap-storage
+# https://qdrant.tech/documentation/guides/capacity-planning/
+# https://qdrant.tech/documentation/interfaces/#grpc-interface
+# https://python-client.qdrant.tech/#async-client
+# https://github.com/grpc/grpc/blob/master/doc/keepalive.md
+# https://github.com/grpc/proposal/blob/master/A6-client-retries.md
+# https://qdrant.tech/documentation/tutorials/bulk-upload/
+
+"""
+The qdrant module is responsible for the configuration of the Qdrant collections
+- Declarative collection profiles (payload indexes, HNSW, optimizers, quantization, on-disk storage)
+- Create or update a collection from a profile
+- Estimate the RAM footprint and measure the search latency of a collection
+- Share pooled, gRPC-preferred sync and async clients across ingestion, chatbot and evaluation
+- Bulk upload points with indexing disabled during the load
+"""
+
+logger = logging.getLogger(__name__)
+
+# connection settings of the shared clients, compose exposes REST on 6333 and gRPC on 6334
+VECTOR_STORE_GRPC_PORT = int(os.getenv('VECTOR_STORE_GRPC_PORT', 6334))
+VECTOR_STORE_PREFER_GRPC = os.getenv('VECTOR_STORE_PREFER_GRPC', '1') == '1'
+VECTOR_STORE_TIMEOUT = int(os.getenv('VECTOR_STORE_TIMEOUT', 30))
+VECTOR_STORE_RETRIES = int(os.getenv('VECTOR_STORE_RETRIES', 3))
+
+# name of the BM25 sparse vector of hybrid collections (see stages.hybrid)
+SPARSE_VECTOR_NAME = "bm25"
+
+# indexing threshold of a collection without an explicit one (Qdrant default in KB)
+DEFAULT_INDEXING_THRESHOLD = 20000
+
+# payload indexes for the metadata that Loading attaches to every document
+PAYLOAD_INDEXES = {
+    'release_year': models.PayloadSchemaType.INTEGER,
+    'title': models.PayloadSchemaType.KEYWORD,
+    'origin_ethnicity': models.PayloadSchemaType.KEYWORD,
+    # genres are lists in one string ("comedy, drama"), matched by word
+    'genre': models.TextIndexParams(
+        type=models.TextIndexType.TEXT,
+        tokenizer=models.TokenizerType.WORD,
+        lowercase=True
+    )
+}
+
+# collection profiles, every key is optional
+# - payload_indexes: field name -> schema type
+# - hnsw: m, ef_construct, full_scan_threshold, on_disk
+# - optimizers: indexing_threshold, memmap_threshold, default_segment_number, ...
+# - quantization: None, "scalar" or "binary"
+# - quantization_always_ram: keep the quantized vectors in RAM
+# - vectors_on_disk, payload_on_disk: memmap the original vectors / the payloads
+# - search: hnsw_ef, rescore and oversampling used for the latency report
+# - sparse: name of a BM25 sparse vector next to the dense one (hybrid retrieval)
+COLLECTION_PROFILES = {
+    'default': {
+        'payload_indexes': PAYLOAD_INDEXES
+    },
+    'fast': {
+        'payload_indexes': PAYLOAD_INDEXES,
+        'hnsw': {'m': 32, 'ef_construct': 256},
+        'quantization': "scalar",
+        'quantization_always_ram': True,
+        'search': {'hnsw_ef': 128, 'rescore': True, 'oversampling': 2.0}
+    },
+    'low_memory': {
+        'payload_indexes': PAYLOAD_INDEXES,
+        'hnsw': {'m': 16, 'ef_construct': 100, 'on_disk': True},
+        'optimizers': {'memmap_threshold': 20000},
+        'quantization': "scalar",
+        'quantization_always_ram': True,
+        'vectors_on_disk': True,
+        'payload_on_disk': True,
+        'search': {'hnsw_ef': 64, 'rescore': True, 'oversampling': 2.0}
+    },
+    'binary': {
+        'payload_indexes': PAYLOAD_INDEXES,
+        'quantization': "binary",
+        'quantization_always_ram': True,
+        'vectors_on_disk': True,
+        'payload_on_disk': True,
+        'search': {'rescore': True, 'oversampling': 3.0}
+    }
+}
+
+
+def get_collection_profile(profile):
+    """
+    Get a profile by name or return the given profile dict
+    :param profile:
+    :return:
+    """
+    if profile is None or isinstance(profile, dict):
+        return profile
+    if profile not in COLLECTION_PROFILES:
+        raise ValueError(f"Collection profile {profile} not supported")
+    return COLLECTION_PROFILES[profile]
+
+
+def _quantization_config(profile):
+    """
+    Create the quantization config of a profile
+    :param profile:
+    :return:
+    """
+    quantization = profile.get('quantization')
+    always_ram = profile.get('quantization_always_ram', True)
+    if quantization is None:
+        return None
+    if quantization == "scalar":
+        return models.ScalarQuantization(
+            scalar=models.ScalarQuantizationConfig(
+                type=models.ScalarType.INT8,
+                quantile=profile.get('quantile', 0.99),
+                always_ram=always_ram
+            )
+        )
+    if quantization == "binary":
+        return models.BinaryQuantization(binary=models.BinaryQuantizationConfig(always_ram=always_ram))
+    raise ValueError(f"Quantization {quantization} not supported")
+
+
+def sparse_vectors_config(name=SPARSE_VECTOR_NAME):
+    """
+    Get the sparse vector config of a collection, the IDF of the terms is computed by Qdrant
+    :param name:
+    :return:
+    """
+    modifier = getattr(models, 'Modifier', None)
+    if modifier is None:
+        # qdrant-client < 1.10 has no IDF modifier, the sparse scores are term frequencies only
+        logger.warning("Sparse vectors without IDF modifier, update qdrant-client to 1.10 or newer")
+        return {name: models.SparseVectorParams()}
+    return {name: models.SparseVectorParams(modifier=modifier.IDF)}
+
+
+def apply_collection_profile(client, collection_name, vector_size, profile, vector_name=""):
+    """
+    Create the collection with the settings of the profile, or update an existing collection.
+    The vectors are created unnamed and with cosine distance like QdrantVectorStore does,
+    so the collection can be used by QdrantVectorStore afterwards.
+    :param client:
+    :param collection_name:
+    :param vector_size:
+    :param profile:
+    :param vector_name:
+    :return:
+    """
+    profile = get_collection_profile(profile)
+    hnsw_config = models.HnswConfigDiff(**profile['hnsw']) if profile.get('hnsw') else None
+    optimizers_config = models.OptimizersConfigDiff(**profile['optimizers']) if profile.get('optimizers') else None
+    quantization_config = _quantization_config(profile)
+
+    if not client.collection_exists(collection_name):
+        vector_params = models.VectorParams(
+            size=vector_size,
+            distance=models.Distance.COSINE,
+            on_disk=profile.get('vectors_on_disk')
+        )
+        client.create_collection(
+            collection_name=collection_name,
+            vectors_config={vector_name: vector_params} if vector_name else vector_params,
+            hnsw_config=hnsw_config,
+            optimizers_config=optimizers_config,
+            quantization_config=quantization_config,
+            on_disk_payload=profile.get('payload_on_disk'),
+            sparse_vectors_config=sparse_vectors_config(profile['sparse']) if profile.get('sparse') else None
+        )
+        logger.info(f"Created collection {collection_name} with profile {profile}")
+    elif profile.get('sparse') and profile['sparse'] not in \
+            (client.get_collection(collection_name).config.params.sparse_vectors or {}):
+        raise ValueError(
+            f"Collection {collection_name} has no sparse vector {profile['sparse']}, delete it to create it for hybrid"
+        )
+    elif hnsw_config or optimizers_config or quantization_config or 'vectors_on_disk' in profile:
+        client.update_collection(
+            collection_name=collection_name,
+            vectors_config={vector_name: models.VectorParamsDiff(on_disk=profile.get('vectors_on_disk'))}
+            if 'vectors_on_disk' in profile else None,
+            hnsw_config=hnsw_config,
+            optimizers_config=optimizers_config,
+            quantization_config=quantization_config
+        )
+        logger.info(f"Updated collection {collection_name} with profile {profile}")
+
+    # payload indexes for filtered search (creating an existing index is a no-op)
+    for field_name, field_schema in (profile.get('payload_indexes') or {}).items():
+        client.create_payload_index(
+            collection_name=collection_name,
+            field_name=field_name,
+            field_schema=field_schema
+        )
+
+
+def search_params(profile):
+    """
+    Get the search params of a profile
+    :param profile:
+    :return:
+    """
+    search = (get_collection_profile(profile) or {}).get('search') or {}
+    quantization = None
+    if 'rescore' in search or 'oversampling' in search:
+        quantization = models.QuantizationSearchParams(
+            rescore=search.get('rescore', True),
+            oversampling=search.get('oversampling')
+        )
+    return models.SearchParams(hnsw_ef=search.get('hnsw_ef'), quantization=quantization)
+
+
+def estimate_ram(client, collection_name):
+    """
+    Estimate the RAM footprint of a collection in bytes
+    (vectors, quantized vectors and HNSW graph, following the Qdrant capacity planning guide)
+    :param client:
+    :param collection_name:
+    :return:
+    """
+    info = client.get_collection(collection_name)
+    params = info.config.params
+    vectors = params.vectors
+    if isinstance(vectors, dict):
+        vectors = next(iter(vectors.values()))
+    points = info.points_count or 0
+    dim = vectors.size
+
+    vectors_in_ram = 0 if vectors.on_disk else points * dim * 4
+    quantized = 0
+    quantization = info.config.quantization_config
+    if quantization is not None:
+        if isinstance(quantization, models.ScalarQuantization):
+            quantized = points * dim if quantization.scalar.always_ram is not False else 0
+        elif isinstance(quantization, models.BinaryQuantization):
+            quantized = points * dim // 8 if quantization.binary.always_ram is not False else 0
+    hnsw = info.config.hnsw_config
+    graph = 0 if hnsw.on_disk else points * hnsw.m * 2 * 4
+    total = int((vectors_in_ram + quantized + graph) * 1.5)
+    return {
+        'points': points,
+        'vectors_bytes': vectors_in_ram,
+        'quantized_bytes': quantized,
+        'hnsw_bytes': graph,
+        'payload_on_disk': bool(params.on_disk_payload),
+        # 1.5 = overhead for metadata, indexes and segment optimization
+        'estimated_ram_mb': round(total / 1024 ** 2, 1)
+    }
+
+
+def measure_search_latency(client, collection_name, query_vectors, top_k: int = 2, profile=None, query_filter=None):
+    """
+    Measure the search latency for a list of query vectors
+    :param client:
+    :param collection_name:
+    :param query_vectors:
+    :param top_k:
+    :param profile:
+    :param query_filter:
+    :return:
+    """
+    params = search_params(profile)
+    latencies = []
+    for vector in query_vectors:
+        start = time.perf_counter()
+        if hasattr(client, 'query_points'):
+            client.query_points(
+                collection_name=collection_name,
+                query=vector,
+                limit=top_k,
+                search_params=params,
+                query_filter=query_filter
+            )
+        else:
+            # qdrant-client < 1.10
+            client.search(
+                collection_name=collection_name,
+                query_vector=vector,
+                limit=top_k,
+                search_params=params,
+                query_filter=query_filter
+            )
+        latencies.append((time.perf_counter() - start) * 1000)
+    latencies = np.asarray(latencies)
+    return {
+        'queries': len(latencies),
+        'p50_ms': round(float(np.percentile(latencies, 50)), 2),
+        'p95_ms': round(float(np.percentile(latencies, 95)), 2),
+        'mean_ms': round(float(latencies.mean()), 2)
+    }
+
+
+def grpc_options(retries: int = VECTOR_STORE_RETRIES, keepalive_ms: int = 30000):
+    """
+    Get the gRPC channel options: keep-alive pings and retries of unavailable calls
+    :param retries: gRPC allows at most 4 retries (5 attempts)
+    :param keepalive_ms:
+    :return:
+    """
+    options = {
+        'grpc.keepalive_time_ms': keepalive_ms,
+        'grpc.keepalive_timeout_ms': 10000,
+        'grpc.keepalive_permit_without_calls': 1,
+        'grpc.http2.max_pings_without_data': 0,
+        # search results with payloads can be larger than the default 4 MB
+        'grpc.max_receive_message_length': 64 * 1024 ** 2
+    }
+    if retries:
+        options['grpc.enable_retries'] = 1
+        options['grpc.service_config'] = json.dumps({
+            'methodConfig': [{
+                'name': [{'service': 'qdrant.Points'}, {'service': 'qdrant.Collections'}],
+                'retryPolicy': {
+                    'maxAttempts': min(retries + 1, 5),
+                    'initialBackoff': "0.1s",
+                    'maxBackoff': "2s",
+                    'backoffMultiplier': 2,
+                    'retryableStatusCodes': ["UNAVAILABLE"]
+                }
+            }]
+        })
+    return options
+
+
+class QdrantConnections:
+    """
+    Process-wide Qdrant clients, one per connection setting.
+    The sync client is thread-safe and shared by all callers,
+    an async client is bound to the event loop it was created in, so there is one per loop.
+    Streamlit runs every rerun of chatbot.py in a new loop, the async clients are closed with aclose at the end of
+    the run and the clients of loops closed without it are dropped.
+    """
+
+    def __init__(
+            self,
+            host: str = VECTOR_STORE_HOST,
+            port: int = VECTOR_STORE_PORT,
+            grpc_port: int = VECTOR_STORE_GRPC_PORT,
+            prefer_grpc: bool = VECTOR_STORE_PREFER_GRPC,
+            timeout: int = VECTOR_STORE_TIMEOUT,
+            retries: int = VECTOR_STORE_RETRIES):
+        self.settings = {
+            'host': host,
+            'port': port,
+            'grpc_port': grpc_port,
+            'prefer_grpc': prefer_grpc,
+            'timeout': timeout
+        }
+        self.retries = retries
+        self.__lock = threading.Lock()
+        self.__clients = {}
+        self.__async_clients = {}
+
+    def __key(self, overrides):
+        settings = {**self.settings, **overrides}
+        return tuple(sorted(settings.items())), settings
+
+    def client(self, **overrides):
+        """
+        Get the shared sync client
+        :param overrides: connection settings that differ from the defaults, e.g. prefer_grpc=False
+        :return:
+        """
+        key, settings = self.__key(overrides)
+        with self.__lock:
+            if key not in self.__clients:
+                self.__clients[key] = qdrant_client.QdrantClient(
+                    grpc_options=grpc_options(self.retries) if settings['prefer_grpc'] else None,
+                    **settings
+                )
+                logger.info(f"Opened Qdrant client {settings}")
+            return self.__clients[key]
+
+    def async_client(self, loop=None, **overrides):
+        """
+        Get the async client of an event loop, by default the running loop (e.g. the one of chatbot.py's main)
+        :param loop:
+        :param overrides:
+        :return:
+        """
+        loop = loop or asyncio.get_event_loop()
+        key, settings = self.__key(overrides)
+        with self.__lock:
+            # closed loops are dropped, their clients cannot be used or awaited anymore
+            for stale in [stale for stale in self.__async_clients if stale[0].is_closed()]:
+                del self.__async_clients[stale]
+                logger.debug("Dropped the async Qdrant client of a closed event loop")
+            if (loop, key) not in self.__async_clients:
+                self.__async_clients[(loop, key)] = qdrant_client.AsyncQdrantClient(
+                    grpc_options=grpc_options(self.retries) if settings['prefer_grpc'] else None,
+                    **settings
+                )
+                logger.info(f"Opened async Qdrant client {settings}")
+            return self.__async_clients[(loop, key)]
+
+    def close(self):
+        """
+        Close the sync clients, the async clients are closed with aclose in their loop
+        :return:
+        """
+        with self.__lock:
+            clients, self.__clients = list(self.__clients.values()), {}
+        for client in clients:
+            client.close()
+
+    async def aclose(self):
+        """
+        Close the async clients of the running loop
+        :return:
+        """
+        loop = asyncio.get_running_loop()
+        with self.__lock:
+            keys = [key for key in self.__async_clients if key[0] is loop]
+            clients = [self.__async_clients.pop(key) for key in keys]
+        for client in clients:
+            await client.close()
+
+
+_connections = QdrantConnections()
+atexit.register(_connections.close)
+
+
+def get_qdrant_client(**overrides):
+    """
+    Get the process-wide sync Qdrant client
+    :param overrides:
+    :return:
+    """
+    return _connections.client(**overrides)
+
+
+def get_async_qdrant_client(loop=None, **overrides):
+    """
+    Get the process-wide async Qdrant client of the current event loop
+    :param loop:
+    :param overrides:
+    :return:
+    """
+    return _connections.async_client(loop=loop, **overrides)
+
+
+async def close_async_qdrant_clients():
+    """
+    Close the async Qdrant clients of the running event loop, before the loop ends
+    :return:
+    """
+    await _connections.aclose()
+
+
+def create_vector_store(collection_name, use_async: bool = False, **kwargs):
+    """
+    Create a QdrantVectorStore on the shared clients
+    :param collection_name:
+    :param use_async: also pass the async client of the current event loop for aretrieve/aquery,
+        the vector store is bound to that loop and must not be shared across loops
+    :param kwargs: further QdrantVectorStore arguments
+    :return:
+    """
+    if use_async:
+        kwargs['aclient'] = get_async_qdrant_client()
+    return QdrantVectorStore(client=get_qdrant_client(), collection_name=collection_name, **kwargs)
+
+
+def load_qdrant_index(collection_name, embed_model, use_async: bool = False):
+    """
+    Open an existing collection as index on the shared clients,
+    used instead of a new client per index in the chatbot and the evaluation scripts
+    :param collection_name:
+    :param embed_model:
+    :param use_async: bind the index to the async client of the current event loop, see create_vector_store
+    :return:
+    """
+    return VectorStoreIndex.from_vector_store(
+        create_vector_store(collection_name, use_async=use_async),
+        embed_model=embed_model,
+        use_async=use_async
+    )
+
+
+def node_to_point(node, embedding, sparse_vector=None):
+    """
+    Create a point with the payload QdrantVectorStore writes, so load_index can read bulk loaded collections
+    :param node:
+    :param embedding:
+    :param sparse_vector: BM25 vector of hybrid collections, stored next to the unnamed dense vector
+    :return:
+    """
+    return models.PointStruct(
+        id=node.node_id,
+        vector={"": embedding, SPARSE_VECTOR_NAME: sparse_vector} if sparse_vector is not None else embedding,
+        payload=node_to_metadata_dict(node, remove_text=False, flat_metadata=False)
+    )
+
+
+def bulk_upload(
+        client,
+        collection_name,
+        points,
+        profile=None,
+        batch_size: int = 256,
+        parallel: int = 4,
+        wait_for_index: bool = False):
+    """
+    Upload a stream of points: indexing is disabled during the load, the upload batches are sent
+    by parallel workers without waiting for their application, and indexing is enabled once at the end
+    :param client:
+    :param collection_name:
+    :param points: iterable of PointStruct, e.g. a generator that embeds the nodes window by window
+    :param profile: collection profile, default "default"
+    :param batch_size:
+    :param parallel: worker processes of upload_points (1 for a local or in-memory client)
+    :param wait_for_index: wait until the collection is indexed
+    :return: stats
+    """
+    iterator = iter(points)
+    first = next(iterator, None)
+    if first is None:
+        return {'points': 0}
+    vector = first.vector[""] if isinstance(first.vector, dict) else first.vector
+    apply_collection_profile(client, collection_name, len(vector), profile or 'default')
+    indexing_threshold = client.get_collection(collection_name).config.optimizer_config.indexing_threshold
+    client.update_collection(
+        collection_name=collection_name,
+        optimizers_config=models.OptimizersConfigDiff(indexing_threshold=0)
+    )
+
+    uploaded = 0
+
+    def counted(stream):
+        nonlocal uploaded
+        for point in stream:
+            uploaded += 1
+            yield point
+
+    start = time.perf_counter()
+    try:
+        client.upload_points(
+            collection_name=collection_name,
+            points=counted(chain([first], iterator)),
+            batch_size=batch_size,
+            parallel=parallel,
+            wait=False
+        )
+    finally:
+        # enabling indexing again starts the optimization of the loaded segments
+        client.update_collection(
+            collection_name=collection_name,
+            optimizers_config=models.OptimizersConfigDiff(
+                indexing_threshold=indexing_threshold or DEFAULT_INDEXING_THRESHOLD
+            )
+        )
+    upload_seconds = time.perf_counter() - start
+
+    if wait_for_index:
+        while client.get_collection(collection_name).status != models.CollectionStatus.GREEN:
+            time.sleep(1)
+    stats = {
+        'points': uploaded,
+        'upload_seconds': round(upload_seconds, 2),
+        'points_per_second': round(uploaded / upload_seconds, 1) if upload_seconds else None,
+        'total_seconds': round(time.perf_counter() - start, 2)
+    }
+    logger.info(f"Bulk upload to {collection_name}: {stats}")
+    return stats
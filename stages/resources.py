@@ -0,0 +1,390 @@
+import asyncio
+import importlib
+import logging
+import sys
+import threading
+import time
+from typing import Optional
+
+from utils.config import INDEX_COLLECTION_NAME, ROOT_DIR
+
+# Sources:
+# https://docs.streamlit.io/develop/concepts/architecture/caching#stcache_resource
+# https://docs.python.org/3/library/importlib.html#importlib.import_module
+# https://github.com/ollama/ollama/blob/main/docs/faq.md#how-can-i-preload-a-model-into-ollama-to-get-faster-response-times
+
+"""
+The ChatResources class holds the heavy chatbot resources once per process
+- Lazy imports of torch, llama_index and the model clients, so the page renders before they are loaded
+- LLM client, embedding model, index, known titles, node postprocessors, prompts and answer cache
+  built once and shared by all sessions and reruns
+- Chat engine of a session run: condense plus context over the self-querying retriever, wrapped by the answer cache
+- Background warm-up thread started on the first run of the app
+- Build times and time-to-first-response measurements
+"""
+
+logger = logging.getLogger(__name__)
+
+CHAT_MODE = "condense_plus_context"
+PROMPT_FILES = {
+    'system_prompt': "system_prompt.txt",
+    'context_prompt': "context_prompt.txt",
+    'condense_prompt': "condense_prompt.txt"
+}
+
+# concurrent first imports of the same packages from the warm-up and a session can deadlock on the module locks
+_import_lock = threading.RLock()
+
+
+def lazy_import(name):
+    """
+    Import a module on first use, one import at a time
+    :param name:
+    :return:
+    """
+    with _import_lock:
+        return importlib.import_module(name)
+
+
+def running_loop():
+    """
+    Get the running event loop, None outside of a coroutine
+    :return:
+    """
+    try:
+        return asyncio.get_running_loop()
+    except RuntimeError:
+        return None
+
+
+def llm_settings(llm):
+    """
+    Get the Ollama settings of an LLM
+    :param llm:
+    :return:
+    """
+    settings = {
+        'request_timeout': 60.0,
+        'temperature': 1,
+        'context_window': 4096
+    }
+    if llm == "mistral":
+        settings['context_window'] = 8192
+    elif llm == "llama2":
+        settings['request_timeout'] = 30.0
+    return settings
+
+
+class ChatResources:
+    """
+    Process-wide resources of the chatbot.
+    Every resource is built by the first caller, concurrent callers wait for it instead of building it again.
+    """
+
+    def __init__(self, collection_name=INDEX_COLLECTION_NAME, db: str = "qdrant"):
+        self.collection_name = collection_name
+        self.db = db
+        self.created = time.perf_counter()
+        self.build_seconds = {}
+        self.first_response_seconds = None
+        self.responses = []
+        self.__resources = {}
+        self.__locks = {}
+        self.__lock = threading.Lock()
+        self.__warm_up_thread = None
+
+    def __get(self, key, build):
+        """
+        Get a resource, building it once
+        :param key:
+        :param build:
+        :return:
+        """
+        resource = self.__resources.get(key)
+        if resource is not None:
+            return resource
+        with self.__lock:
+            lock = self.__locks.setdefault(key, threading.Lock())
+        with lock:
+            if key not in self.__resources:
+                start = time.perf_counter()
+                self.__resources[key] = build()
+                self.build_seconds[str(key)] = round(time.perf_counter() - start, 3)
+                logger.info(f"Built {key} in {self.build_seconds[str(key)]}s")
+            return self.__resources[key]
+
+    def peek(self, key):
+        """
+        Get a resource if it is built, without building it
+        :param key: e.g. 'answer_cache'
+        :return: resource or None
+        """
+        return self.__resources.get(key)
+
+    def llm(self, name):
+        """
+        Get the Ollama client of an LLM
+        :param name:
+        :return:
+        """
+        def build():
+            ollama = lazy_import("llama_index.llms.ollama")
+            return ollama.Ollama(model=name, **llm_settings(name))
+
+        return self.__get(('llm', name), build)
+
+    def embed_model(self):
+        """
+        Get the embedding model, importing torch on first use
+        :return:
+        """
+        def build():
+            return lazy_import("stages.embedding").load_embed_model()
+
+        return self.__get('embed_model', build)
+
+    def index(self, collection_name=None, db=None):
+        """
+        Get the index of a stored collection
+        :param collection_name:
+        :param db: qdrant or local
+        :return:
+        """
+        collection_name = collection_name or self.collection_name
+        db = db or self.db
+
+        def build():
+            if db == "qdrant":
+                return lazy_import("stages.qdrant").load_qdrant_index(collection_name, self.embed_model())
+            if db == "local":
+                return lazy_import("stages.local_store").load_local_index(
+                    f"{ROOT_DIR}/data/storage/{collection_name}", self.embed_model()
+                )
+            raise ValueError(f"Database {db} not supported for the chatbot index")
+
+        return self.__get(('index', db, collection_name), build)
+
+    def retriever(self, similarity_top_k: int = 2, self_query: bool = True, mode: str = "dense",
+                  postprocess: bool = True, use_async: Optional[bool] = None):
+        """
+        Get a retriever of the index, with self_query the questions are filtered by their constraints
+        :param similarity_top_k:
+        :param self_query: filter by year, title, genre and origin named in the question
+        :param mode: dense, or sparse and hybrid for qdrant collections stored with Storing(hybrid=True)
+        :param postprocess: apply the node_postprocessors, False for a chat engine that is given them itself
+        :param use_async: search a qdrant collection with the async client of the current event loop,
+            for aretrieve and astream_chat, by default when called in a running loop.
+            The retriever is bound to the loop, build it again in every run of the chatbot.
+        :return:
+        """
+        if use_async is None:
+            use_async = running_loop() is not None
+        retriever = self.__retriever(similarity_top_k, self_query, mode, use_async)
+        node_postprocessors = self.node_postprocessors() if postprocess else []
+        if not node_postprocessors:
+            return retriever
+        return lazy_import("stages.chunking").PostprocessedRetriever(retriever, node_postprocessors)
+
+    def __retriever(self, similarity_top_k, self_query, mode, use_async):
+        index = self.index()
+        if use_async and self.db == "qdrant" and mode == "dense":
+            # the shared index has no async client, an index over the shared clients is cheap to open per loop
+            index = lazy_import("stages.qdrant").load_qdrant_index(
+                self.collection_name, self.embed_model(), use_async=True
+            )
+        titles = self.titles() if self_query else None
+        if mode != "dense":
+            if self.db != "qdrant":
+                raise ValueError(f"Search mode {mode} is only supported for qdrant")
+            return lazy_import("stages.hybrid").HybridRetriever(
+                index.vector_store.client,
+                self.collection_name,
+                self.embed_model(),
+                similarity_top_k=similarity_top_k,
+                mode=mode,
+                self_query=self_query,
+                titles=titles
+            )
+        if not self_query:
+            return index.as_retriever(similarity_top_k=similarity_top_k)
+        return lazy_import("stages.self_query").SelfQueryRetriever(
+            index, similarity_top_k=similarity_top_k, titles=titles
+        )
+
+    def node_postprocessors(self):
+        """
+        Get the node postprocessors of the collection, for the chat engine (node_postprocessors=...).
+        Collections chunked by the MovieNodeParser get their movie headers reattached to the plot chunks.
+        :return:
+        """
+        def build():
+            chunking = lazy_import("stages.chunking")
+            vector_store = self.index().vector_store
+            if not chunking.has_header_nodes(vector_store):
+                return ()
+            return (chunking.MovieHeaderPostprocessor(vector_store=vector_store),)
+
+        # a copy, callers can add their own postprocessors
+        return list(self.__get(('node_postprocessors', self.db, self.collection_name), build))
+
+    def titles(self):
+        """
+        Get the known titles of the collection for the self-querying retrieval
+        :return:
+        """
+        self_query_module = lazy_import("stages.self_query")
+        return self.__get(
+            ('titles', self.db, self.collection_name),
+            lambda: self_query_module.TitleIndex(self_query_module.collection_titles(self.index().vector_store))
+        )
+
+    def prompts(self):
+        """
+        Get the prompts of the chat engine from the prompt_templates directory
+        :return:
+        """
+        def build():
+            prompts = {}
+            for name, file_name in PROMPT_FILES.items():
+                with open(f"{ROOT_DIR}/prompt_templates/{file_name}", encoding="utf-8") as file:
+                    prompts[name] = file.read().strip()
+            return prompts
+
+        return self.__get('prompts', build)
+
+    def chat_engine(self, llm, memory):
+        """
+        Build the chat engine of a session.
+        It is built again in every run of the chatbot, its retriever is bound to the event loop of the run,
+        the chat history is kept in the memory of the session.
+        :param llm:
+        :param memory: chat memory of the session, see chat_memory
+        :return: CachedChatEngine
+        """
+        chat_engines = lazy_import("llama_index.core.chat_engine")
+        answer_cache = lazy_import("stages.answer_cache")
+        prompts = self.prompts()
+        chat_engine = chat_engines.CondensePlusContextChatEngine.from_defaults(
+            retriever=self.retriever(postprocess=False),
+            llm=self.llm(llm),
+            memory=memory,
+            node_postprocessors=self.node_postprocessors(),
+            **prompts
+        )
+        scope = answer_cache.AnswerCache.scope(llm, self.collection_name, prompts['system_prompt'], CHAT_MODE)
+        return answer_cache.CachedChatEngine(chat_engine, self.answer_cache(), scope)
+
+    def chat_memory(self, llm):
+        """
+        Create the chat memory of a session, limited to a quarter of the context window of the LLM
+        :param llm:
+        :return:
+        """
+        memory = lazy_import("llama_index.core.memory")
+        return memory.ChatMemoryBuffer.from_defaults(token_limit=llm_settings(llm)['context_window'] // 4)
+
+    def answer_cache(self):
+        """
+        Get the answer cache shared by all sessions
+        :return:
+        """
+        def build():
+            return lazy_import("stages.answer_cache").AnswerCache(embed_model=self.embed_model())
+
+        return self.__get('answer_cache', build)
+
+    def warm_up(self, llm=None):
+        """
+        Build the resources in a background thread, once per process.
+        The LLM is loaded into Ollama with a one token completion.
+        :param llm:
+        :return:
+        """
+        with self.__lock:
+            if self.__warm_up_thread is not None:
+                return self.__warm_up_thread
+            self.__warm_up_thread = threading.Thread(target=self.__warm_up, args=(llm,), name="warm-up", daemon=True)
+        self.__warm_up_thread.start()
+        return self.__warm_up_thread
+
+    def __warm_up(self, llm):
+        start = time.perf_counter()
+        try:
+            self.index()
+            self.node_postprocessors()
+            self.answer_cache()
+            if llm is not None:
+                # the kwargs replace the keys of the request payload of llama-index-llms-ollama,
+                # so the options are sent in full, Ollama reloads the model for another num_ctx
+                client = self.llm(llm)
+                options = {
+                    'temperature': client.temperature,
+                    'num_ctx': client.context_window,
+                    **(client.additional_kwargs or {}),
+                    'num_predict': 1
+                }
+                client.complete("Hi", options=options)
+        except Exception as e:
+            # the resources are built again on demand
+            logger.warning(f"Warm-up failed: {e}")
+        self.build_seconds['warm_up'] = round(time.perf_counter() - start, 3)
+        logger.info(f"Warm-up finished in {self.build_seconds['warm_up']}s")
+
+    async def close_loop_clients(self):
+        """
+        Close the async clients of the running event loop, at the end of every chatbot run
+        :return:
+        """
+        if self.db == "qdrant" and "stages.qdrant" in sys.modules:
+            await sys.modules["stages.qdrant"].close_async_qdrant_clients()
+
+    @property
+    def warm(self):
+        return self.__warm_up_thread is not None and not self.__warm_up_thread.is_alive()
+
+    def record_response(self, session_started, seconds=None):
+        """
+        Record the first response of a session, relative to the session and the process start
+        :param session_started: perf_counter value at the start of the session
+        :param seconds: latency of the response, optional
+        :return:
+        """
+        now = time.perf_counter()
+        if self.first_response_seconds is None:
+            self.first_response_seconds = round(now - self.created, 3)
+        self.responses.append({
+            'session_seconds': round(now - session_started, 3),
+            'response_seconds': round(seconds, 3) if seconds is not None else None,
+            'warm': self.warm
+        })
+
+    def stats(self):
+        """
+        Get the build times and time-to-first-response
+        :return:
+        """
+        session_seconds = [response['session_seconds'] for response in self.responses]
+        return {
+            'warm': self.warm,
+            'build_seconds': dict(self.build_seconds),
+            'process_first_response_seconds': self.first_response_seconds,
+            'sessions': len(self.responses),
+            'mean_session_first_response_seconds':
+                round(sum(session_seconds) / len(session_seconds), 3) if session_seconds else None
+        }
+
+
+_resources = None
+_resources_lock = threading.Lock()
+
+
+def get_resources():
+    """
+    Get the process-wide chatbot resources, Streamlit reruns only the script and keeps this module
+    :return:
+    """
+    global _resources
+    with _resources_lock:
+        if _resources is None:
+            _resources = ChatResources()
+        return _resources
@@ -0,0 +1,365 @@
+import logging
+import re
+import time
+from typing import List, Optional
+
+from llama_index.core.retrievers import BaseRetriever
+from llama_index.core.schema import NodeWithScore, QueryBundle
+from llama_index.core.vector_stores.types import FilterOperator, MetadataFilter, MetadataFilters
+from qdrant_client.http import models
+
+# Sources:
+# https://docs.llamaindex.ai/en/stable/examples/vector_stores/Qdrant_metadata_filter/
+# https://python.langchain.com/v0.1/docs/modules/data_connection/retrievers/self_query/
+# https://qdrant.tech/documentation/concepts/filtering/
+# https://qdrant.tech/documentation/concepts/indexing/#full-text-index
+
+"""
+The self_query module narrows the retrieval with the constraints named in a question
+- Extract the release year, a year range or decade, the title, the genre and the origin of a question
+- Translate them to metadata filters on the payload Loading attaches (release_year, title, genre, origin_ethnicity)
+- Filtered retriever for the Qdrant and the local vector store, unfiltered fallback if nothing matches
+- Compare the precision and latency of filtered and unfiltered retrieval on the evaluation questions
+"""
+
+logger = logging.getLogger(__name__)
+
+MIN_YEAR = 1900
+MAX_YEAR = 2030
+
+GENRES = (
+    "action", "adventure", "animated", "animation", "biographical", "biography", "comedy", "crime", "disaster",
+    "documentary", "drama", "family", "fantasy", "horror", "musical", "mystery", "romance", "romantic comedy",
+    "science fiction", "sci-fi", "sports", "spy", "superhero", "suspense", "teen", "thriller", "war", "western"
+)
+# origin_ethnicity values of the Wikipedia movie plots
+ORIGINS = (
+    "American", "Australian", "Bangladeshi", "Bengali", "Bollywood", "British", "Canadian", "Chinese", "Egyptian",
+    "Filipino", "Hong Kong", "Japanese", "Kannada", "Malayalam", "Malaysian", "Maldivian", "Marathi", "Punjabi",
+    "Russian", "South Korean", "Tamil", "Telugu", "Turkish"
+)
+
+_year = r"((?:19|20)\d{2})"
+_decade = r"(?:((?:19|20)\d0)'?s|'?(\d0)s)"
+_movie = r"(?:movies?|films?|pictures?)"
+# a year only counts with a cue that it is the release year, "set in the 1930s" is about the plot
+_year_patterns = [
+    re.compile(rf"\b(?:released|came out|premiered|made|produced)\s+(?:in\s+|during\s+)?{_year}\b", re.I),
+    re.compile(rf"\({_year}\)"),
+    re.compile(rf"\b{_year}\s+{_movie}\b", re.I),
+    re.compile(rf"\b{_movie}\s+(?:from|of)\s+{_year}\b", re.I),
+]
+_decade_patterns = [
+    re.compile(rf"\b(?:released|came out|made|produced)\s+(?:in\s+|during\s+)?(?:the\s+)?{_decade}", re.I),
+    re.compile(rf"\b{_movie}\s+(?:from|of)\s+(?:the\s+)?{_decade}", re.I),
+    re.compile(rf"(?:^|\s){_decade}\s+{_movie}\b", re.I),
+]
+_range = rf"(?:between\s+{_year}\s+and\s+{_year}|(?:from\s+)?{_year}\s*(?:[-–]|to|until|through)\s*{_year})"
+# a range needs the same release cue as a single year, "set 1939-1945" is the time of the story
+_range_patterns = [
+    re.compile(rf"\b(?:released|came out|premiered|made|produced)\s+(?:in\s+|during\s+)?{_range}\b", re.I),
+    re.compile(rf"\b{_movie}\s+(?:released\s+|made\s+)?{_range}\b", re.I),
+    re.compile(rf"\({_year}\s*[-–]\s*{_year}\)"),
+    re.compile(rf"(?:^|\s){_year}\s*[-–]\s*{_year}\s+{_movie}\b", re.I),
+]
+_bound_pattern = re.compile(rf"\b(?:released\s+)?(before|after|since|prior to)\s+{_year}\b", re.I)
+_title_pattern = re.compile(r"[\"“”]([^\"“”]{2,120})[\"“”]")
+_genre_pattern = re.compile(
+    rf"\b({'|'.join(re.escape(genre) for genre in sorted(GENRES, key=len, reverse=True))})\s+{_movie}\b", re.I
+)
+_origin_pattern = re.compile(
+    rf"\b({'|'.join(re.escape(origin) for origin in sorted(ORIGINS, key=len, reverse=True))})\s+{_movie}\b", re.I
+)
+_normalize_pattern = re.compile(r"[^\w\s]")
+# n-grams like "a scary movie" or "disaster film" read as descriptions, not as titles
+_generic_last_words = frozenset(("movie", "movies", "film", "films", "picture", "pictures"))
+_generic_first_words = frozenset(("a", "an"))
+
+
+def normalize_title(title):
+    return " ".join(_normalize_pattern.sub(" ", title.lower()).split())
+
+
+class TitleIndex:
+    """
+    Lookup of the known titles in a question, for titles without quotes.
+    The normalized titles are matched as word n-grams, the longest match wins.
+    Generic n-grams (a/an ..., ... movie/film) only match when they are capitalized in the question.
+    """
+
+    def __init__(self, titles, min_words: int = 2):
+        self.min_words = min_words
+        self.__titles = {}
+        self.max_words = 0
+        for title in titles:
+            normalized = normalize_title(str(title))
+            if not normalized:
+                continue
+            self.__titles.setdefault(normalized, str(title))
+            self.max_words = max(self.max_words, len(normalized.split()))
+
+    def canonical(self, title):
+        """
+        Get the stored spelling of a title
+        :param title:
+        :return: title or None if unknown
+        """
+        return self.__titles.get(normalize_title(title))
+
+    def find(self, question):
+        """
+        Find the longest known title in a question.
+        Titles shorter than min_words are only matched quoted, "Rocky" or "Heat" are common words.
+        :param question:
+        :return:
+        """
+        # same tokens as normalize_title, with the case of the question
+        raw_words = _normalize_pattern.sub(" ", question).split()
+        words = [word.lower() for word in raw_words]
+        for size in range(min(self.max_words, len(words)), self.min_words - 1, -1):
+            for start in range(len(words) - size + 1):
+                title = self.__titles.get(" ".join(words[start:start + size]))
+                if title is None:
+                    continue
+                generic = words[start] in _generic_first_words or words[start + size - 1] in _generic_last_words
+                if generic and not all(word[0].isupper() for word in raw_words[start:start + size]):
+                    continue
+                return title
+        return None
+
+
+def collection_titles(vector_store, batch_size: int = 1000):
+    """
+    Get the titles stored in a Qdrant collection or a local vector store
+    :param vector_store:
+    :param batch_size:
+    :return:
+    """
+    titles = set()
+    if hasattr(vector_store, 'iter_records'):
+        for _, _, payloads in vector_store.iter_records(batch_size=batch_size):
+            titles.update(payload['title'] for payload in payloads if payload.get('title'))
+        return titles
+    client = getattr(vector_store, 'client', None)
+    if client is None or not hasattr(client, 'scroll'):
+        raise ValueError(f"Cannot read the titles of {type(vector_store).__name__}")
+    offset = None
+    while True:
+        points, offset = client.scroll(
+            collection_name=vector_store.collection_name,
+            limit=batch_size,
+            offset=offset,
+            with_payload=['title'],
+            with_vectors=False
+        )
+        titles.update(point.payload['title'] for point in points if point.payload.get('title'))
+        if offset is None:
+            return titles
+
+
+def parse_query(question, titles: Optional[TitleIndex] = None):
+    """
+    Extract the constraints of a question
+    :param question:
+    :param titles: known titles, optional
+    :return: dict with year, year_range (inclusive), title, genre and origin, only the found keys
+    """
+    constraints = {}
+    for pattern in _range_patterns:
+        match = pattern.search(question)
+        if match:
+            start, end = sorted(int(year) for year in match.groups() if year)
+            if MIN_YEAR <= start <= end <= MAX_YEAR:
+                constraints['year_range'] = (start, end)
+                break
+    if 'year_range' not in constraints:
+        for pattern in _decade_patterns:
+            match = pattern.search(question)
+            if match:
+                full, short = match.groups()
+                # '80s means the 1980s, '10s the 2010s
+                start = int(full) if full else (1900 if int(short) >= 30 else 2000) + int(short)
+                constraints['year_range'] = (start, start + 9)
+                break
+    if 'year_range' not in constraints:
+        for pattern in _year_patterns:
+            match = pattern.search(question)
+            if match and MIN_YEAR <= int(match.group(1)) <= MAX_YEAR:
+                constraints['year'] = int(match.group(1))
+                break
+    if 'year' not in constraints and 'year_range' not in constraints:
+        match = _bound_pattern.search(question)
+        if match:
+            bound, year = match.group(1).lower(), int(match.group(2))
+            constraints['year_range'] = (MIN_YEAR, year - 1) if bound in ("before", "prior to") \
+                else (year + (bound == "after"), MAX_YEAR)
+
+    match = _title_pattern.search(question)
+    if match:
+        title = match.group(1).strip()
+        constraints['title'] = (titles.canonical(title) if titles is not None else None) or title
+    elif titles is not None:
+        title = titles.find(question)
+        if title is not None:
+            constraints['title'] = title
+
+    match = _genre_pattern.search(question)
+    if match:
+        constraints['genre'] = match.group(1).lower()
+    match = _origin_pattern.search(question)
+    if match:
+        constraints['origin'] = next(origin for origin in ORIGINS if origin.lower() == match.group(1).lower())
+    return constraints
+
+
+def to_metadata_filters(constraints):
+    """
+    Translate the constraints to llama_index metadata filters, supported by Qdrant and the local vector store
+    :param constraints:
+    :return: filters or None without constraints
+    """
+    filters = []
+    if 'year' in constraints:
+        filters.append(MetadataFilter(key='release_year', value=constraints['year'], operator=FilterOperator.EQ))
+    if 'year_range' in constraints:
+        start, end = constraints['year_range']
+        filters.append(MetadataFilter(key='release_year', value=start, operator=FilterOperator.GTE))
+        filters.append(MetadataFilter(key='release_year', value=end, operator=FilterOperator.LTE))
+    if 'title' in constraints:
+        filters.append(MetadataFilter(key='title', value=constraints['title'], operator=FilterOperator.EQ))
+    if 'genre' in constraints:
+        filters.append(MetadataFilter(key='genre', value=constraints['genre'], operator=FilterOperator.TEXT_MATCH))
+    if 'origin' in constraints:
+        filters.append(MetadataFilter(key='origin_ethnicity', value=constraints['origin'], operator=FilterOperator.EQ))
+    return MetadataFilters(filters=filters) if filters else None
+
+
+def to_qdrant_filter(constraints):
+    """
+    Translate the constraints to a Qdrant filter, e.g. for measure_search_latency
+    :param constraints:
+    :return: filter or None without constraints
+    """
+    conditions = []
+    if 'year' in constraints:
+        conditions.append(models.FieldCondition(key='release_year', match=models.MatchValue(value=constraints['year'])))
+    if 'year_range' in constraints:
+        start, end = constraints['year_range']
+        conditions.append(models.FieldCondition(key='release_year', range=models.Range(gte=start, lte=end)))
+    if 'title' in constraints:
+        conditions.append(models.FieldCondition(key='title', match=models.MatchValue(value=constraints['title'])))
+    if 'genre' in constraints:
+        conditions.append(models.FieldCondition(key='genre', match=models.MatchText(text=constraints['genre'])))
+    if 'origin' in constraints:
+        conditions.append(
+            models.FieldCondition(key='origin_ethnicity', match=models.MatchValue(value=constraints['origin']))
+        )
+    return models.Filter(must=conditions) if conditions else None
+
+
+class SelfQueryRetriever(BaseRetriever):
+    """
+    Retriever that searches only the movies matching the constraints of the question.
+    A filter without results (e.g. a wrong title spelling) falls back to the unfiltered search.
+    """
+
+    def __init__(self, index, similarity_top_k: int = 2, titles: Optional[TitleIndex] = None, fallback: bool = True,
+                 **kwargs):
+        self.index = index
+        self.similarity_top_k = similarity_top_k
+        self.titles = titles
+        self.fallback = fallback
+        self.last_constraints = {}
+        self.last_fallback = False
+        super().__init__(**kwargs)
+
+    def _retrieve(self, query_bundle: QueryBundle) -> List[NodeWithScore]:
+        """
+        Retrieve with the metadata filters of the question
+        :param query_bundle:
+        :return:
+        """
+        self.last_constraints = parse_query(query_bundle.query_str, self.titles)
+        self.last_fallback = False
+        filters = to_metadata_filters(self.last_constraints)
+        if filters is not None:
+            results = self.index.as_retriever(
+                similarity_top_k=self.similarity_top_k,
+                filters=filters
+            ).retrieve(query_bundle)
+            if results or not self.fallback:
+                return results
+            self.last_fallback = True
+            logger.debug(f"No results for {self.last_constraints}, retrieving unfiltered")
+        return self.index.as_retriever(similarity_top_k=self.similarity_top_k).retrieve(query_bundle)
+
+    async def _aretrieve(self, query_bundle: QueryBundle) -> List[NodeWithScore]:
+        """
+        Retrieve with the metadata filters of the question, with the async client of the index
+        :param query_bundle:
+        :return:
+        """
+        self.last_constraints = parse_query(query_bundle.query_str, self.titles)
+        self.last_fallback = False
+        filters = to_metadata_filters(self.last_constraints)
+        if filters is not None:
+            results = await self.index.as_retriever(
+                similarity_top_k=self.similarity_top_k,
+                filters=filters
+            ).aretrieve(query_bundle)
+            if results or not self.fallback:
+                return results
+            self.last_fallback = True
+            logger.debug(f"No results for {self.last_constraints}, retrieving unfiltered")
+        return await self.index.as_retriever(similarity_top_k=self.similarity_top_k).aretrieve(query_bundle)
+
+
+def evaluation_queries(records):
+    """
+    Get the questions of the evaluation records with the title of their movie
+    :param records: e.g. llm_qna_to_context_gpt-3.5-turbo_100_random.json
+    :return: list of question and expected title
+    """
+    queries = []
+    for record in records:
+        title = next(
+            (line[len("title: "):] for line in record['context'].splitlines() if line.startswith("title: ")), None
+        )
+        if title is None:
+            continue
+        queries.extend((question, title) for question in record['questions'])
+    return queries
+
+
+def compare_retrievers(retrievers, queries, top_k: int = 2):
+    """
+    Measure the precision (share of retrieved chunks of the right movie), hit rate and latency of retrievers
+    :param retrievers: name -> retriever
+    :param queries: list of question and expected title, see evaluation_queries
+    :param top_k: retrieved chunks that are counted
+    :return:
+    """
+    report = {}
+    for name, retriever in retrievers.items():
+        hits = 0
+        relevant = 0
+        retrieved = 0
+        seconds = []
+        for question, title in queries:
+            start = time.perf_counter()
+            results = retriever.retrieve(question)[:top_k]
+            seconds.append(time.perf_counter() - start)
+            matches = sum(1 for result in results if result.node.metadata.get('title') == title)
+            relevant += matches
+            retrieved += len(results)
+            hits += matches > 0
+        seconds.sort()
+        report[name] = {
+            'queries': len(queries),
+            f"precision@{top_k}": round(relevant / retrieved, 4) if retrieved else 0,
+            f"hit_rate@{top_k}": round(hits / len(queries), 4) if queries else 0,
+            'mean_ms': round(1000 * sum(seconds) / len(seconds), 2) if seconds else None,
+            'p95_ms': round(1000 * seconds[int(0.95 * (len(seconds) - 1))], 2) if seconds else None
+        }
+    logger.info(f"Retriever comparison: {report}")
+    return report
@@ -0,0 +1,257 @@
+import hashlib
+import json
+import logging
+import tempfile
+import time
+import zipfile
+from pathlib import Path
+
+import numpy as np
+from llama_index.core.vector_stores.utils import metadata_dict_to_node
+from qdrant_client.http import models
+
+from stages.qdrant import SPARSE_VECTOR_NAME
+
+# Sources:
+# https://docs.python.org/3/library/zipfile.html#zipfile.ZipFile.open
+# https://numpy.org/doc/stable/reference/generated/numpy.frombuffer.html
+# https://qdrant.tech/documentation/concepts/points/#scroll-points
+# https://qdrant.tech/documentation/concepts/snapshots/
+
+"""
+The snapshot module exports a collection into a single file and restores it without embedding
+- Vectors as one binary float32/float16 array
+- Payloads in a columnar side file, one JSON line file per payload key
+- Manifest with the embed model, the chunk configuration and the hashes of all parts
+- Restore into Qdrant (bulk upload) or the local vector store
+"""
+
+logger = logging.getLogger(__name__)
+
+SNAPSHOT_VERSION = 1
+MANIFEST_FILE = "manifest.json"
+IDS_FILE = "ids.jsonl"
+VECTORS_FILE = "vectors"
+COLUMN_PREFIX = "payload/"
+
+# manifest keys that have to match the configuration of the importing Storing,
+# embed_namespace includes the backend, an onnx-int8 snapshot does not match an fp32 collection
+CONFIG_KEYS = ('embed_model', 'embed_namespace', 'chunk_size', 'overlap_size', 'node_parser')
+
+
+def iter_qdrant_records(client, collection_name, batch_size: int = 1000):
+    """
+    Iterate over all points of a collection in batches of ids, vectors and payloads
+    :param client:
+    :param collection_name:
+    :param batch_size:
+    :return:
+    """
+    offset = None
+    while True:
+        points, offset = client.scroll(
+            collection_name=collection_name,
+            limit=batch_size,
+            offset=offset,
+            with_payload=True,
+            with_vectors=True
+        )
+        if points:
+            yield (
+                [str(point.id) for point in points],
+                # the dense vector, sparse BM25 vectors of hybrid collections are recomputed on import
+                np.asarray(
+                    [point.vector[""] if isinstance(point.vector, dict) else point.vector for point in points],
+                    dtype=np.float32
+                ),
+                [point.payload for point in points]
+            )
+        if offset is None:
+            return
+
+
+def file_hash(file):
+    """
+    Hash a file object in blocks
+    :param file:
+    :return:
+    """
+    digest = hashlib.sha256()
+    for block in iter(lambda: file.read(1024 * 1024), b""):
+        digest.update(block)
+    return digest.hexdigest()
+
+
+def export_snapshot(records, path, config, dtype: str = "float32"):
+    """
+    Write the records of a collection into a snapshot file.
+    The parts are streamed into a temporary directory first, so only one batch is held in memory.
+    :param records: batches of ids, vectors and payloads (iter_qdrant_records or MemmapVectorStore.iter_records)
+    :param path:
+    :param config: embed model and chunk configuration of the collection
+    :param dtype: float32 or float16 vectors
+    :return: manifest
+    """
+    start = time.perf_counter()
+    path = Path(path)
+    path.parent.mkdir(parents=True, exist_ok=True)
+    with tempfile.TemporaryDirectory(dir=path.parent) as tmp_dir:
+        tmp_dir = Path(tmp_dir)
+        columns = {}
+        points = 0
+        dim = None
+        with (tmp_dir / IDS_FILE).open('w', encoding="utf-8") as ids_file, \
+                (tmp_dir / VECTORS_FILE).open('wb') as vectors_file:
+            for ids, vectors, payloads in records:
+                if dim is None:
+                    dim = vectors.shape[1]
+                for point_id in ids:
+                    ids_file.write(json.dumps(point_id) + "\n")
+                vectors_file.write(vectors.astype(dtype).tobytes())
+                # one line per point in every column, missing keys are null
+                for key in {key for payload in payloads for key in payload} - set(columns):
+                    columns[key] = (tmp_dir / f"column_{len(columns)}.jsonl").open('w', encoding="utf-8")
+                    columns[key].write("null\n" * points)
+                for key, column in columns.items():
+                    for payload in payloads:
+                        column.write(json.dumps(payload.get(key), default=str) + "\n")
+                points += len(ids)
+        for column in columns.values():
+            column.close()
+
+        parts = {IDS_FILE: tmp_dir / IDS_FILE, VECTORS_FILE: tmp_dir / VECTORS_FILE}
+        for key, column in columns.items():
+            parts[COLUMN_PREFIX + key] = Path(column.name)
+        hashes = {}
+        for name, part in parts.items():
+            with part.open('rb') as file:
+                hashes[name] = file_hash(file)
+        manifest = {
+            'version': SNAPSHOT_VERSION,
+            'created': time.time(),
+            'points': points,
+            'dim': dim,
+            'dtype': dtype,
+            'distance': "cosine",
+            'columns': sorted(columns),
+            'hashes': hashes,
+            **config
+        }
+
+        tmp_path = path.with_suffix(path.suffix + ".tmp")
+        with zipfile.ZipFile(tmp_path, 'w', allowZip64=True) as archive:
+            # the vectors do not compress, they are stored so they can be read without inflating
+            archive.write(parts[VECTORS_FILE], VECTORS_FILE, compress_type=zipfile.ZIP_STORED)
+            for name, part in parts.items():
+                if name != VECTORS_FILE:
+                    archive.write(part, name, compress_type=zipfile.ZIP_DEFLATED)
+            archive.writestr(MANIFEST_FILE, json.dumps(manifest, indent=2))
+        tmp_path.replace(path)
+
+    logger.info(
+        f"Exported {points} points to {path} ({path.stat().st_size / 1024 ** 2:.1f} MB) "
+        f"in {time.perf_counter() - start:.2f}s"
+    )
+    return manifest
+
+
+def read_manifest(path):
+    """
+    Read the manifest of a snapshot
+    :param path:
+    :return:
+    """
+    with zipfile.ZipFile(path) as archive:
+        return json.loads(archive.read(MANIFEST_FILE))
+
+
+def verify_snapshot(path, config=None):
+    """
+    Check the hashes of all parts and compare the manifest with the current configuration
+    :param path:
+    :param config: embed model and chunk configuration that have to match, None to skip the check
+    :return: manifest
+    """
+    manifest = read_manifest(path)
+    if manifest.get('version') != SNAPSHOT_VERSION:
+        raise ValueError(f"Snapshot version {manifest.get('version')} not supported")
+    if config is not None:
+        mismatches = {
+            key: (manifest.get(key), config.get(key))
+            for key in CONFIG_KEYS if key in config and manifest.get(key) != config[key]
+        }
+        if mismatches:
+            raise ValueError(f"Snapshot {path} does not match the configuration (snapshot, current): {mismatches}")
+    with zipfile.ZipFile(path) as archive:
+        for name, expected in manifest['hashes'].items():
+            with archive.open(name) as file:
+                if file_hash(file) != expected:
+                    raise ValueError(f"Snapshot {path} is corrupt, the hash of {name} does not match")
+    return manifest
+
+
+def iter_snapshot_records(path, batch_size: int = 1000):
+    """
+    Read the records of a snapshot in batches of ids, float32 vectors and payloads
+    :param path:
+    :param batch_size:
+    :return:
+    """
+    manifest = read_manifest(path)
+    dim = manifest['dim']
+    row_bytes = dim * np.dtype(manifest['dtype']).itemsize
+    with zipfile.ZipFile(path) as archive:
+        files = [archive.open(COLUMN_PREFIX + key) for key in manifest['columns']]
+        try:
+            with archive.open(IDS_FILE) as ids_file, archive.open(VECTORS_FILE) as vectors_file:
+                for start in range(0, manifest['points'], batch_size):
+                    count = min(batch_size, manifest['points'] - start)
+                    ids = [json.loads(ids_file.readline()) for _ in range(count)]
+                    vectors = np.frombuffer(vectors_file.read(count * row_bytes), dtype=manifest['dtype'])
+                    payloads = [{} for _ in range(count)]
+                    for key, file in zip(manifest['columns'], files):
+                        for payload in payloads:
+                            value = json.loads(file.readline())
+                            if value is not None:
+                                payload[key] = value
+                    yield ids, vectors.reshape(count, dim).astype(np.float32), payloads
+        finally:
+            for file in files:
+                file.close()
+
+
+def iter_snapshot_points(path, batch_size: int = 1000, sparse_encoder=None):
+    """
+    Read the snapshot as qdrant points
+    :param path:
+    :param batch_size:
+    :param sparse_encoder: BM25Encoder of a hybrid collection, the sparse vectors are computed from the node text
+    :return:
+    """
+    for ids, vectors, payloads in iter_snapshot_records(path, batch_size):
+        for point_id, vector, payload in zip(ids, vectors, payloads):
+            if sparse_encoder is None:
+                yield models.PointStruct(id=point_id, vector=vector.tolist(), payload=payload)
+                continue
+            sparse_vector = sparse_encoder.encode_node(metadata_dict_to_node(payload))
+            yield models.PointStruct(
+                id=point_id,
+                vector={"": vector.tolist(), SPARSE_VECTOR_NAME: sparse_vector},
+                payload=payload
+            )
+
+
+def iter_snapshot_nodes(path, batch_size: int = 1000):
+    """
+    Read the snapshot as batches of embedded nodes, e.g. for MemmapVectorStore.add
+    :param path:
+    :param batch_size:
+    :return:
+    """
+    for ids, vectors, payloads in iter_snapshot_records(path, batch_size):
+        nodes = []
+        for vector, payload in zip(vectors, payloads):
+            node = metadata_dict_to_node(payload)
+            node.embedding = vector.tolist()
+            nodes.append(node)
+        yield nodes
@@ -1,14 +1,47 @@
+import gc
+import logging
+import os
+import sys
+import time
+from itertools import islice
+
 import chromadb
 from llama_index.core import StorageContext, VectorStoreIndex
 from llama_index.core.callbacks import CallbackManager, LlamaDebugHandler
 from llama_index.core.ingestion import IngestionPipeline
 from llama_index.core.node_parser import SentenceSplitter
-from llama_index.embeddings.huggingface import HuggingFaceEmbedding
+from llama_index.core.schema import MetadataMode
 from llama_index.llms.ollama import Ollama
 from llama_index.vector_stores.chroma import ChromaVectorStore
 from llama_index.vector_stores.qdrant import QdrantVectorStore
-from qdrant_client import qdrant_client
 
+from stages.answer_cache import bump_collection_version
+from stages.checkpoint import IngestionCheckpoint
+from stages.chunking import MovieNodeParser, token_savings
+from stages.dedup import NearDuplicateFilter, merge_duplicate_sources
+from stages.docstore import DocumentHashStore, content_hash
+from stages.embedding import embedding_namespace, embedding_stats, load_embed_model
+from stages.hybrid import BM25Encoder, add_sparse_vectors
+from stages.local_store import MemmapVectorStore
+from stages.pipeline import StagedIngestion
+from stages.qdrant import (
+    apply_collection_profile,
+    bulk_upload,
+    estimate_ram,
+    get_collection_profile,
+    get_qdrant_client,
+    measure_search_latency,
+    node_to_point,
+    SPARSE_VECTOR_NAME
+)
+from stages.resources import llm_settings
+from stages.snapshot import (
+    export_snapshot,
+    iter_qdrant_records,
+    iter_snapshot_nodes,
+    iter_snapshot_points,
+    verify_snapshot
+)
 from utils.config import (
     DEBUG,
     INDEX_PERSIST_DIRECTORY,
@@ -17,11 +50,87 @@ from utils.config import (
     CACHE_DIR,
     DEVICE,
     INDEX_COLLECTION_NAME,
-    ROOT_DIR,
-    VECTOR_STORE_HOST,
-    VECTOR_STORE_PORT
+    ROOT_DIR
 )
 
+logger = logging.getLogger(__name__)
+
+
+def current_rss_mb():
+    """
+    Get the resident memory of the process in MB,
+    from /proc on Linux, otherwise the peak from getrusage, None if neither is available
+    :return:
+    """
+    try:
+        with open('/proc/self/statm') as file:
+            return int(file.read().split()[1]) * os.sysconf('SC_PAGE_SIZE') / 1024 ** 2
+    except (OSError, ValueError, AttributeError):
+        pass
+    try:
+        import resource
+    except ImportError:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # bytes on macOS, KB on Linux
+    return peak / 1024 ** 2 if sys.platform == 'darwin' else peak / 1024
+
+
+def store_data_multi(storings, documents, db, window_size: int = 1000):
+    """
+    Store the same documents in several collections (e.g. 512/50, 1024/100 and 2048/200) in one pass.
+    The documents are read once, chunked per configuration and every distinct chunk text
+    is embedded only once, before the nodes are written to their collections.
+    All storings should share the same embed model (Storing(embed_model=...)).
+    :param storings:
+    :param documents:
+    :param db:
+    :param window_size:
+    :return:
+    """
+    if any(storing.incremental for storing in storings):
+        raise ValueError("Multi-configuration ingestion does not support incremental mode")
+
+    embed_model = storings[0].embed_model
+    for storing in storings:
+        storing.open_vector_store(db)
+
+    iterator = iter(documents)
+    stats = {'documents': 0, 'nodes': 0, 'embedded': 0}
+    start = time.perf_counter()
+    while True:
+        window = list(islice(iterator, window_size))
+        if not window:
+            break
+
+        # chunk the window for every configuration
+        node_sets = [storing.create_nodes(window) for storing in storings]
+
+        # embed every distinct chunk text once
+        embeddings = {}
+        for nodes in node_sets:
+            for node in nodes:
+                embeddings.setdefault(node.get_content(metadata_mode=MetadataMode.EMBED), None)
+        texts = list(embeddings)
+        for text, embedding in zip(texts, embed_model.get_text_embedding_batch(texts, show_progress=DEBUG)):
+            embeddings[text] = embedding
+
+        # fan out to the collections
+        for storing, nodes in zip(storings, node_sets):
+            for node in nodes:
+                node.embedding = embeddings[node.get_content(metadata_mode=MetadataMode.EMBED)]
+            storing.write_nodes(nodes)
+
+        stats['documents'] += len(window)
+        stats['nodes'] += sum(len(nodes) for nodes in node_sets)
+        stats['embedded'] += len(texts)
+        logger.info(f"Stored {stats['documents']} documents in {len(storings)} collections")
+
+    stats['saved_embeddings'] = stats['nodes'] - stats['embedded']
+    stats['seconds'] = round(time.perf_counter() - start, 2)
+    logger.info(f"Multi-configuration ingestion: {stats}")
+    return stats
+
 
 class Storing:
     def __init__(
@@ -29,15 +138,73 @@ class Storing:
             chunk_size: int = CHUNK_SIZE,
             overlap_size: int = OVERLAP_SIZE,
             node_parser: bool = False,
-            collection_name: str = INDEX_COLLECTION_NAME):
+            collection_name: str = INDEX_COLLECTION_NAME,
+            window_size: int = 1000,
+            incremental: bool = False,
+            embedding_cache: bool = True,
+            embed_model=None,
+            embed_backend: str = "torch",
+            pipelined: bool = False,
+            pipeline_options: dict = None,
+            collection_profile=None,
+            local_dtype: str = "float32",
+            local_ivf_lists: int = None,
+            checkpoint: bool = False,
+            bulk: bool = False,
+            bulk_options: dict = None,
+            structured_chunking: bool = False,
+            memory_limit_mb: int = None,
+            min_window_size: int = 50,
+            dedup: bool = False,
+            dedup_threshold: float = 0.8,
+            hybrid: bool = False):
         self.debug = DEBUG
         self.async_mode = True
-        self.documents = None
-        self.nodes = None
         self.db = None
         self.llm = None
         self.testing = False
         self.vector_store = None
+        self.vector_size = None
+        self.client = None
+        # the local vector store keeps float32 or float16 vectors,
+        # an IVF index is built after the ingestion if local_ivf_lists is set (0 = sqrt of the number of nodes)
+        self.local_dtype = local_dtype
+        self.local_ivf_lists = local_ivf_lists
+        # name of a profile in stages.qdrant.COLLECTION_PROFILES or a profile dict
+        self.collection_profile = get_collection_profile(collection_profile)
+        # hybrid retrieval: BM25 sparse vectors next to the dense ones, qdrant only
+        self.hybrid = hybrid
+        self.sparse_encoder = BM25Encoder() if hybrid else None
+        if hybrid:
+            self.collection_profile = {
+                **(self.collection_profile or get_collection_profile('default')),
+                'sparse': SPARSE_VECTOR_NAME
+            }
+        # documents are processed in windows of at most window_size documents,
+        # with a memory limit the window shrinks when the process gets close to it and grows back below it
+        self.window_size = window_size
+        self.memory_limit_mb = memory_limit_mb
+        self.min_window_size = min(min_window_size, window_size)
+        self.incremental = incremental
+        self.docstore = None
+        self.docstore_directory = ROOT_DIR + "/data/docstore"
+        # write a checkpoint after every committed window and resume an interrupted run
+        self.checkpointing = checkpoint
+        self.checkpoint = None
+        self.checkpoint_directory = ROOT_DIR + "/data/checkpoints"
+        # initial loads into qdrant: stream the embedded points into upload_points, see stages.qdrant.bulk_upload
+        self.bulk = bulk
+        self.bulk_options = bulk_options or {}
+        self.bulk_stats = None
+        # collapse near-duplicate chunks before they are embedded, see stages.dedup
+        self.dedup = dedup
+        self.dedup_threshold = dedup_threshold
+        self.deduplicator = None
+        self.dedup_stats = None
+        # run splitting, embedding and writing as overlapping stages, see StagedIngestion for the options
+        self.pipelined = pipelined
+        self.pipeline_options = pipeline_options or {}
+        self.pipeline_stats = None
         self.device = DEVICE
         self.chunk_size = chunk_size
         self.overlap_size = overlap_size
@@ -45,31 +212,275 @@ class Storing:
         self.collection_name = collection_name
         self.local_persist_directory = ROOT_DIR + "/data/storage"
         self.index_persist_directory = INDEX_PERSIST_DIRECTORY
+        if not node_parser and structured_chunking:
+            # header node per movie and plot-only chunks, see stages.chunking
+            node_parser = MovieNodeParser(chunk_size=int(self.chunk_size), chunk_overlap=int(self.overlap_size))
         self.node_parser = node_parser or SentenceSplitter(
             chunk_size=int(self.chunk_size),
             chunk_overlap=int(self.overlap_size)
         )
-        self.embed_model = HuggingFaceEmbedding(
-            model_name="mixedbread-ai/mxbai-embed-large-v1",
+        # an embed model can be shared between several Storing instances
+        self.embed_model = embed_model or load_embed_model(
             cache_folder=self.em_cache_dir,
             device=self.device,
-            embed_batch_size=128
+            embed_batch_size=128,
+            cache=embedding_cache,
+            backend=embed_backend
         )
 
-    def store_data(self, documents, db, testing=False, llm=None):
-
-        # set the documents and db
-        self.documents = documents
-        self.db = db
+    def store_data(self, documents, db, testing=False, llm=None, total=None):
+        """
+        Store the documents in the vector store.
+        The documents (a list or any iterable, e.g. Loading.iter_documents) are consumed in windows:
+        every window is chunked, embedded and written before the next one is read,
+        nothing but the current window is kept.
+        In incremental mode only new and changed documents are stored
+        and the vectors of documents missing from the input are deleted.
+        With checkpoints every committed window is recorded and a rerun resumes after the last one.
+        :param documents:
+        :param db:
+        :param testing:
+        :param llm:
+        :param total: number of documents for the ETA, optional
+        :return:
+        """
         self.testing = testing
         if self.testing:
             self.llm = self.__set_llm(llm)
 
-        # set vector_store based on db parameter
-        self.__set_vector_store()
+        if self.checkpointing:
+            if self.pipelined:
+                raise ValueError("Pipelined ingestion does not support checkpoints")
+            self.checkpoint = IngestionCheckpoint(
+                f"{self.checkpoint_directory}/{self.collection_name}.json",
+                self.__checkpoint_config(db),
+                total=total
+            )
+
+        if self.dedup:
+            if self.incremental or self.pipelined:
+                # a deleted document could take the only stored copy of other documents' chunks with it
+                raise ValueError("Near-duplicate filtering does not support incremental or pipelined mode")
+            self.deduplicator = NearDuplicateFilter(threshold=self.dedup_threshold)
+
+        if self.hybrid and db != "qdrant":
+            raise ValueError("Hybrid retrieval is only supported for qdrant")
+
+        # set the db and vector_store based on db parameter
+        self.open_vector_store(db)
 
         # store the nodes in the vector store
-        self.__store_nodes(documents)
+        if self.bulk:
+            if self.db != "qdrant" or self.incremental or self.pipelined or self.checkpoint is not None:
+                raise ValueError(
+                    "Bulk loading is only supported for qdrant without incremental, pipelined or checkpoint mode"
+                )
+            self.bulk_stats = bulk_upload(
+                self.client,
+                self.collection_name,
+                self.__iter_points(documents),
+                profile=self.collection_profile,
+                **self.bulk_options
+            )
+        elif self.pipelined:
+            if self.incremental:
+                raise ValueError("Pipelined ingestion does not support incremental mode")
+            self.pipeline_stats = StagedIngestion(self, **self.pipeline_options).run(documents)
+        elif self.incremental:
+            self.__store_incremental(documents)
+        elif self.checkpoint is not None:
+            self.__store_windows(self.checkpoint.skip(documents))
+        else:
+            self.__store_windows(documents)
+
+        if self.deduplicator is not None:
+            try:
+                merge_duplicate_sources(self.vector_store, self.deduplicator.pending)
+            finally:
+                self.deduplicator.close()
+            self.dedup_stats = self.deduplicator.report()
+            logger.info(f"Near-duplicate filtering of {self.collection_name}: {self.dedup_stats}")
+        if self.db == "local" and self.local_ivf_lists is not None:
+            self.vector_store.build_ivf(n_lists=self.local_ivf_lists or None)
+        if self.checkpoint is not None:
+            self.checkpoint.finish()
+        # cached chatbot answers of the previous collection are dropped
+        bump_collection_version(self.collection_name)
+
+        stats = embedding_stats(self.embed_model)
+        if stats:
+            logger.info(f"Embedding stats of {self.collection_name}: {stats}")
+
+    def open_vector_store(self, db):
+        """
+        Set the db and create the vector store
+        :param db:
+        :return:
+        """
+        self.db = db
+        self.__set_vector_store()
+
+    def __checkpoint_config(self, db):
+        """
+        Get the settings that have to match to resume a checkpoint
+        :param db:
+        :return:
+        """
+        return {
+            'db': db,
+            'collection_name': self.collection_name,
+            'chunk_size': self.chunk_size,
+            'overlap_size': self.overlap_size,
+            'node_parser': type(self.node_parser).__name__,
+            'embed_model': self.embed_model.model_name,
+            'embed_namespace': embedding_namespace(self.embed_model),
+            'incremental': self.incremental,
+            'hybrid': self.hybrid
+        }
+
+    def __resuming(self):
+        """
+        Check if the stored vectors have to be kept, in incremental mode or when a checkpoint is resumed
+        :return:
+        """
+        return self.incremental or (self.checkpoint is not None and self.checkpoint.resumable)
+
+    def __store_windows(self, documents):
+        """
+        Consume an iterable of documents in bounded windows
+        :param documents:
+        :return:
+        """
+        stored = 0
+        resuming = self.checkpoint is not None and self.checkpoint.resumable
+        for window in self.__iter_windows(documents):
+            if resuming:
+                # the interrupted run can have written nodes of its uncommitted window, they have other ids
+                # than the new ones, the resumed window starts at its first document and is at least as large
+                for document in window:
+                    self.vector_store.delete(ref_doc_id=document.doc_id)
+                resuming = False
+            nodes = self.__store_nodes(window)
+            stored += len(window)
+            if self.checkpoint is not None:
+                self.checkpoint.commit(window, nodes)
+            else:
+                logger.info(f"Stored {stored} documents in {self.collection_name}")
+
+    def __iter_points(self, documents):
+        """
+        Split and embed the documents window by window and yield the qdrant points
+        :param documents:
+        :return:
+        """
+        stored = 0
+        for window in self.__iter_windows(documents):
+            nodes = self.create_nodes(window)
+            if self.deduplicator is not None:
+                nodes = self.deduplicator.filter(nodes)
+            start = time.perf_counter()
+            texts = [node.get_content(metadata_mode=MetadataMode.EMBED) for node in nodes]
+            embeddings = self.embed_model.get_text_embedding_batch(texts, show_progress=self.debug)
+            if self.deduplicator is not None and embeddings:
+                self.deduplicator.record_write(nodes, time.perf_counter() - start, len(embeddings[0]))
+            for node, embedding in zip(nodes, embeddings):
+                sparse_vector = self.sparse_encoder.encode_node(node) if self.hybrid else None
+                yield node_to_point(node, embedding, sparse_vector)
+            stored += len(window)
+            logger.info(f"Embedded {stored} documents for {self.collection_name}")
+
+    def __iter_windows(self, documents):
+        """
+        Split an iterable of documents into lists of at most window_size documents,
+        the size is adapted to the memory limit after every window
+        :param documents:
+        :return:
+        """
+        iterator = iter(documents)
+        window_size = self.window_size
+        while True:
+            window = list(islice(iterator, window_size))
+            if not window:
+                return
+            yield window
+            # release the stored window before the memory is measured
+            window = None
+            window_size = self.__adapt_window_size(window_size)
+
+    def __adapt_window_size(self, window_size):
+        """
+        Halve the window above 80% of the memory limit, grow it back below 50%
+        :param window_size:
+        :return:
+        """
+        if not self.memory_limit_mb:
+            return window_size
+        rss = current_rss_mb()
+        if rss is None:
+            return window_size
+        if rss > 0.8 * self.memory_limit_mb:
+            gc.collect()
+            adapted = max(self.min_window_size, window_size // 2)
+        elif rss < 0.5 * self.memory_limit_mb:
+            adapted = min(self.window_size, int(window_size * 1.5) + 1)
+        else:
+            adapted = window_size
+        if adapted != window_size:
+            logger.info(f"Window size {window_size} -> {adapted} at {rss:.0f} MB of {self.memory_limit_mb} MB")
+        return adapted
+
+    def __store_incremental(self, documents):
+        """
+        Store only new and changed documents, compared by their content hash,
+        and delete the vectors of documents that are no longer in the input
+        :param documents:
+        :return:
+        """
+        self.docstore = DocumentHashStore(f"{self.docstore_directory}/{self.collection_name}.json")
+        if self.db == "qdrant" and not self.vector_store.client.collection_exists(self.collection_name) \
+                or self.db == "local" and not self.vector_store.count():
+            # the collection was dropped, the stored hashes are no longer valid
+            self.docstore.hashes = {}
+        seen = set()
+        stats = {'new': 0, 'changed': 0, 'unchanged': 0, 'deleted': 0}
+
+        for window in self.__iter_windows(documents):
+            changed = []
+            hashes = {}
+            for document in window:
+                doc_id = document.doc_id
+                seen.add(doc_id)
+                hashes[doc_id] = content_hash(document)
+                stored_hash = self.docstore.get(doc_id)
+                if stored_hash == hashes[doc_id]:
+                    stats['unchanged'] += 1
+                    continue
+                if stored_hash is None:
+                    stats['new'] += 1
+                else:
+                    # remove the vectors of the old version
+                    self.vector_store.delete(ref_doc_id=doc_id)
+                    stats['changed'] += 1
+                changed.append(document)
+
+            nodes = 0
+            if changed:
+                nodes = self.__store_nodes(changed)
+                for document in changed:
+                    self.docstore.set(document.doc_id, hashes[document.doc_id])
+                self.docstore.persist()
+            if self.checkpoint is not None:
+                # the stored hashes already skip the committed documents, the checkpoint records the progress
+                self.checkpoint.commit(window, nodes)
+
+        # delete the documents that disappeared from the input
+        for doc_id in self.docstore.doc_ids() - seen:
+            self.vector_store.delete(ref_doc_id=doc_id)
+            self.docstore.remove(doc_id)
+            stats['deleted'] += 1
+        self.docstore.persist()
+
+        logger.info(f"Incremental ingestion of {self.collection_name}: {stats}")
 
     def __set_vector_store(self):
         """
@@ -80,14 +491,27 @@ class Storing:
             raise ValueError("Database not set")
 
         if self.db == "local":
-            return True
-        if self.db == "chromadb":
+            self.__create_local_vector_store()
+        elif self.db == "chromadb":
             self.__create_chroma_vector_store()
         elif self.db == "qdrant":
             self.__create_qdrant_vector_store()
         else:
             raise ValueError(f"Database {self.db} not supported when creating vector store")
 
+    def __create_local_vector_store(self):
+        """
+        Create a memory-mapped local vector store
+        :return:
+        """
+        self.vector_store = MemmapVectorStore(
+            f"{self.local_persist_directory}/{self.collection_name}",
+            dtype=self.local_dtype
+        )
+        if not self.__resuming():
+            # start from an empty store
+            self.vector_store.clear()
+
     def __create_chroma_vector_store(self):
         """
         Create a Chroma vector store
@@ -95,8 +519,14 @@ class Storing:
         """
         # self.__clean_persist_dir() 
         client = chromadb.PersistentClient(path=self.index_persist_directory)
-        client.reset()  # instead of cleaning the directory, reset the client
-        chroma_collection = client.create_collection(self.collection_name)
+        if self.__resuming():
+            # keep the stored vectors, only the changes or the rest of the run are written
+            chroma_collection = client.get_or_create_collection(self.collection_name)
+        else:
+            # only drop this collection, client.reset() would remove all collections
+            if self.collection_name in [collection.name for collection in client.list_collections()]:
+                client.delete_collection(self.collection_name)
+            chroma_collection = client.create_collection(self.collection_name)
         self.vector_store = ChromaVectorStore(
             chroma_collection=chroma_collection,
             path=self.index_persist_directory
@@ -109,10 +539,15 @@ class Storing:
         """
         llama_debug = LlamaDebugHandler(print_trace_on_end=DEBUG)
         callback_manager = CallbackManager(handlers=[llama_debug])
-        client = qdrant_client.QdrantClient(
-            host=VECTOR_STORE_HOST,
-            port=VECTOR_STORE_PORT
-        )
+        # the process-wide gRPC client is shared by all Storing instances
+        client = get_qdrant_client()
+        self.client = client
+        if self.checkpoint is not None and not self.__resuming() and client.collection_exists(self.collection_name):
+            # a new checkpointed run starts from an empty collection, the old one is from another or a partial run
+            client.delete_collection(self.collection_name)
+        if self.collection_profile is not None:
+            # create the collection with the profile before QdrantVectorStore creates a default one
+            apply_collection_profile(client, self.collection_name, self.__vector_size(), self.collection_profile)
         self.vector_store = QdrantVectorStore(
             client=client,
             collection_name=self.collection_name,
@@ -121,46 +556,80 @@ class Storing:
 
     def __store_nodes(self, documents):
         """
-        Store the nodes in the vector store
+        Split the documents and write their nodes to the vector store
         :param documents:
+        :return: number of written nodes
+        """
+        nodes = self.create_nodes(documents)
+        if self.deduplicator is None:
+            self.write_nodes(nodes)
+            return len(nodes)
+
+        nodes = self.deduplicator.filter(nodes)
+        start = time.perf_counter()
+        self.write_nodes(nodes)
+        if nodes:
+            self.deduplicator.record_write(nodes, time.perf_counter() - start, self.__vector_size())
+        return len(nodes)
+
+    def __vector_size(self):
+        """
+        Get the size of the vectors of the embed model
         :return:
         """
-        if self.db == "local":
-            self.__store_nodes_local_vector_store()
-        else:
-            # ingest the documents
-            pipeline = IngestionPipeline(
-                transformations=[
-                    self.node_parser,
-                    # self.embed_model
-                ],
-                documents=self.documents,
-                vector_store=self.vector_store
-            )
+        if self.vector_size is None:
+            self.vector_size = len(self.embed_model.get_text_embedding("vector size"))
+        return self.vector_size
 
-            # run the pipeline to get the nodes
-            self.nodes = pipeline.run(
-                documents=documents,
-                show_progress=self.debug,
-            )
+    def create_nodes(self, documents):
+        """
+        Split the documents into nodes
+        :param documents:
+        :return:
+        """
+        # ingest the documents
+        pipeline = IngestionPipeline(
+            transformations=[
+                self.node_parser,
+                # self.embed_model
+            ],
+            vector_store=self.vector_store
+        )
 
+        # run the pipeline to get the nodes
+        return pipeline.run(
+            documents=documents,
+            show_progress=self.debug,
+        )
+
+    def write_nodes(self, nodes):
+        """
+        Embed the nodes that have no embedding yet and write them to the vector store
+        :param nodes:
+        :return:
+        """
         if self.db == "chromadb":
-            self.__store_nodes_chroma_vector_store()
+            self.__store_nodes_chroma_vector_store(nodes)
+        elif self.db == "local":
+            self.__store_nodes_local_vector_store(nodes)
         elif self.db == "qdrant":
-            self.__store_nodes_qdrant_vector_store()
+            self.__store_nodes_qdrant_vector_store(nodes)
         else:
             raise ValueError(f"Database {self.db} not supported when storing nodes in vector store")
 
-    def __store_nodes_local_vector_store(self):
-        index = VectorStoreIndex.from_documents(
-            documents=self.documents,
-            show_progress=self.debug,
+    def __store_nodes_local_vector_store(self, nodes):
+        """
+        Store the nodes in the local vector store, the vectors are appended to the memory-mapped matrix
+        """
+        storage_context = StorageContext.from_defaults(vector_store=self.vector_store)
+        VectorStoreIndex(
+            nodes=nodes,
+            embed_model=self.embed_model,
+            storage_context=storage_context,
+            show_progress=self.debug
         )
-        # save index to disk
-        index.set_index_id("vector_index")
-        index.storage_context.persist(self.local_persist_directory)
 
-    def __store_nodes_chroma_vector_store(self):
+    def __store_nodes_chroma_vector_store(self, nodes):
         """
         Store the nodes in chroma vector store
         """
@@ -170,41 +639,146 @@ class Storing:
             use_async=self.async_mode,
             embed_model=self.embed_model,
             storage_context=storage_context,
-            nodes=self.nodes,
+            nodes=nodes,
             show_progress=self.debug
         )
 
-    def __store_nodes_qdrant_vector_store(self):
+    def __store_nodes_qdrant_vector_store(self, nodes):
         """
         Store the nodes in qdrant vector store
         """
         # set the storage context
         storage_context = StorageContext.from_defaults(vector_store=self.vector_store)
         VectorStoreIndex(
-            nodes=self.nodes,
+            nodes=nodes,
             embed_model=self.embed_model,
             storage_context=storage_context,
             show_progress=self.debug
         )
+        if self.hybrid:
+            # QdrantVectorStore only writes the dense vectors
+            add_sparse_vectors(self.client, self.collection_name, nodes, self.sparse_encoder)
 
-    @staticmethod
-    def __set_llm(llm):
+    def collection_report(self, queries, top_k: int = 2):
         """
-        Set the LLM
+        Report the estimated RAM footprint and the search latency of the qdrant collection
+        :param queries: e.g. the evaluation questions
+        :param top_k:
         :return:
         """
-        llm_settings = {
-            'request_timeout': 60.0,
-            'temperature': 1,
-            'context_window': 4096
+        if self.db != "qdrant" or self.client is None:
+            raise ValueError("The collection report is only available for qdrant, call open_vector_store first")
+        query_vectors = [self.embed_model.get_query_embedding(query) for query in queries]
+        report = {
+            'collection': self.collection_name,
+            'ram': estimate_ram(self.client, self.collection_name),
+            'latency': measure_search_latency(
+                self.client, self.collection_name, query_vectors, top_k=top_k, profile=self.collection_profile
+            )
         }
+        logger.info(f"Collection report: {report}")
+        return report
 
-        if llm == "mistral":
-            llm_settings['context_window'] = 8192
-        elif llm == "llama2":
-            llm_settings['request_timeout'] = 30.0
+    def export_snapshot(self, path, db, dtype: str = "float32", batch_size: int = 1000):
+        """
+        Export the stored collection into a snapshot file, to restore it elsewhere without embedding.
+        The collection is only read, it is not opened with open_vector_store which would clear it.
+        :param path:
+        :param db: local or qdrant
+        :param dtype: float32 or float16 vectors
+        :param batch_size:
+        :return: manifest
+        """
+        if db == "local":
+            records = MemmapVectorStore(
+                f"{self.local_persist_directory}/{self.collection_name}",
+                dtype=self.local_dtype
+            ).iter_records(batch_size=batch_size)
+        elif db == "qdrant":
+            records = iter_qdrant_records(get_qdrant_client(), self.collection_name, batch_size=batch_size)
+        else:
+            raise ValueError(f"Database {db} not supported for snapshots")
+        return export_snapshot(records, path, self.__snapshot_config(), dtype=dtype)
 
+    def import_snapshot(self, path, db, force=False, batch_size: int = 1000):
+        """
+        Restore a snapshot into the collection, replacing the stored vectors.
+        The manifest has to match the embed model and chunk configuration of this Storing.
+        :param path:
+        :param db: local or qdrant
+        :param force: skip the configuration check, the file hashes are always checked
+        :param batch_size:
+        :return: manifest
+        """
+        start = time.perf_counter()
+        manifest = verify_snapshot(path, None if force else self.__snapshot_config())
+        self.db = db
+        if db == "local":
+            self.vector_store = MemmapVectorStore(
+                f"{self.local_persist_directory}/{self.collection_name}",
+                dtype=self.local_dtype
+            )
+            self.vector_store.clear()
+            for nodes in iter_snapshot_nodes(path, batch_size=batch_size):
+                self.vector_store.add(nodes)
+            self.vector_store.persist()
+            if self.local_ivf_lists is not None:
+                self.vector_store.build_ivf(n_lists=self.local_ivf_lists or None)
+        elif db == "qdrant":
+            self.client = get_qdrant_client()
+            if self.client.collection_exists(self.collection_name):
+                self.client.delete_collection(self.collection_name)
+            self.bulk_stats = bulk_upload(
+                self.client,
+                self.collection_name,
+                iter_snapshot_points(path, batch_size=batch_size, sparse_encoder=self.sparse_encoder),
+                profile=self.collection_profile,
+                **self.bulk_options
+            )
+            self.vector_store = QdrantVectorStore(client=self.client, collection_name=self.collection_name)
+        else:
+            raise ValueError(f"Database {db} not supported for snapshots")
+        bump_collection_version(self.collection_name)
+        logger.info(
+            f"Imported {manifest['points']} points from {path} into {db} {self.collection_name} "
+            f"in {time.perf_counter() - start:.2f}s"
+        )
+        return manifest
+
+    def __snapshot_config(self):
+        """
+        Get the settings a snapshot is exported with and that have to match to import it
+        :return:
+        """
+        return {
+            'collection_name': self.collection_name,
+            'embed_model': self.embed_model.model_name,
+            'embed_namespace': embedding_namespace(self.embed_model),
+            'chunk_size': int(self.chunk_size),
+            'overlap_size': int(self.overlap_size),
+            'node_parser': type(self.node_parser).__name__
+        }
+
+    def chunking_report(self, documents):
+        """
+        Report the embedded and LLM tokens the structured chunking saves for the chunk configuration of this collection
+        :param documents: e.g. a sample of the corpus
+        :return:
+        """
+        report = {
+            'collection': self.collection_name,
+            **token_savings(documents, chunk_size=int(self.chunk_size), chunk_overlap=int(self.overlap_size))
+        }
+        logger.info(f"Chunking report: {report}")
+        return report
+
+    @staticmethod
+    def __set_llm(llm):
+        """
+        Set the LLM
+        :return:
+        """
         return Ollama(
             model=llm,
-            **llm_settings
+            **llm_settings(llm)
         )
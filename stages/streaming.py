@@ -0,0 +1,149 @@
+import logging
+import threading
+import time
+from typing import Any, Dict, List, Optional
+
+from llama_index.core.callbacks import CBEventType
+from llama_index.core.callbacks.base_handler import BaseCallbackHandler
+
+# Sources:
+# https://docs.llamaindex.ai/en/stable/module_guides/deploying/chat_engines/usage_pattern/#streaming
+# https://docs.llamaindex.ai/en/stable/module_guides/observability/callbacks/
+# https://docs.streamlit.io/develop/tutorials/llms/build-conversational-apps#build-a-chatgpt-like-app
+
+"""
+The streaming module streams the chatbot answers token by token
+- astream_chat returns after condensing and retrieval, the sources are shown before the answer is generated
+- Tokens are rendered as they arrive
+- Time-to-first-token, tokens/sec and the latency of the condense, retrieve and generate stages per turn
+"""
+
+logger = logging.getLogger(__name__)
+
+
+class RetrievalTimer(BaseCallbackHandler):
+    """
+    Callback handler that measures the retrieval of a turn.
+    The callback manager can be shared by the sessions, only the events of the turn's thread are recorded.
+    """
+
+    def __init__(self):
+        super().__init__(event_starts_to_ignore=[], event_ends_to_ignore=[])
+        self.thread_id = threading.get_ident()
+        self.seconds = 0.0
+        self.__starts = {}
+
+    def on_event_start(self, event_type: CBEventType, payload: Optional[Dict[str, Any]] = None,
+                       event_id: str = "", parent_id: str = "", **kwargs: Any) -> str:
+        if event_type == CBEventType.RETRIEVE and threading.get_ident() == self.thread_id:
+            self.__starts[event_id] = time.perf_counter()
+        return event_id
+
+    def on_event_end(self, event_type: CBEventType, payload: Optional[Dict[str, Any]] = None,
+                     event_id: str = "", **kwargs: Any) -> None:
+        start = self.__starts.pop(event_id, None)
+        if start is not None:
+            self.seconds += time.perf_counter() - start
+
+    def start_trace(self, trace_id: Optional[str] = None) -> None:
+        pass
+
+    def end_trace(self, trace_id: Optional[str] = None, trace_map: Optional[Dict[str, List[str]]] = None) -> None:
+        pass
+
+
+def callback_managers(chat_engine):
+    """
+    Get the distinct callback managers of a chat engine and its retriever
+    :param chat_engine:
+    :return:
+    """
+    managers = []
+    for component in (chat_engine, getattr(chat_engine, '_retriever', None)):
+        manager = getattr(component, 'callback_manager', None)
+        if manager is not None and all(manager is not known for known in managers):
+            managers.append(manager)
+    return managers
+
+
+async def stream_chat_turn(chat_engine, message, on_sources=None, on_token=None):
+    """
+    Answer a message with astream_chat and measure the stages of the turn
+    :param chat_engine: chat engine with astream_chat, e.g. CondensePlusContextChatEngine or CachedChatEngine
+    :param message:
+    :param on_sources: called with the source nodes once retrieval finished
+    :param on_token: called with the answer so far after every token
+    :return: answer and metrics
+    """
+    timer = RetrievalTimer()
+    managers = callback_managers(chat_engine)
+    for manager in managers:
+        manager.add_handler(timer)
+    start = time.perf_counter()
+    try:
+        response = await chat_engine.astream_chat(message)
+        setup_seconds = time.perf_counter() - start
+        sources = list(getattr(response, 'source_nodes', None) or [])
+        if on_sources is not None:
+            on_sources(sources)
+
+        answer = ""
+        tokens = 0
+        first_token = None
+        async for delta in response.async_response_gen():
+            if not delta:
+                continue
+            if first_token is None:
+                first_token = time.perf_counter()
+            answer += delta
+            tokens += 1
+            if on_token is not None:
+                on_token(answer)
+        end = time.perf_counter()
+    finally:
+        for manager in managers:
+            manager.remove_handler(timer)
+
+    generate_seconds = end - start - setup_seconds
+    stream_seconds = end - first_token if first_token is not None else 0
+    metrics = {
+        'time_to_first_token': round(first_token - start, 3) if first_token is not None else None,
+        'tokens': tokens,
+        # the first token is the end of the prefill, the rate is measured over the following ones
+        'tokens_per_second': round((tokens - 1) / stream_seconds, 2) if tokens > 1 and stream_seconds else None,
+        'condense_seconds': round(max(setup_seconds - timer.seconds, 0), 3),
+        'retrieve_seconds': round(timer.seconds, 3),
+        'generate_seconds': round(generate_seconds, 3),
+        'total_seconds': round(end - start, 3),
+        'sources': len(sources),
+        'cached': bool(getattr(response, 'cached', False))
+    }
+    logger.debug(f"Chat turn: {metrics}")
+    return answer, metrics
+
+
+async def render_chat_turn(chat_engine, message, answer_placeholder, sources_container=None, cursor="▌"):
+    """
+    Stream the answer of a message into Streamlit containers
+    :param chat_engine:
+    :param message:
+    :param answer_placeholder: e.g. st.empty()
+    :param sources_container: e.g. st.expander("Sources"), optional
+    :param cursor: shown behind the answer while it is generated
+    :return: answer and metrics
+    """
+    def show_sources(sources):
+        if sources_container is None:
+            return
+        for source in sources:
+            title = source.node.metadata.get('title', source.node.node_id)
+            sources_container.markdown(f"**{title}** ({source.score:.3f})" if source.score is not None else title)
+
+    answer, metrics = await stream_chat_turn(
+        chat_engine,
+        message,
+        on_sources=show_sources,
+        on_token=lambda text: answer_placeholder.markdown(text + cursor)
+    )
+    answer_placeholder.markdown(answer)
+    return answer, metrics
@@ -0,0 +1,62 @@
+from types import SimpleNamespace
+
+import pytest
+
+from stages.checkpoint import IngestionCheckpoint
+
+
+def documents(*doc_ids):
+    return [SimpleNamespace(doc_id=doc_id) for doc_id in doc_ids]
+
+
+def run(path, docs, window_size=2, total=None):
+    checkpoint = IngestionCheckpoint(path, {'collection_name': "movies"}, total=total)
+    remaining = list(checkpoint.skip(docs))
+    for start in range(0, len(remaining), window_size):
+        checkpoint.commit(remaining[start:start + window_size], nodes=3)
+    checkpoint.finish()
+    return checkpoint
+
+
+def test_interrupted_run_is_resumed(tmp_path):
+    path = tmp_path / "movies.json"
+    checkpoint = IngestionCheckpoint(path, {'collection_name': "movies"})
+    checkpoint.commit(documents("a", "b"), nodes=3)
+
+    resumed = IngestionCheckpoint(path, {'collection_name': "movies"})
+    assert resumed.resumable
+    assert [document.doc_id for document in resumed.skip(documents("a", "b", "c"))] == ["c"]
+
+
+def test_rerun_after_finished_run_starts_new_state(tmp_path):
+    path = tmp_path / "movies.json"
+    first = run(path, documents("a", "b", "c"), total=3)
+    assert first.finished
+    assert first.documents == 3
+
+    rerun = IngestionCheckpoint(path, {'collection_name': "movies"}, total=3)
+    assert not rerun.resumable
+    assert not rerun.finished
+    # the rerun sees every document again and does not count the previous run
+    assert len(list(rerun.skip(documents("a", "b", "c")))) == 3
+    rerun = run(path, documents("a", "b", "c"), total=3)
+    assert rerun.state['documents'] == 3
+    assert rerun.state['nodes'] == 6
+    assert rerun.state['windows'] == 2
+    assert rerun.state['ids_hash'] == first.state['ids_hash']
+
+
+def test_rerun_after_finished_run_accepts_changed_input(tmp_path):
+    path = tmp_path / "movies.json"
+    run(path, documents("a", "b", "c"))
+
+    rerun = run(path, documents("x", "b", "c"))
+    assert rerun.documents == 3
+
+
+def test_changed_input_of_interrupted_run_is_rejected(tmp_path):
+    path = tmp_path / "movies.json"
+    IngestionCheckpoint(path, {'collection_name': "movies"}).commit(documents("a", "b"), nodes=3)
+
+    with pytest.raises(ValueError):
+        list(IngestionCheckpoint(path, {'collection_name': "movies"}).skip(documents("x", "b", "c")))
@@ -0,0 +1,39 @@
+import random
+
+from llama_index.core.schema import TextNode
+
+from stages.dedup import DUPLICATE_SOURCES_KEY, NearDuplicateFilter
+
+
+def plot_text(seed, words=300):
+    rng = random.Random(seed)
+    return " ".join(f"w{rng.randrange(3000)}" for _ in range(words))
+
+
+def movie_node(text, title, release_year):
+    return TextNode(text=text, metadata={'title': title, 'release_year': release_year})
+
+
+def test_collapses_duplicates_of_the_same_movie_only():
+    text = plot_text(0)
+    deduplicator = NearDuplicateFilter()
+    try:
+        first = deduplicator.filter([movie_node(text, "Heat", 1995), movie_node(text, "Heat", 1995)])
+        second = deduplicator.filter([movie_node(text, "Heat", 1986), movie_node(text, "Heat", 1995)])
+    finally:
+        deduplicator.close()
+
+    assert len(first) == 1
+    assert first[0].metadata[DUPLICATE_SOURCES_KEY][0]['release_year'] == 1995
+    # the remake keeps its own chunk, so a release_year filter still finds it
+    assert [node.metadata['release_year'] for node in second] == [1986]
+    assert list(deduplicator.pending) == [first[0].node_id]
+    assert deduplicator.duplicates == 2
+
+
+def test_signature_store_is_removed_on_close():
+    deduplicator = NearDuplicateFilter()
+    deduplicator.filter([movie_node(plot_text(seed), "Heat", 1995) for seed in range(3)])
+    assert deduplicator.path.exists()
+    deduplicator.close()
+    assert not deduplicator.path.exists()
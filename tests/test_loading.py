@@ -0,0 +1,14 @@
+import json
+
+from stages.loading import Loading
+
+
+def test_duplicate_identities_get_distinct_stable_ids(tmp_path):
+    movie = {'release_year': 1994, 'title': "Heat", 'wiki_page': "https://en.wikipedia.org/wiki/Heat", 'plot': "A heist."}
+    rows = [movie, {**movie, 'plot': "Another listing."}, {**movie, 'title': "Heat 2"}]
+    input_file = tmp_path / "movies.json"
+    input_file.write_text(json.dumps(rows), encoding="utf-8")
+
+    ids = [document.doc_id for document in Loading(str(input_file), streaming=True).iter_documents()]
+    assert len(set(ids)) == 3
+    assert ids == [document.doc_id for document in Loading(str(input_file)).get_documents()]
@@ -0,0 +1,22 @@
+import pytest
+
+from stages.self_query import parse_query
+
+
+@pytest.mark.parametrize("question, year_range", [
+    ("Which movies were released between 1990 and 1995?", (1990, 1995)),
+    ("films from 1990 to 1995 about boxing", (1990, 1995)),
+    ("war films released 1939-1945", (1939, 1945)),
+    ("1990-1995 movies with Tom Hanks", (1990, 1995)),
+])
+def test_year_range_with_release_cue(question, year_range):
+    assert parse_query(question)['year_range'] == year_range
+
+
+@pytest.mark.parametrize("question", [
+    "1939-1945 war movies about resistance",
+    "a film set 1939-1945",
+    "movies set between 1939 and 1945",
+])
+def test_story_period_is_not_a_year_range(question):
+    assert 'year_range' not in parse_query(question)